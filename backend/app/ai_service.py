@@ -1,12 +1,176 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from app.config import settings
-from typing import List, Dict
+from app.llm_cache import response_cache, replay_tokens
+from app.prompt_cache import prompt_cache_stats
+from app.prompt_trace import prompt_tracer
+from app.telemetry import record_llm_stream, span
+from app.llm_router import ModelRouter
+from typing import List, Dict, AsyncIterator, Callable, Iterable, Optional
+import httpx
 import logging
 import json
+import time
 
 logger = logging.getLogger(__name__)
 client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
+# Префикс текста-заглушки, который возвращается вместо вопроса при ошибке OpenAI
+QUESTION_FALLBACK_PREFIX = "[ТЕСТОВЫЙ РЕЖИМ - OpenAI недоступен]"
+
+# Асинхронный клиент с общим пулом HTTP-соединений (один на процесс).
+# Используется в async-эндпоинтах, чтобы стриминг не блокировал event loop.
+async_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(settings.OPENAI_TIMEOUT_SECONDS, connect=10.0),
+)
+async_client = AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    http_client=async_http_client,
+    # Повторы с jitter и circuit breaker - в роутере (app/llm_guard.py)
+    max_retries=0,
+)
+
+
+# Роутер запросов по бэкендам LLM_BACKENDS (по умолчанию - единственный async_client)
+model_router = ModelRouter.from_settings(async_client, async_http_client)
+
+
+async def close_async_client() -> None:
+    """Закрывает пул соединений асинхронного клиента (вызывается при shutdown)"""
+    await async_client.close()
+
+
+def _build_question_messages(
+    system_prompt: str,
+    task_description: str,
+    conversation_history: List[Dict[str, str]] = None
+) -> List[Dict[str, str]]:
+    """Собирает messages для генерации вопроса: system + история + текущее задание"""
+    messages = [
+        {"role": "system", "content": system_prompt}
+    ]
+    
+    # Добавляем историю диалога если есть
+    if conversation_history:
+        messages.extend(conversation_history)
+    
+    # Добавляем текущее задание
+    messages.append({
+        "role": "user",
+        "content": task_description
+    })
+    return messages
+
+
+def _build_report_messages(
+    system_prompt: str,
+    report_template: str,
+    all_tasks: List[Dict[str, str]]
+) -> List[Dict[str, str]]:
+    """Собирает messages для финального отчёта из всех вопросов и ответов"""
+    # Формируем текст с вопросами и ответами
+    qa_parts: List[str] = []
+    for i, task in enumerate(all_tasks, 1):
+        qa_parts.append(f"\nВопрос №{i}:\n{task['question']}\n\n")
+        qa_parts.append(f"Ответ:\n{task['answer']}\n")
+        qa_parts.append("-" * 80 + "\n")
+    qa_text = "".join(qa_parts)
+    
+    # Формируем финальный промпт
+    user_prompt = f"{report_template}\n\n{qa_text}"
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def _build_reduce_report_messages(
+    system_prompt: str,
+    report_template: str,
+    all_tasks: List[Dict[str, str]]
+) -> List[Dict[str, str]]:
+    """
+    Собирает messages для финального отчёта по кратким оценкам заданий (reduce-шаг)
+    
+    Задания без оценки (последнее или не успевшее оцениться) передаются целиком.
+    """
+    parts: List[str] = []
+    for i, task in enumerate(all_tasks, 1):
+        if task.get("evaluation"):
+            parts.append(f"\nЗадание №{i} - оценка ответа:\n{task['evaluation']}\n")
+        else:
+            parts.append(f"\nВопрос №{i}:\n{task['question']}\n\n")
+            parts.append(f"Ответ:\n{task['answer']}\n")
+        parts.append("-" * 80 + "\n")
+    
+    user_prompt = (
+        f"{report_template}\n\n"
+        "Ниже - краткие оценки ответов пользователя по заданиям "
+        "(полный вопрос и ответ - там, где оценки нет). "
+        "Составь итоговый отчёт по шаблону на их основе.\n"
+        f"{''.join(parts)}"
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def _build_evaluation_messages(
+    system_prompt: str,
+    report_template: str,
+    task_order: int,
+    question: str,
+    answer: str
+) -> List[Dict[str, str]]:
+    """Собирает messages для краткой оценки одного ответа (map-шаг)"""
+    # Неизменная часть (system + шаблон) идёт первой - она общая для всех заданий сценария
+    user_prompt = (
+        f"Критерии итогового отчёта:\n{report_template}\n\n"
+        f"Задание №{task_order}\nВопрос:\n{question}\n\nОтвет пользователя:\n{answer}\n\n"
+        "Дай краткую оценку этого ответа по критериям отчёта: сильные стороны, "
+        "слабые стороны, ключевые наблюдения. 3-5 пунктов, не более 100 слов. "
+        "Оценка будет использована при составлении итогового отчёта."
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def _log_stream_request(name: str, model: str, temperature: float, max_completion_tokens: int, messages) -> None:
+    if not settings.DEBUG_OPENAI_PROMPTS:
+        return
+    logger.info("=" * 80)
+    logger.info("OpenAI Request - %s", name)
+    logger.info(
+        "Params: %s",
+        json.dumps(
+            {
+                "model": model,
+                "temperature": temperature,
+                "max_completion_tokens": max_completion_tokens,
+                "stream": True,
+            },
+            ensure_ascii=False,
+        ),
+    )
+    logger.info("Messages: %s", json.dumps(messages, ensure_ascii=False, indent=2))
+    logger.info("=" * 80)
+
+
+def _log_response(name: str, text: str) -> None:
+    if not settings.DEBUG_OPENAI_PROMPTS:
+        return
+    logger.info("=" * 80)
+    logger.info("OpenAI Response - %s", name)
+    logger.info("Response: %s", text)
+    logger.info("=" * 80)
+
 
 def generate_task_question(
     system_prompt: str,
@@ -25,19 +189,7 @@ def generate_task_question(
         Сгенерированный вопрос/задание от AI
     """
     try:
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
-        
-        # Добавляем историю диалога если есть
-        if conversation_history:
-            messages.extend(conversation_history)
-        
-        # Добавляем текущее задание
-        messages.append({
-            "role": "user",
-            "content": task_description
-        })
+        messages = _build_question_messages(system_prompt, task_description, conversation_history)
         
         # Debug logging
         if settings.DEBUG_OPENAI_PROMPTS:
@@ -54,13 +206,7 @@ def generate_task_question(
         )
         
         ai_response = response.choices[0].message.content
-        
-        # Debug logging
-        if settings.DEBUG_OPENAI_PROMPTS:
-            logger.info("=" * 80)
-            logger.info("OpenAI Response - generate_task_question")
-            logger.info(f"Response: {ai_response}")
-            logger.info("=" * 80)
+        _log_response("generate_task_question", ai_response)
         
         return ai_response
         
@@ -68,7 +214,7 @@ def generate_task_question(
         logger.error(f"Error generating task question: {e}", exc_info=True)
         
         # Временное решение: возвращаем задание с пометкой
-        return f"[ТЕСТОВЫЙ РЕЖИМ - OpenAI недоступен]\n\n{task_description}"
+        return f"{QUESTION_FALLBACK_PREFIX}\n\n{task_description}"
         # Возвращаем сам текст задания в случае ошибки
         #return task_description
 
@@ -90,42 +236,13 @@ def generate_task_question_stream(
         Токены ответа от AI по мере генерации
     """
     try:
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
-        
-        # Добавляем историю диалога если есть
-        if conversation_history:
-            messages.extend(conversation_history)
-        
-        # Добавляем текущее задание
-        messages.append({
-            "role": "user",
-            "content": task_description
-        })
+        messages = _build_question_messages(system_prompt, task_description, conversation_history)
 
         model = settings.OPENAI_MODEL
         temperature = 0.7
         max_completion_tokens = 1500
 
-        # Debug logging (request)
-        if settings.DEBUG_OPENAI_PROMPTS:
-            logger.info("=" * 80)
-            logger.info("OpenAI Request - generate_task_question_stream")
-            logger.info(
-                "Params: %s",
-                json.dumps(
-                    {
-                        "model": model,
-                        "temperature": temperature,
-                        "max_completion_tokens": max_completion_tokens,
-                        "stream": True,
-                    },
-                    ensure_ascii=False,
-                ),
-            )
-            logger.info("Messages: %s", json.dumps(messages, ensure_ascii=False, indent=2))
-            logger.info("=" * 80)
+        _log_stream_request("generate_task_question_stream", model, temperature, max_completion_tokens, messages)
 
         # Streaming request
         stream = client.chat.completions.create(
@@ -148,18 +265,12 @@ def generate_task_question_stream(
                 full_text_parts.append(token)
                 yield token
 
-        # Debug logging (response)
-        if settings.DEBUG_OPENAI_PROMPTS:
-            full_text = "".join(full_text_parts)
-            logger.info("=" * 80)
-            logger.info("OpenAI Response - generate_task_question_stream")
-            logger.info("Response: %s", full_text)
-            logger.info("=" * 80)
+        _log_response("generate_task_question_stream", "".join(full_text_parts))
         
     except Exception as e:
         logger.error(f"Error generating task question (streaming): {e}", exc_info=True)
         # В случае ошибки возвращаем fallback
-        yield f"[ТЕСТОВЫЙ РЕЖИМ - OpenAI недоступен]\n\n{task_description}"
+        yield f"{QUESTION_FALLBACK_PREFIX}\n\n{task_description}"
 
 
 def generate_next_task_prompt(
@@ -178,7 +289,8 @@ def generate_next_task_prompt(
     Returns:
         Сформированный промпт для user role
     """
-    # Формируем промпт с ответом пользователя и следующим заданием
+    # Сначала ответ на текущее задание, затем новое задание: модель реагирует на
+    # ответ и переходит к следующему шагу. Кешируемый префикс - системный промпт
     prompt = f"Пользователь ответил на задание №{current_task_order}. Его ответ: {user_answer}\n\n{next_task_description}"
     
     return prompt
@@ -201,43 +313,13 @@ def generate_final_report_stream(
         Токены отчета от AI по мере генерации
     """
     try:
-        # Формируем текст с вопросами и ответами
-        qa_text = ""
-        for i, task in enumerate(all_tasks, 1):
-            qa_text += f"\nВопрос №{i}:\n{task['question']}\n\n"
-            qa_text += f"Ответ:\n{task['answer']}\n"
-            qa_text += "-" * 80 + "\n"
-        
-        # Формируем финальный промпт
-        user_prompt = f"{report_template}\n\n{qa_text}"
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages = _build_report_messages(system_prompt, report_template, all_tasks)
 
         model = settings.OPENAI_MODEL
         temperature = 0.5
         max_completion_tokens = 3000
 
-        # Debug logging (request)
-        if settings.DEBUG_OPENAI_PROMPTS:
-            logger.info("=" * 80)
-            logger.info("OpenAI Request - generate_final_report_stream")
-            logger.info(
-                "Params: %s",
-                json.dumps(
-                    {
-                        "model": model,
-                        "temperature": temperature,
-                        "max_completion_tokens": max_completion_tokens,
-                        "stream": True,
-                    },
-                    ensure_ascii=False,
-                ),
-            )
-            logger.info("Messages: %s", json.dumps(messages, ensure_ascii=False, indent=2))
-            logger.info("=" * 80)
+        _log_stream_request("generate_final_report_stream", model, temperature, max_completion_tokens, messages)
 
         # Streaming request
         stream = client.chat.completions.create(
@@ -260,13 +342,7 @@ def generate_final_report_stream(
                 full_text_parts.append(token)
                 yield token
 
-        # Debug logging (response)
-        if settings.DEBUG_OPENAI_PROMPTS:
-            full_text = "".join(full_text_parts)
-            logger.info("=" * 80)
-            logger.info("OpenAI Response - generate_final_report_stream")
-            logger.info("Response: %s", full_text)
-            logger.info("=" * 80)
+        _log_response("generate_final_report_stream", "".join(full_text_parts))
         
     except Exception as e:
         logger.error(f"Error generating final report (streaming): {e}", exc_info=True)
@@ -290,20 +366,7 @@ def generate_final_report(
         Финальный отчёт от AI
     """
     try:
-        # Формируем текст с вопросами и ответами
-        qa_text = ""
-        for i, task in enumerate(all_tasks, 1):
-            qa_text += f"\nВопрос №{i}:\n{task['question']}\n\n"
-            qa_text += f"Ответ:\n{task['answer']}\n"
-            qa_text += "-" * 80 + "\n"
-        
-        # Формируем финальный промпт
-        user_prompt = f"{report_template}\n\n{qa_text}"
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages = _build_report_messages(system_prompt, report_template, all_tasks)
         
         # Debug logging
         if settings.DEBUG_OPENAI_PROMPTS:
@@ -320,16 +383,312 @@ def generate_final_report(
         )
         
         ai_response = response.choices[0].message.content
+        _log_response("generate_final_report", ai_response)
         
-        # Debug logging
+        return ai_response
+        
+    except Exception as e:
+        logger.error(f"Error generating final report: {e}", exc_info=True)
+        return "К сожалению, возникла ошибка при генерации отчёта. Пожалуйста, свяжитесь с поддержкой."
+
+
+# ============================================================
+# Асинхронные версии (AsyncOpenAI) - используются в роутерах
+# ============================================================
+
+def _system_prompt_of(messages: List[Dict[str, str]]) -> str:
+    return messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+
+
+async def complete_async(
+    messages: List[Dict[str, str]],
+    temperature: Optional[float],
+    max_completion_tokens: int,
+    name: str = "complete_async",
+):
+    """Нестриминговый completion через роутер бэкендов с учётом кешированных токенов"""
+    trace = prompt_tracer.start(name, messages, temperature, max_completion_tokens)
+    try:
+        with span("llm_completion"):
+            response = await model_router.complete(messages, temperature, max_completion_tokens)
+    except Exception as e:
+        if trace:
+            trace.fail(e)
+        raise
+    usage = getattr(response, "usage", None)
+    prompt_cache_stats.record(_system_prompt_of(messages), usage)
+    if trace:
+        trace.finish(response.choices[0].message.content, getattr(response, "model", None), usage)
+    return response
+
+
+async def _stream_completion_async(
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_completion_tokens: int,
+    hedge: bool = False,
+    name: str = "stream_completion_async",
+    on_model: Optional[Callable[[str], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    Стримит токены completion через роутер бэкендов (hedge - дублировать медленный запрос)
+
+    on_model получает модель бэкенда, который действительно отвечает (см. ModelRouter.stream)
+    """
+    system_prompt = _system_prompt_of(messages)
+    trace = prompt_tracer.start(name, messages, temperature, max_completion_tokens)
+    model = None
+    usage = None
+    parts: List[str] = []
+    started = time.perf_counter()
+    first_token = None
+    tokens = 0
+    try:
+        async for chunk in model_router.stream(
+            messages, temperature, max_completion_tokens, hedge=hedge, on_model=on_model
+        ):
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+                prompt_cache_stats.record(system_prompt, usage)
+            model = model or getattr(chunk, "model", None)
+
+            token = None
+            try:
+                token = chunk.choices[0].delta.content
+            except Exception:
+                token = None
+
+            if token:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                tokens += 1
+                if trace:
+                    parts.append(token)
+                yield token
+    except Exception as e:
+        if trace:
+            trace.fail(e)
+        raise
+    record_llm_stream(name, first_token, getattr(usage, "completion_tokens", None) or tokens, time.perf_counter() - started)
+    if trace:
+        trace.finish("".join(parts), model, usage)
+
+
+async def generate_task_question_async(
+    system_prompt: str,
+    task_description: str,
+    conversation_history: List[Dict[str, str]] = None
+) -> str:
+    """Асинхронная версия generate_task_question"""
+    try:
+        messages = _build_question_messages(system_prompt, task_description, conversation_history)
+
         if settings.DEBUG_OPENAI_PROMPTS:
             logger.info("=" * 80)
-            logger.info("OpenAI Response - generate_final_report")
-            logger.info(f"Response: {ai_response}")
+            logger.info("OpenAI Request - generate_task_question_async")
+            logger.info("Messages: %s", json.dumps(messages, ensure_ascii=False, indent=2))
             logger.info("=" * 80)
-        
+
+        response = await complete_async(
+            messages, temperature=0.7, max_completion_tokens=1500, name="generate_task_question_async"
+        )
+
+        ai_response = response.choices[0].message.content
+        _log_response("generate_task_question_async", ai_response)
+
         return ai_response
-        
+
     except Exception as e:
-        logger.error(f"Error generating final report: {e}", exc_info=True)
+        logger.error(f"Error generating task question (async): {e}", exc_info=True)
+        return f"{QUESTION_FALLBACK_PREFIX}\n\n{task_description}"
+
+
+async def generate_task_question_stream_async(
+    system_prompt: str,
+    task_description: str,
+    conversation_history: List[Dict[str, str]] = None,
+    cache_tags: Optional[Iterable[str]] = None
+) -> AsyncIterator[str]:
+    """
+    Асинхронная версия generate_task_question_stream (для async for в SSE-генераторах)
+    
+    Args:
+        cache_tags: Если заданы и история пуста - ответ берётся из/кладётся в
+            response_cache (теги используются для инвалидации, напр. "scenario:1")
+    
+    Yields:
+        Токены ответа от AI по мере генерации
+    """
+    try:
+        messages = _build_question_messages(system_prompt, task_description, conversation_history)
+
+        temperature = 0.7
+        max_completion_tokens = 1500
+
+        # Модель, ответившая на запрос: ключ кеша строится по ней, а не по OPENAI_MODEL
+        served_models: Optional[List[str]] = None
+        if cache_tags is not None and not conversation_history and settings.LLM_CACHE_ENABLED:
+            cached = response_cache.get_any(
+                response_cache.make_key(model, messages, temperature) for model in model_router.models()
+            )
+            if cached is not None:
+                async for token in replay_tokens(cached):
+                    yield token
+                return
+            served_models = []
+
+        _log_stream_request(
+            "generate_task_question_stream_async",
+            settings.OPENAI_MODEL, temperature, max_completion_tokens, messages
+        )
+
+        full_text_parts: List[str] = []
+        # Вопрос ждёт пользователь - медленный первый токен дублируется во второй бэкенд
+        async for token in _stream_completion_async(
+            messages, temperature, max_completion_tokens, hedge=True, name="generate_task_question_stream_async",
+            on_model=served_models.append if served_models is not None else None,
+        ):
+            full_text_parts.append(token)
+            yield token
+
+        full_text = "".join(full_text_parts)
+        if served_models and full_text:
+            response_cache.put(response_cache.make_key(served_models[-1], messages, temperature), full_text, cache_tags)
+
+        _log_response("generate_task_question_stream_async", full_text)
+
+    except Exception as e:
+        logger.error(f"Error generating task question (async streaming): {e}", exc_info=True)
+        yield f"{QUESTION_FALLBACK_PREFIX}\n\n{task_description}"
+
+
+async def generate_final_report_stream_async(
+    system_prompt: str,
+    report_template: str,
+    all_tasks: List[Dict[str, str]],
+    use_evaluations: bool = False
+) -> AsyncIterator[str]:
+    """
+    Асинхронная версия generate_final_report_stream
+    
+    Args:
+        use_evaluations: Строить отчёт по кратким оценкам заданий (ключ "evaluation"),
+            а не по полным вопросам и ответам
+    
+    Yields:
+        Токены отчета от AI по мере генерации
+    """
+    try:
+        if use_evaluations:
+            messages = _build_reduce_report_messages(system_prompt, report_template, all_tasks)
+        else:
+            messages = _build_report_messages(system_prompt, report_template, all_tasks)
+
+        temperature = 0.5
+        max_completion_tokens = 3000
+        _log_stream_request(
+            "generate_final_report_stream_async",
+            settings.OPENAI_MODEL, temperature, max_completion_tokens, messages
+        )
+
+        full_text_parts: List[str] = []
+        async for token in _stream_completion_async(
+            messages, temperature, max_completion_tokens, name="generate_final_report_stream_async"
+        ):
+            full_text_parts.append(token)
+            yield token
+
+        _log_response("generate_final_report_stream_async", "".join(full_text_parts))
+
+    except Exception as e:
+        logger.error(f"Error generating final report (async streaming): {e}", exc_info=True)
+        yield "К сожалению, возникла ошибка при генерации отчёта. Пожалуйста, свяжитесь с поддержкой."
+
+
+async def summarize_history_async(
+    previous_summary: Optional[str],
+    messages: List[Dict[str, str]]
+) -> Optional[str]:
+    """Сжимает старую часть диалога в краткое содержание (None при ошибке)"""
+    try:
+        dialogue = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous_summary:
+            dialogue = f"Предыдущее краткое содержание:\n{previous_summary}\n\nНовые сообщения:\n{dialogue}"
+
+        response = await complete_async(
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Сожми диалог симуляции в краткое содержание: какие задания были, "
+                        "что ответил пользователь, важные детали для следующих вопросов. "
+                        "Пиши сжато, без вступлений."
+                    )
+                },
+                {"role": "user", "content": dialogue}
+            ],
+            temperature=0.3,
+            max_completion_tokens=settings.HISTORY_SUMMARY_MAX_TOKENS,
+            name="summarize_history_async"
+        )
+
+        return response.choices[0].message.content or None
+
+    except Exception as e:
+        logger.error(f"Error summarizing history (async): {e}", exc_info=True)
+        return None
+
+
+async def evaluate_task_answer_async(
+    system_prompt: str,
+    report_template: str,
+    task_order: int,
+    question: str,
+    answer: str
+) -> Optional[str]:
+    """Краткая оценка ответа на задание для инкрементального отчёта (None при ошибке)"""
+    try:
+        messages = _build_evaluation_messages(system_prompt, report_template, task_order, question, answer)
+
+        response = await complete_async(
+            messages, temperature=0.3, max_completion_tokens=settings.REPORT_EVALUATION_MAX_TOKENS,
+            name="evaluate_task_answer_async"
+        )
+
+        ai_response = response.choices[0].message.content
+        _log_response("evaluate_task_answer_async", ai_response)
+
+        return ai_response or None
+
+    except Exception as e:
+        logger.error(f"Error evaluating task answer (async): {e}", exc_info=True)
+        return None
+
+
+async def generate_final_report_async(
+    system_prompt: str,
+    report_template: str,
+    all_tasks: List[Dict[str, str]]
+) -> str:
+    """Асинхронная версия generate_final_report"""
+    try:
+        messages = _build_report_messages(system_prompt, report_template, all_tasks)
+
+        if settings.DEBUG_OPENAI_PROMPTS:
+            logger.info("=" * 80)
+            logger.info("OpenAI Request - generate_final_report_async")
+            logger.info("Messages: %s", json.dumps(messages, ensure_ascii=False, indent=2))
+            logger.info("=" * 80)
+
+        response = await complete_async(
+            messages, temperature=0.5, max_completion_tokens=3000, name="generate_final_report_async"
+        )
+
+        ai_response = response.choices[0].message.content
+        _log_response("generate_final_report_async", ai_response)
+
+        return ai_response
+
+    except Exception as e:
+        logger.error(f"Error generating final report (async): {e}", exc_info=True)
         return "К сожалению, возникла ошибка при генерации отчёта. Пожалуйста, свяжитесь с поддержкой."
@@ -0,0 +1,133 @@
+"""
+Продуктовая аналитика: события в таблицу events
+
+Обработчики вызывают analytics.emit(...) - это только добавление кортежа в
+кольцевой буфер процесса (deque с maxlen), без ввода-вывода и без ожидания.
+Фоновый flusher забирает события пачками по ANALYTICS_FLUSH_SIZE (или раз в
+ANALYTICS_FLUSH_INTERVAL_SECONDS) и пишет их одним COPY (asyncpg
+copy_records_to_table) или, при ANALYTICS_USE_COPY=false, одним многострочным
+INSERT.
+
+Буфер ограничен ANALYTICS_BUFFER_SIZE: если БД не успевает или недоступна,
+самые старые события вытесняются (счётчик dropped), запросы пользователей
+никогда не ждут запись аналитики. Пачка, которую не удалось записать,
+тоже отбрасывается (счётчик failed) - аналитика best-effort.
+
+Оценка пропускной способности: scripts/benchmark_analytics.py.
+"""
+import asyncio
+import json
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from app.config import settings
+from app.database import async_engine
+from app.models import Event
+
+logger = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ["user_id", "event_type", "event_metadata", "created_at"]
+
+EventRecord = Tuple[Optional[int], str, Dict[str, Any], datetime]
+
+
+class EventPipeline:
+    def __init__(self, capacity: int, flush_size: int, flush_interval: float, use_copy: bool):
+        self.capacity = capacity
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.use_copy = use_copy
+        self._buffer: Deque[EventRecord] = deque(maxlen=capacity)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._counters = {"emitted": 0, "dropped": 0, "written": 0, "failed": 0, "batches": 0}
+
+    def emit(self, event_type: str, user_id: Optional[int] = None, **metadata: Any) -> None:
+        """Ставит событие в буфер; при переполнении вытесняет самое старое"""
+        if not settings.ANALYTICS_ENABLED:
+            return
+        if len(self._buffer) >= self.capacity:
+            self._counters["dropped"] += 1
+        self._buffer.append((user_id, event_type, metadata, datetime.now(timezone.utc)))
+        self._counters["emitted"] += 1
+        if len(self._buffer) >= self.flush_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        # Flusher создаётся внутри работающего event loop (при startup)
+        if self._flusher is None and settings.ANALYTICS_ENABLED:
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает flusher и дописывает остаток буфера"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+            self._wakeup = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _take(self) -> List[EventRecord]:
+        batch = []
+        while self._buffer and len(batch) < self.flush_size:
+            batch.append(self._buffer.popleft())
+        return batch
+
+    async def flush(self) -> int:
+        """Пишет всё, что накопилось в буфере, пачками по flush_size"""
+        written = 0
+        while self._buffer:
+            batch = self._take()
+            try:
+                await self._write(batch)
+            except Exception as e:
+                self._counters["failed"] += len(batch)
+                logger.warning(f"Analytics flush of {len(batch)} events failed: {e}")
+                break
+            self._counters["batches"] += 1
+            self._counters["written"] += len(batch)
+            written += len(batch)
+        return written
+
+    async def _write(self, batch: List[EventRecord]) -> None:
+        async with async_engine.begin() as conn:
+            if self.use_copy:
+                # Сериализация metadata - здесь, а не в emit, чтобы не нагружать обработчики
+                records = [
+                    (user_id, event_type, json.dumps(metadata, ensure_ascii=False, default=str), created_at)
+                    for user_id, event_type, metadata, created_at in batch
+                ]
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.copy_records_to_table("events", records=records, columns=EVENT_COLUMNS)
+            else:
+                await conn.execute(insert(Event), [dict(zip(EVENT_COLUMNS, record)) for record in batch])
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "buffered": len(self._buffer),
+            "capacity": self.capacity,
+            "method": "copy" if self.use_copy else "insert",
+        }
+
+
+analytics = EventPipeline(
+    capacity=settings.ANALYTICS_BUFFER_SIZE,
+    flush_size=settings.ANALYTICS_FLUSH_SIZE,
+    flush_interval=settings.ANALYTICS_FLUSH_INTERVAL_SECONDS,
+    use_copy=settings.ANALYTICS_USE_COPY,
+)
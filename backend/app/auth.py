@@ -1,25 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
 import logging
 from app.config import settings
-from app.database import get_db
+from app.database import get_async_db
 from app.models import User
+from app.principal_cache import Principal, principal_cache
+from app.telemetry import span
 
 logger = logging.getLogger(__name__)
 
-# Используем bcrypt с явным указанием бэкенда
+# Используем bcrypt с явным указанием бэкенда.
+# min_rounds = rounds: хеши с меньшей стоимостью считаются устаревшими
+# и прозрачно перехешируются при следующем входе (verify_and_update).
 pwd_context = CryptContext(
     schemes=["bcrypt"],
     deprecated="auto",
-    bcrypt__rounds=12
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS
 )
 security = HTTPBearer()
 
+# bcrypt отпускает GIL, поэтому отдельный пул потоков даёт реальный параллелизм
+# и не блокирует event loop на ~250 мс на каждый вход/регистрацию
+_password_executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    thread_name_prefix="password-hash"
+)
+_password_jobs = 0
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -29,21 +45,66 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def _run_password_job(func, *args):
+    """Выполняет bcrypt в пуле; при переполненной очереди отвечает 503 с Retry-After"""
+    global _password_jobs
+    if _password_jobs >= settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_MAX_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(settings.PASSWORD_HASH_RETRY_AFTER_SECONDS)},
+        )
+    _password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_jobs -= 1
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Проверяет пароль в пуле потоков
+    
+    Returns:
+        (валиден ли пароль, новый хеш - если текущий нужно обновить под актуальную стоимость)
+    """
+    return await _run_password_job(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_password_job(pwd_context.hash, password)
+
+
+def password_pool_stats() -> dict:
+    return {
+        "workers": settings.PASSWORD_HASH_WORKERS,
+        "max_queue": settings.PASSWORD_HASH_MAX_QUEUE,
+        "in_flight": _password_jobs,
+    }
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
     return encoded_jwt
 
 
+def principal_claims(user: User) -> dict:
+    """Claims is_active/is_admin для токена (если включено JWT_PRINCIPAL_CLAIMS)"""
+    if not settings.JWT_PRINCIPAL_CLAIMS:
+        return {}
+    return {"act": bool(user.is_active), "adm": bool(user.is_admin)}
+
+
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
+    db: AsyncSession = Depends(get_async_db)
+) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -65,17 +126,29 @@ async def get_current_user(
         logger.error(f"Unexpected error in authentication: {e}")
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
-        logger.warning(f"User not found: {user_id}")
-        raise credentials_exception
+    # Claims в токене → кеш → БД (только id и флаги, без загрузки всей строки)
+    with span("auth"):
+        principal = None
+        if settings.JWT_PRINCIPAL_CLAIMS:
+            principal = await principal_cache.from_claims(user_id, payload)
+        if principal is None:
+            principal = await principal_cache.get(user_id)
+        if principal is None:
+            row = (await db.execute(
+                select(User.id, User.is_active, User.is_admin).where(User.id == user_id)
+            )).first()
+            if row is None:
+                logger.warning(f"User not found: {user_id}")
+                raise credentials_exception
+            principal = Principal(id=row.id, is_active=bool(row.is_active), is_admin=bool(row.is_admin))
+            await principal_cache.put(principal)
     
-    return user
+    return principal
 
 
 async def get_current_active_user(
-    current_user: User = Depends(get_current_user)
-) -> User:
+    current_user: Principal = Depends(get_current_user)
+) -> Principal:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
@@ -0,0 +1,211 @@
+"""
+Снимок каталога: профессии, сценарии, задания и шаблоны отчётов
+
+Каталог почти не меняется, поэтому он загружается целиком в неизменяемые
+структуры при старте и заменяется атомарно (одним присваиванием) после
+каждой правки в admin.py. Горячие эндпоинты (задания, список профессий)
+читают снимок без запросов к БД.
+
+Версия снимка - хеш содержимого: одинакова во всех воркерах и служит ETag.
+Другие воркеры подхватывают правки периодической перезагрузкой
+(CATALOG_REFRESH_INTERVAL_SECONDS).
+"""
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Profession, ReportTemplate, Scenario, Task
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProfessionEntry:
+    id: int
+    name: str
+    name_en: Optional[str]
+    description: Optional[str]
+    description_en: Optional[str]
+    language: str
+    category: Optional[str]
+    is_active: bool
+    price: float
+    created_at: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class TaskEntry:
+    id: int
+    scenario_id: int
+    order: int
+    type: Optional[str]
+    time_limit_minutes: Optional[int]
+    description_template: str
+
+
+@dataclass(frozen=True)
+class ScenarioEntry:
+    id: int
+    profession_id: int
+    system_prompt: str
+    tasks: Tuple[TaskEntry, ...]  # упорядочены по order
+    order_index: Mapping[int, int]  # order -> индекс в tasks
+
+    @property
+    def total_tasks(self) -> int:
+        return len(self.tasks)
+
+    def task_by_order(self, order: int) -> Optional[TaskEntry]:
+        index = self.order_index.get(order)
+        return self.tasks[index] if index is not None else None
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: str
+    professions: Tuple[ProfessionEntry, ...]
+    profession_by_id: Mapping[int, ProfessionEntry]
+    scenario_by_id: Mapping[int, ScenarioEntry]
+    scenario_by_profession: Mapping[int, ScenarioEntry]
+    task_by_id: Mapping[int, TaskEntry]
+    report_template_by_profession: Mapping[int, str]
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+    @property
+    def active_professions(self) -> Tuple[ProfessionEntry, ...]:
+        return tuple(p for p in self.professions if p.is_active)
+
+
+async def _load_snapshot() -> CatalogSnapshot:
+    async with AsyncSessionLocal() as db:
+        professions = (await db.scalars(select(Profession).order_by(Profession.id))).all()
+        scenarios = (await db.scalars(select(Scenario).order_by(Scenario.id))).all()
+        tasks = (await db.scalars(select(Task).order_by(Task.scenario_id, Task.order))).all()
+        templates = (await db.scalars(select(ReportTemplate).order_by(ReportTemplate.id))).all()
+
+    profession_entries = tuple(
+        ProfessionEntry(
+            id=p.id,
+            name=p.name,
+            name_en=p.name_en,
+            description=p.description,
+            description_en=p.description_en,
+            language=p.language,
+            category=p.category,
+            is_active=bool(p.is_active),
+            price=float(p.price) if p.price is not None else 0.0,
+            created_at=p.created_at,
+        )
+        for p in professions
+    )
+
+    tasks_by_scenario = {}
+    for t in tasks:
+        tasks_by_scenario.setdefault(t.scenario_id, []).append(TaskEntry(
+            id=t.id,
+            scenario_id=t.scenario_id,
+            order=t.order,
+            type=t.type,
+            time_limit_minutes=t.time_limit_minutes,
+            description_template=t.description_template,
+        ))
+
+    scenario_by_id = {}
+    scenario_by_profession = {}
+    for s in scenarios:
+        scenario_tasks = tuple(tasks_by_scenario.get(s.id, ()))
+        entry = ScenarioEntry(
+            id=s.id,
+            profession_id=s.profession_id,
+            system_prompt=s.system_prompt,
+            tasks=scenario_tasks,
+            order_index=MappingProxyType({t.order: i for i, t in enumerate(scenario_tasks)}),
+        )
+        scenario_by_id[s.id] = entry
+        # Как и раньше (.first()), у профессии используется один сценарий - с наименьшим id
+        scenario_by_profession.setdefault(s.profession_id, entry)
+
+    report_templates = {}
+    for rt in templates:
+        report_templates.setdefault(rt.profession_id, rt.template_text)
+
+    digest = hashlib.sha1()
+    for part in (profession_entries, tuple(scenario_by_id.values()), tuple(sorted(report_templates.items()))):
+        digest.update(repr(part).encode("utf-8"))
+
+    return CatalogSnapshot(
+        version=digest.hexdigest()[:16],
+        professions=profession_entries,
+        profession_by_id=MappingProxyType({p.id: p for p in profession_entries}),
+        scenario_by_id=MappingProxyType(scenario_by_id),
+        scenario_by_profession=MappingProxyType(scenario_by_profession),
+        task_by_id=MappingProxyType({t.id: t for ts in tasks_by_scenario.values() for t in ts}),
+        report_template_by_profession=MappingProxyType(report_templates),
+    )
+
+
+class Catalog:
+    def __init__(self):
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def snapshot(self) -> Optional[CatalogSnapshot]:
+        """Текущий снимок без загрузки (None, если ещё не загружен)"""
+        return self._snapshot
+
+    async def get(self) -> CatalogSnapshot:
+        """Текущий снимок (загружается при первом обращении, если не был загружен при старте)"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = await self.refresh()
+        return snapshot
+
+    async def refresh(self) -> CatalogSnapshot:
+        """Перечитывает каталог из БД и атомарно заменяет снимок"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            snapshot = await _load_snapshot()
+            if self._snapshot is None or self._snapshot.version != snapshot.version:
+                logger.info("Catalog snapshot loaded: version %s", snapshot.version)
+            self._snapshot = snapshot
+            return snapshot
+
+    async def run_refresh_loop(self) -> None:
+        """Фоновая перезагрузка - чтобы правки из другого воркера доходили до этого"""
+        interval = settings.CATALOG_REFRESH_INTERVAL_SECONDS
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Catalog refresh failed: {e}")
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"loaded": False}
+        return {
+            "loaded": True,
+            "version": snapshot.version,
+            "professions": len(snapshot.professions),
+            "scenarios": len(snapshot.scenario_by_id),
+            "tasks": len(snapshot.task_by_id),
+        }
+
+
+catalog = Catalog()
@@ -0,0 +1,177 @@
+"""
+Бюджет токенов истории диалога
+
+Без ограничения каждый следующий вопрос отправляет модели всю историю
+попытки, и размер промпта растёт с каждым заданием. HistoryCompactor
+считает токены (tiktoken, если установлен, иначе оценка по длине текста) и,
+когда system + история + задание превышают HISTORY_TOKEN_BUDGET, заменяет
+старые сообщения кратким содержанием, оставляя последние
+HISTORY_KEEP_LAST_MESSAGES сообщений без изменений.
+
+Содержание "скользящее": для попытки хранится последнее резюме и число
+покрытых им сообщений, при следующем сжатии суммируются только новые.
+"""
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+Message = Dict[str, str]
+Summarizer = Callable[[Optional[str], List[Message]], Awaitable[Optional[str]]]
+
+# Служебные токены на каждое сообщение и на начало ответа (формат chat completions)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 2
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.encoding_for_model(settings.OPENAI_MODEL)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    return _encoding
+
+
+def count_text_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Без tiktoken: для смешанного русского/английского текста ~3 символа на токен
+    return (len(text) + 2) // 3
+
+
+def count_message_tokens(messages: List[Message]) -> int:
+    return sum(TOKENS_PER_MESSAGE + count_text_tokens(m.get("content") or "") for m in messages) + TOKENS_PER_REPLY
+
+
+@dataclass
+class CompactionResult:
+    history: List[Message]
+    tokens_before: int
+    tokens_after: int
+    summarized_messages: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class HistoryCompactor:
+    def __init__(self, budget: int, keep_last: int, summarize: Summarizer, max_entries: int = 10000):
+        self.budget = budget
+        self.keep_last = keep_last
+        self.max_entries = max_entries
+        self._summarize = summarize
+        # key (progress_id) -> (число покрытых сообщений, текст резюме)
+        self._summaries: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+        self._counters = {
+            "requests": 0,
+            "compacted": 0,
+            "summaries": 0,
+            "summary_failures": 0,
+            "tokens_before": 0,
+            "tokens_after": 0,
+        }
+
+    def _remember(self, key: int, covered: int, summary: str) -> None:
+        self._summaries[key] = (covered, summary)
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.max_entries:
+            self._summaries.popitem(last=False)
+
+    async def fit(
+        self,
+        key: int,
+        system_prompt: str,
+        history: List[Message],
+        task_description: str,
+    ) -> CompactionResult:
+        """История, укладывающаяся в бюджет вместе с system и текущим заданием"""
+        fixed = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": task_description},
+        ]
+        tokens_before = count_message_tokens(fixed + history)
+        self._counters["requests"] += 1
+        self._counters["tokens_before"] += tokens_before
+
+        if tokens_before <= self.budget or len(history) <= self.keep_last:
+            self._counters["tokens_after"] += tokens_before
+            return CompactionResult(history, tokens_before, tokens_before)
+
+        split = len(history) - self.keep_last
+        old = history[:split]
+
+        cached = self._summaries.get(key)
+        if cached and cached[0] <= split:
+            covered, summary = cached
+        else:
+            covered, summary = 0, None
+
+        if covered < split:
+            try:
+                updated = await self._summarize(summary, old[covered:])
+            except Exception as e:
+                logger.warning(f"History summarization failed: {e}")
+                updated = None
+            if updated:
+                covered, summary = split, updated
+                self._counters["summaries"] += 1
+                self._remember(key, covered, summary)
+            else:
+                # Непересказанные сообщения не отбрасываются: после прежнего резюме
+                # (если оно есть) они идут как есть, следующий вызов попробует снова
+                self._counters["summary_failures"] += 1
+
+        if not summary:
+            # Пересказать нечего и не удалось - история уходит без сжатия
+            self._counters["tokens_after"] += tokens_before
+            return CompactionResult(history, tokens_before, tokens_before)
+
+        compacted = [{"role": "system", "content": SUMMARY_PREFIX + summary}, *history[covered:]]
+
+        tokens_after = count_message_tokens(fixed + compacted)
+        self._counters["compacted"] += 1
+        self._counters["tokens_after"] += tokens_after
+        logger.info(
+            "History compacted for %s: %d -> %d prompt tokens (%d messages summarized)",
+            key, tokens_before, tokens_after, covered
+        )
+        return CompactionResult(compacted, tokens_before, tokens_after, summarized_messages=covered)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "saved_tokens": self._counters["tokens_before"] - self._counters["tokens_after"],
+            "tokenizer": "tiktoken" if tiktoken is not None else "heuristic",
+            "budget": self.budget,
+            "keep_last": self.keep_last,
+        }
+
+
+async def _summarize_with_llm(previous_summary: Optional[str], messages: List[Message]) -> Optional[str]:
+    from app.ai_service import summarize_history_async
+
+    return await summarize_history_async(previous_summary, messages)
+
+
+history_compactor = HistoryCompactor(
+    budget=settings.HISTORY_TOKEN_BUDGET,
+    keep_last=settings.HISTORY_KEEP_LAST_MESSAGES,
+    summarize=_summarize_with_llm,
+)
@@ -0,0 +1,52 @@
+"""
+История диалога попытки в таблице conversation_messages
+
+Каждый ход - одна вставка строки (progress_id, seq), без перезаписи всей истории.
+seq берётся из последовательности БД (conversation_messages_seq): параллельные
+вставки в одну попытку не конфликтуют. Значения внутри попытки возрастают, но
+не подряд - seq используется только для упорядочивания.
+Вопрос AI для конкретного задания ищется точечным запросом по (progress_id, task_order).
+"""
+from typing import Dict, List, Optional
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import ConversationMessage
+
+
+async def append_message(
+    db: AsyncSession,
+    progress_id: int,
+    role: str,
+    content: str,
+    task_order: Optional[int] = None
+) -> None:
+    """Добавляет сообщение в конец истории одним INSERT (seq - из последовательности БД)"""
+    await db.execute(
+        insert(ConversationMessage).values(
+            progress_id=progress_id,
+            role=role,
+            content=content,
+            task_order=task_order
+        )
+    )
+
+
+async def get_task_question(db: AsyncSession, progress_id: int, task_order: int) -> Optional[str]:
+    """Вопрос AI, уже сгенерированный для задания task_order в этой попытке"""
+    return (await db.execute(
+        select(ConversationMessage.content).where(
+            ConversationMessage.progress_id == progress_id,
+            ConversationMessage.role == "assistant",
+            ConversationMessage.task_order == task_order
+        ).order_by(ConversationMessage.seq.desc()).limit(1)
+    )).scalar()
+
+
+async def load_history(db: AsyncSession, progress_id: int) -> List[Dict[str, str]]:
+    """История попытки в формате messages OpenAI"""
+    rows = (await db.execute(
+        select(ConversationMessage.role, ConversationMessage.content).where(
+            ConversationMessage.progress_id == progress_id
+        ).order_by(ConversationMessage.seq)
+    )).all()
+    return [{"role": row.role, "content": row.content} for row in rows]
@@ -1,14 +1,50 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
-engine = create_engine(settings.DATABASE_URL)
+
+def _async_database_url(url: str) -> str:
+    """postgresql://... → postgresql+asyncpg://... (драйвер для AsyncEngine)"""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+_pool_options = dict(
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    pool_recycle=settings.DB_POOL_RECYCLE_SECONDS,
+)
+
+# Асинхронный движок (asyncpg) - используется всеми роутерами
+async_engine = create_async_engine(
+    _async_database_url(settings.DATABASE_URL),
+    connect_args={"statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+    **_pool_options,
+)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+# Синхронный движок - для скриптов и миграций вне event loop
+engine = create_engine(settings.DATABASE_URL, **_pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 def get_db():
     db = SessionLocal()
     try:
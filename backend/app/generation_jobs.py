@@ -0,0 +1,162 @@
+"""
+Задачи генерации LLM, отвязанные от HTTP-запросов
+
+Каждая генерация (вопрос задания или финальный отчёт) - задача с ключом
+идемпотентности (progress_id, порядковый номер генерируемого шага). Каждая
+задача выполняется своей asyncio-задачей, без общего пула: генерация почти
+всё время ждёт токены, а число одновременных запросов к LLM ограничивает
+адаптивный лимит бэкенда (app/llm_guard.py). Соединение с БД задача держит
+только на время своих запросов, не на время стрима. Кадры публикуются в
+брокер (app/stream_buffer.py), на который подписываются SSE-ответы.
+
+Повторный запрос с тем же ключом, пока задача выполняется
+(двойной клик, вторая вкладка, get_current_task во время submit),
+подключается к уже идущей генерации вместо запуска второй. Завершённая
+задача остаётся доступной по ключу ещё GENERATION_FINISHED_GRACE_SECONDS:
+клиент, переподключившийся сразу после последнего кадра, получает
+сохранённые в брокере кадры, а не новую (платную) генерацию. Упавшие
+задачи сразу освобождают ключ - повтор запроса запустит генерацию заново.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, Optional, Set, Tuple
+
+from app.config import settings
+from app.sse import sse_frame
+from app.stream_buffer import LocalBroker, create_broker
+
+logger = logging.getLogger(__name__)
+
+JobKey = Tuple[int, int]  # (progress_id, порядковый номер генерируемого шага)
+
+
+@dataclass
+class GenerationJob:
+    key: JobKey
+    owner_id: int
+    produce: Callable[[str], AsyncIterator[str]]
+    stream_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    state: str = "running"  # running, done, failed
+    created_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+
+class GenerationJobQueue:
+    def __init__(self, broker: LocalBroker, finished_grace_seconds: float):
+        self.broker = broker
+        # Дольше буфера брокера держать нельзя: кадров для повтора уже не будет
+        self.finished_grace_seconds = min(finished_grace_seconds, broker.ttl_seconds)
+        self._tasks: Set[asyncio.Task] = set()
+        self._by_key: Dict[JobKey, GenerationJob] = {}
+        self._counters = {
+            "submitted": 0,
+            "attached": 0,
+            "replayed": 0,
+            "completed": 0,
+            "completed_detached": 0,
+            "failed": 0,
+            "resumed": 0,
+        }
+
+    def _evict_finished(self) -> None:
+        now = time.monotonic()
+        for key, job in list(self._by_key.items()):
+            if job.finished_at is not None and now - job.finished_at > self.finished_grace_seconds:
+                del self._by_key[key]
+
+    def find(self, key: JobKey, owner_id: int) -> Optional[GenerationJob]:
+        """Идущая или недавно завершённая задача пользователя с этим ключом"""
+        self._evict_finished()
+        job = self._by_key.get(key)
+        if job is None or job.owner_id != owner_id or self.broker.get(job.stream_id) is None:
+            return None
+        self._counters["attached" if job.finished_at is None else "replayed"] += 1
+        return job
+
+    def submit(self, key: JobKey, owner_id: int, produce: Callable[[str], AsyncIterator[str]]) -> GenerationJob:
+        """
+        Запускает генерацию или возвращает задачу с тем же ключом (см. find)
+
+        produce(stream_id) - генератор кадров; stream_id передаётся клиенту в metadata
+        """
+        job = self.find(key, owner_id)
+        if job is not None:
+            return job
+
+        job = GenerationJob(key=key, owner_id=owner_id, produce=produce)
+        self.broker.open(job.stream_id, owner_id)
+        self._by_key[key] = job
+        self._counters["submitted"] += 1
+        task = asyncio.create_task(self._execute(job))
+        # Держим ссылку, чтобы задачу не собрал GC до завершения
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def subscribe(self, job: GenerationJob) -> AsyncIterator[str]:
+        frames = await self.broker.subscribe(job.stream_id, job.owner_id)
+        if frames is None:
+            return
+        async for frame in frames:
+            yield frame
+
+    async def resume(self, stream_id: str, owner_id: int, last_event_id: int) -> Optional[AsyncIterator[str]]:
+        """Итератор недостающих кадров или None, если стрим неизвестен или чужой"""
+        frames = await self.broker.subscribe(stream_id, owner_id, last_event_id)
+        if frames is not None:
+            self._counters["resumed"] += 1
+        return frames
+
+    async def _execute(self, job: GenerationJob) -> None:
+        try:
+            await self._run(job)
+        finally:
+            if self._by_key.get(job.key) is job:
+                if job.state == "done" and self.finished_grace_seconds > 0:
+                    job.finished_at = time.monotonic()
+                else:
+                    del self._by_key[job.key]
+
+    async def _run(self, job: GenerationJob) -> None:
+        try:
+            async for frame in job.produce(job.stream_id):
+                await self.broker.publish(job.stream_id, frame)
+            job.state = "done"
+            self._counters["completed"] += 1
+        except asyncio.CancelledError:
+            job.state = "failed"
+            raise
+        except Exception as e:
+            job.state = "failed"
+            self._counters["failed"] += 1
+            logger.error(f"[STREAMING] Generation job {job.key} failed: {e}", exc_info=True)
+            await self.broker.publish(job.stream_id, sse_frame({"type": "error", "data": {"message": str(e)}}))
+        finally:
+            await self.broker.finish(job.stream_id)
+            stream = self.broker.get(job.stream_id)
+            if job.state == "done" and stream is not None and stream.subscribers == 0:
+                # Клиент ушёл, но генерация доведена до конца и сохранена
+                self._counters["completed_detached"] += 1
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            **self.broker.stats(),
+            "running": len(self._tasks),
+            "finished_kept": sum(1 for job in self._by_key.values() if job.finished_at is not None),
+        }
+
+
+generation_jobs = GenerationJobQueue(
+    broker=create_broker(),
+    finished_grace_seconds=settings.GENERATION_FINISHED_GRACE_SECONDS,
+)
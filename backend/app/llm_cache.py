@@ -0,0 +1,141 @@
+"""
+Content-addressed кеш ответов LLM
+
+Ключ - sha256 от (model, messages, temperature), где model - модель бэкенда,
+который действительно ответил (роутер мог уйти на другой бэкенд по breaker'у
+или hedging), поэтому ответы разных моделей не смешиваются в одном пуле. При
+поиске проверяются ключи моделей всех бэкендов в порядке роутера (get_any).
+На каждый ключ хранится пул
+до LLM_CACHE_VARIANTS вариантов ответа: пока пул не заполнен, запрос идёт в
+OpenAI и результат добавляется в пул; после заполнения отдаётся случайный
+вариант, чтобы пользователи не видели одинаковый текст.
+
+Записи помечаются тегами (scenario:<id>, task:<id>) для инвалидации из админки.
+Так как ключ зависит от содержимого промпта, изменённый сценарий в любом
+случае получит новый ключ - инвалидация лишь освобождает память.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+
+from app.config import settings
+
+
+@dataclass
+class CacheEntry:
+    variants: List[str] = field(default_factory=list)
+    tags: Set[str] = field(default_factory=set)
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class ResponseCache:
+    """LRU-кеш с TTL и пулом вариантов на ключ"""
+
+    def __init__(self, max_keys: int, variants: int, ttl_seconds: int):
+        self.max_keys = max_keys
+        self.variants = max(1, variants)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._tag_index: Dict[str, Set[str]] = {}
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], temperature: float) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature},
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Случайный вариант, если пул заполнен; иначе None (нужно сгенерировать ещё один)"""
+        return self.get_any((key,))
+
+    def get_any(self, keys: Iterable[str]) -> Optional[str]:
+        """Случайный вариант из первого заполненного пула среди keys (одно обращение в статистике)"""
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry.created_at > self.ttl_seconds:
+                self._drop(key)
+                entry = None
+
+            if entry and len(entry.variants) >= self.variants:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return random.choice(entry.variants)
+
+        self._counters["misses"] += 1
+        return None
+
+    def put(self, key: str, text: str, tags: Iterable[str] = ()) -> None:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            self._entries[key] = entry
+        if len(entry.variants) < self.variants:
+            entry.variants.append(text)
+            self._counters["stores"] += 1
+        for tag in tags:
+            entry.tags.add(tag)
+            self._tag_index.setdefault(tag, set()).add(key)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_keys:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self._counters["evictions"] += 1
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Удаляет все записи с тегом. Возвращает число удалённых ключей"""
+        keys = self._tag_index.pop(tag, set())
+        for key in keys:
+            self._drop(key)
+        self._counters["invalidations"] += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tag_index.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self._counters["hits"] + self._counters["misses"]
+        return {
+            **self._counters,
+            "keys": len(self._entries),
+            "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for tag in entry.tags:
+            keys = self._tag_index.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+
+
+async def replay_tokens(text: str) -> AsyncIterator[str]:
+    """Отдаёт закешированный текст кусками, имитируя стриминг с настраиваемой скоростью"""
+    chunk_size = max(1, settings.LLM_CACHE_REPLAY_CHUNK_CHARS)
+    delay = settings.LLM_CACHE_REPLAY_DELAY_MS / 1000
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+response_cache = ResponseCache(
+    max_keys=settings.LLM_CACHE_MAX_KEYS,
+    variants=settings.LLM_CACHE_VARIANTS,
+    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS,
+)
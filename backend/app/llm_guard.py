@@ -0,0 +1,302 @@
+"""
+Защита вызовов LLM-бэкенда: адаптивный лимит параллельных запросов и circuit breaker
+
+AdaptiveLimiter - AIMD-лимит запросов "в полёте": успешный ответ с временем до
+первого токена не выше LLM_LIMIT_LATENCY_TARGET_MS увеличивает лимит на 1/limit
+(около +1 за "окно" запросов), 429 или медленный первый токен умножают его на
+LLM_LIMIT_BACKOFF (не чаще раза в секунду). Retry-After из ответа провайдера
+приостанавливает выдачу слотов до указанного момента. Запрос, не получивший
+слот за LLM_ACQUIRE_TIMEOUT_SECONDS, завершается LimiterTimeout.
+
+CircuitBreaker - после LLM_BREAKER_FAILURE_THRESHOLD ошибок провайдера подряд
+бэкенд открывается на LLM_BREAKER_OPEN_SECONDS: запросы к нему не отправляются
+(роутер берёт другой бэкенд или сразу отдаёт ошибку, и ai_service отвечает
+заглушкой). Затем breaker переходит в half-open и пропускает
+LLM_BREAKER_HALF_OPEN_PROBES пробных запросов: успех закрывает его, ошибка -
+снова открывает.
+
+Ошибками провайдера считаются 408/409/429/5xx и сетевые ошибки; прочие 4xx
+(например, 400 на слишком длинный промпт) означают, что бэкенд жив.
+"""
+import asyncio
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Deque, Dict, Optional
+
+import httpx
+from openai import APIConnectionError
+
+from app.config import settings
+
+RETRYABLE_STATUSES = {408, 409, 429}
+# Не уменьшать лимит чаще: иначе пачка одновременных 429 обрушит его до минимума
+DECREASE_COOLDOWN_SECONDS = 1.0
+
+
+class CircuitOpenError(Exception):
+    """Все подходящие бэкенды недоступны (circuit breaker открыт)"""
+
+
+class LimiterTimeout(Exception):
+    """Слот лимитера не освободился за LLM_ACQUIRE_TIMEOUT_SECONDS"""
+
+
+def is_upstream_error(exc: BaseException) -> bool:
+    """Ошибка на стороне провайдера (перегрузка, 5xx, сеть) - повод для повтора и для breaker"""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return isinstance(exc, (APIConnectionError, httpx.TransportError, asyncio.TimeoutError))
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Задержка из заголовков retry-after-ms / retry-after ответа провайдера"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        backoff: float,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._counters = {
+            "acquired": 0,
+            "timeouts": 0,
+            "increases": 0,
+            "decreases": 0,
+            "retry_after_pauses": 0,
+        }
+
+    def _pause_remaining(self) -> float:
+        return max(self._paused_until - time.monotonic(), 0.0)
+
+    def _can_admit(self) -> bool:
+        return self.in_flight < int(self.limit) and self._pause_remaining() == 0.0
+
+    def _wake(self) -> None:
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self, timeout: float) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self._can_admit():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._counters["timeouts"] += 1
+                raise LimiterTimeout(f"No LLM slot within {timeout:.0f}s (limit {int(self.limit)})")
+            pause = self._pause_remaining()
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                # Во время паузы по Retry-After слоты никто не освобождает - проверяем по её окончании
+                await asyncio.wait_for(waiter, min(remaining, pause) if pause else remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        self._counters["acquired"] += 1
+
+    def release(self) -> None:
+        self.in_flight = max(self.in_flight - 1, 0)
+        self._wake()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit * self.backoff, float(self.min_limit))
+        self._counters["decreases"] += 1
+
+    def on_success(self, latency: Optional[float]) -> None:
+        """latency - время до первого токена (None для нестриминговых запросов)"""
+        if latency is not None and latency > self.latency_target:
+            self._decrease()
+            return
+        if self.limit < self.max_limit:
+            self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+            self._counters["increases"] += 1
+            self._wake()
+
+    def on_overload(self, retry_after: Optional[float]) -> None:
+        self._decrease()
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._counters["retry_after_pauses"] += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "paused_ms": round(self._pause_remaining() * 1000),
+        }
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, open_seconds: float, half_open_probes: int):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._consecutive_failures = 0
+        self._probes_in_flight = 0
+        self._last_probe_at = 0.0
+        self._counters = {"opened": 0, "rejected": 0, "probes": 0}
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в half-open - занимает слот пробного запроса)"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes_in_flight >= self.half_open_probes:
+            # Пробный запрос без результата (потерянный слот) не должен держать half-open вечно
+            if time.monotonic() - self._last_probe_at >= self.open_seconds:
+                self._probes_in_flight = 0
+        if state == self.HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+            self._probes_in_flight += 1
+            self._last_probe_at = time.monotonic()
+            self._counters["probes"] += 1
+            return True
+        self._counters["rejected"] += 1
+        return False
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+        self._counters["opened"] += 1
+
+    def on_success(self) -> None:
+        self._consecutive_failures = 0
+        if self._state != self.CLOSED:
+            self._state = self.CLOSED
+            self._probes_in_flight = 0
+
+    def on_failure(self) -> None:
+        self._consecutive_failures += 1
+        if self._state == self.HALF_OPEN or (
+            self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold
+        ):
+            self._open()
+
+    def abandon(self) -> None:
+        """Запрос отменён до результата: освобождает слот пробного запроса"""
+        if self._state == self.HALF_OPEN and self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+
+    def stats(self) -> Dict[str, object]:
+        state = self.state
+        retry_in = self.open_seconds - (time.monotonic() - self._opened_at) if state == self.OPEN else 0.0
+        return {
+            **self._counters,
+            "state": state,
+            "consecutive_failures": self._consecutive_failures,
+            "retry_in_seconds": round(max(retry_in, 0.0), 1),
+        }
+
+
+class UpstreamGuard:
+    """Лимитер и breaker одного бэкенда"""
+
+    def __init__(self, limiter: AdaptiveLimiter, breaker: CircuitBreaker):
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @classmethod
+    def from_settings(cls) -> "UpstreamGuard":
+        return cls(
+            AdaptiveLimiter(
+                initial=settings.LLM_LIMIT_INITIAL,
+                min_limit=settings.LLM_LIMIT_MIN,
+                max_limit=settings.LLM_LIMIT_MAX,
+                latency_target=settings.LLM_LIMIT_LATENCY_TARGET_MS / 1000,
+                backoff=settings.LLM_LIMIT_BACKOFF,
+            ),
+            CircuitBreaker(
+                failure_threshold=settings.LLM_BREAKER_FAILURE_THRESHOLD,
+                open_seconds=settings.LLM_BREAKER_OPEN_SECONDS,
+                half_open_probes=settings.LLM_BREAKER_HALF_OPEN_PROBES,
+            ),
+        )
+
+    def admit(self) -> bool:
+        return self.breaker.allow()
+
+    async def acquire(self) -> None:
+        """Слот лимитера для допущенного admit() запроса"""
+        try:
+            await self.limiter.acquire(settings.LLM_ACQUIRE_TIMEOUT_SECONDS)
+        except BaseException:
+            self.breaker.abandon()
+            raise
+
+    def release(self) -> None:
+        self.limiter.release()
+
+    def record_success(self, latency: Optional[float] = None) -> None:
+        self.breaker.on_success()
+        self.limiter.on_success(latency)
+
+    def record_failure(self, exc: BaseException) -> None:
+        if not is_upstream_error(exc):
+            # Бэкенд ответил (например, 400) - для breaker это не сбой
+            self.breaker.on_success()
+            return
+        self.breaker.on_failure()
+        if getattr(exc, "status_code", None) == 429:
+            self.limiter.on_overload(retry_after_seconds(exc))
+
+    def abandon(self) -> None:
+        self.breaker.abandon()
+
+    def stats(self) -> Dict[str, object]:
+        return {"limiter": self.limiter.stats(), "circuit": self.breaker.stats()}
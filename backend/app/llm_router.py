@@ -0,0 +1,385 @@
+"""
+Маршрутизация запросов к нескольким LLM-бэкендам
+
+Бэкенды задаются в LLM_BACKENDS (JSON-список OpenAI-совместимых эндпоинтов,
+например основной OpenAI и локальный сервер для тестов):
+
+    [{"name": "openai"},
+     {"name": "local", "base_url": "http://localhost:8000/v1", "api_key": "x", "model": "qwen2.5-7b"}]
+
+Если список пуст, используется единственный бэкенд из OPENAI_API_KEY/OPENAI_MODEL.
+
+Для каждого бэкенда считается EWMA времени до первого токена (TTFT) и p95
+по последним замерам; запрос идёт в бэкенд с наименьшим EWMA. Для стриминга
+вопросов включается hedging: если первый токен не пришёл за p95 основного
+бэкенда, параллельно отправляется запрос во второй, и используется тот
+стрим, что начнёт отдавать токены первым; второй отменяется.
+
+Параметры, которые понимает не каждый OpenAI-совместимый сервер, включаются
+на бэкенд: prompt_cache_key (по умолчанию только для OpenAI) и include_usage -
+stream_options={"include_usage": true}; если бэкенд отвечает на него 400, а
+без него запрос проходит, параметр для бэкенда отключается.
+
+Каждый бэкенд защищён UpstreamGuard (app/llm_guard.py): адаптивным лимитом
+параллельных запросов и circuit breaker'ом; бэкенды с открытым breaker'ом
+пропускаются. Ошибки провайдера повторяются с jitter (или по Retry-After)
+только до первого токена - начатый стрим не перезапускается.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+import httpx
+from openai import AsyncOpenAI, BadRequestError
+
+from app.config import settings
+from app.llm_guard import CircuitOpenError, UpstreamGuard, is_upstream_error, retry_after_seconds
+from app.prompt_cache import request_options
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Ошибка бэкенда учитывается в EWMA как очень медленный ответ
+ERROR_PENALTY_SECONDS = 30.0
+# Минимум замеров, после которого задержка hedging берётся из p95
+MIN_SAMPLES_FOR_P95 = 20
+
+
+@dataclass
+class LLMBackend:
+    name: str
+    model: str
+    client: AsyncOpenAI
+    prompt_cache_key: bool = True
+    include_usage: bool = True
+    ttft_ewma: Optional[float] = None
+    requests: int = 0
+    errors: int = 0
+    guard: UpstreamGuard = field(default_factory=UpstreamGuard.from_settings)
+    _samples: Deque[float] = field(default_factory=lambda: deque(maxlen=200))
+
+    def _update_ewma(self, value: float) -> None:
+        alpha = settings.LLM_EWMA_ALPHA
+        self.ttft_ewma = value if self.ttft_ewma is None else (1 - alpha) * self.ttft_ewma + alpha * value
+
+    def observe_ttft(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._update_ewma(seconds)
+
+    def observe_error(self) -> None:
+        self.errors += 1
+        self._update_ewma(ERROR_PENALTY_SECONDS)
+
+    def p95(self) -> Optional[float]:
+        if len(self._samples) < MIN_SAMPLES_FOR_P95:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        if p95 is None:
+            return settings.LLM_HEDGE_DELAY_MS / 1000
+        return max(p95, settings.LLM_HEDGE_MIN_DELAY_MS / 1000)
+
+    def options(self, system_prompt: str) -> Dict[str, Any]:
+        return request_options(system_prompt) if self.prompt_cache_key else {}
+
+    def stream_options(self) -> Dict[str, Any]:
+        # Последний чанк приносит usage - из него берётся число кешированных токенов
+        return {"stream_options": {"include_usage": True}} if self.include_usage else {}
+
+    def stats(self) -> Dict[str, object]:
+        p95 = self.p95()
+        return {
+            "model": self.model,
+            "requests": self.requests,
+            "errors": self.errors,
+            "include_usage": self.include_usage,
+            "ttft_ewma_ms": round(self.ttft_ewma * 1000, 1) if self.ttft_ewma is not None else None,
+            "ttft_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            **self.guard.stats(),
+        }
+
+
+@dataclass
+class _OpenedStream:
+    backend: LLMBackend
+    stream: Any
+    iterator: Any
+    buffered: List[Any]
+
+
+def _has_content(chunk) -> bool:
+    try:
+        return bool(chunk.choices[0].delta.content)
+    except Exception:
+        return False
+
+
+class ModelRouter:
+    def __init__(self, backends: List[LLMBackend]):
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = backends
+        self._counters = {"hedges": 0, "hedge_wins": 0, "retries": 0}
+
+    @classmethod
+    def from_settings(cls, default_client: AsyncOpenAI, http_client: httpx.AsyncClient) -> "ModelRouter":
+        configured = json.loads(settings.LLM_BACKENDS) if settings.LLM_BACKENDS else []
+        backends = []
+        for item in configured:
+            base_url = item.get("base_url")
+            client = default_client if not base_url and not item.get("api_key") else AsyncOpenAI(
+                api_key=item.get("api_key") or settings.OPENAI_API_KEY,
+                base_url=base_url,
+                http_client=http_client,
+                # Повторы делает роутер (до первого токена, с учётом breaker)
+                max_retries=0,
+            )
+            backends.append(LLMBackend(
+                name=item["name"],
+                model=item.get("model") or settings.OPENAI_MODEL,
+                client=client,
+                # Параметр prompt_cache_key понимает только OpenAI
+                prompt_cache_key=item.get("prompt_cache_key", not base_url),
+                include_usage=item.get("include_usage", True),
+            ))
+        if not backends:
+            backends.append(LLMBackend(name="openai", model=settings.OPENAI_MODEL, client=default_client))
+        return cls(backends)
+
+    def ranked(self) -> List[LLMBackend]:
+        """Бэкенды по возрастанию EWMA TTFT (без замеров - в начале, чтобы их опробовать)"""
+        return sorted(self.backends, key=lambda b: b.ttft_ewma if b.ttft_ewma is not None else 0.0)
+
+    def models(self) -> List[str]:
+        """Модели бэкендов в порядке ranked() без повторов (ключи кеша ответов)"""
+        return list(dict.fromkeys(backend.model for backend in self.ranked()))
+
+    def _admit(self, exclude: Optional[LLMBackend] = None) -> LLMBackend:
+        """Самый быстрый бэкенд, чей breaker пропускает запрос"""
+        for backend in self.ranked():
+            if backend is not exclude and backend.guard.admit():
+                return backend
+        raise CircuitOpenError("All LLM backends are unavailable (circuit open)")
+
+    async def _with_retries(self, attempt: Callable[[], Awaitable[T]]) -> T:
+        """Повторяет попытку при ошибках провайдера: full jitter или Retry-After"""
+        attempts = max(settings.LLM_RETRY_ATTEMPTS, 1)
+        max_delay = settings.LLM_RETRY_MAX_DELAY_MS / 1000
+        for number in range(1, attempts + 1):
+            try:
+                return await attempt()
+            except Exception as e:
+                if number >= attempts or not is_upstream_error(e):
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(max_delay, settings.LLM_RETRY_BASE_DELAY_MS / 1000 * 2 ** (number - 1)))
+                elif delay > max_delay:
+                    raise
+                self._counters["retries"] += 1
+                logger.warning("LLM request failed (%s), retry %d/%d in %.2fs", e, number, attempts - 1, delay)
+                await asyncio.sleep(delay)
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float],
+        max_completion_tokens: int,
+    ):
+        """Нестриминговый запрос в лучший по задержке доступный бэкенд"""
+        params: Dict[str, Any] = {"max_completion_tokens": max_completion_tokens}
+        if temperature is not None:
+            params["temperature"] = temperature
+
+        async def attempt():
+            backend = self._admit()
+            await backend.guard.acquire()
+            backend.requests += 1
+            try:
+                response = await backend.client.chat.completions.create(
+                    model=backend.model,
+                    messages=messages,
+                    **params,
+                    **backend.options(messages[0]["content"] if messages else ""),
+                )
+            except asyncio.CancelledError:
+                backend.guard.abandon()
+                raise
+            except Exception as e:
+                backend.guard.record_failure(e)
+                if is_upstream_error(e):
+                    backend.observe_error()
+                raise
+            finally:
+                backend.guard.release()
+            backend.guard.record_success()
+            return response
+
+        return await self._with_retries(attempt)
+
+    async def _open_stream(
+        self,
+        backend: LLMBackend,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_completion_tokens: int,
+    ) -> _OpenedStream:
+        """Открывает стрим в допущенный breaker'ом бэкенд и читает его до первого токена"""
+        await backend.guard.acquire()
+        backend.requests += 1
+        started = time.monotonic()
+        stream = None
+        try:
+            request = dict(
+                model=backend.model,
+                messages=messages,
+                temperature=temperature,
+                max_completion_tokens=max_completion_tokens,
+                stream=True,
+                **backend.options(messages[0]["content"] if messages else ""),
+            )
+            try:
+                stream = await backend.client.chat.completions.create(**request, **backend.stream_options())
+            except BadRequestError:
+                if not backend.include_usage:
+                    raise
+                stream = await backend.client.chat.completions.create(**request)
+                # Без stream_options запрос прошёл - бэкенд их не понимает, больше не отправляем
+                backend.include_usage = False
+                logger.warning("LLM backend %s rejects stream_options, include_usage disabled", backend.name)
+            iterator = stream.__aiter__()
+            buffered = []
+            while True:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                buffered.append(chunk)
+                if _has_content(chunk):
+                    break
+            ttft = time.monotonic() - started
+            backend.observe_ttft(ttft)
+            backend.guard.record_success(ttft)
+            return _OpenedStream(backend, stream, iterator, buffered)
+        except asyncio.CancelledError:
+            # Проигравший в hedging запрос: первый токен не пришёл как минимум за это время,
+            # иначе медленный бэкенд так и останется первым в рейтинге. Соединение закрываем.
+            backend._update_ewma(time.monotonic() - started)
+            backend.guard.abandon()
+            backend.guard.release()
+            if stream is not None:
+                await stream.close()
+            raise
+        except Exception as e:
+            backend.guard.record_failure(e)
+            backend.guard.release()
+            if is_upstream_error(e):
+                backend.observe_error()
+            if stream is not None:
+                await stream.close()
+            raise
+
+    async def _discard(self, opened: _OpenedStream) -> None:
+        try:
+            await opened.stream.close()
+        finally:
+            opened.backend.guard.release()
+
+    async def _open_first(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_completion_tokens: int,
+        hedge: bool,
+    ) -> _OpenedStream:
+        """Стрим, первым отдавший токен (с hedging - из двух бэкендов)"""
+        primary = self._admit()
+        pending = {asyncio.create_task(self._open_stream(primary, messages, temperature, max_completion_tokens))}
+        secondary: Optional[LLMBackend] = None
+        opened: Optional[_OpenedStream] = None
+        errors: List[BaseException] = []
+        try:
+            if hedge and settings.LLM_HEDGE_ENABLED and len(self.backends) > 1:
+                done, _ = await asyncio.wait(pending, timeout=primary.hedge_delay())
+                if not done:
+                    try:
+                        secondary = self._admit(exclude=primary)
+                    except CircuitOpenError:
+                        secondary = None
+                if secondary is not None:
+                    self._counters["hedges"] += 1
+                    logger.info("Hedging LLM stream: %s is slow, also asking %s", primary.name, secondary.name)
+                    pending.add(asyncio.create_task(
+                        self._open_stream(secondary, messages, temperature, max_completion_tokens)
+                    ))
+
+            while pending and opened is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif opened is None:
+                        opened = task.result()
+                    else:
+                        await self._discard(task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if opened is None:
+            raise errors[0]
+        if secondary is not None and opened.backend is secondary:
+            self._counters["hedge_wins"] += 1
+        return opened
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_completion_tokens: int,
+        hedge: bool = False,
+        on_model: Optional[Callable[[str], None]] = None,
+    ) -> AsyncIterator[Any]:
+        """
+        Чанки стрима; при hedge=True медленный первый токен дублируется запросом во второй бэкенд
+
+        on_model вызывается с моделью бэкенда, который будет отдавать стрим
+        (до первого чанка) - после fallback или hedging это не обязательно
+        основной бэкенд.
+        """
+        opened = await self._with_retries(
+            lambda: self._open_first(messages, temperature, max_completion_tokens, hedge)
+        )
+        if on_model is not None:
+            on_model(opened.backend.model)
+        try:
+            for chunk in opened.buffered:
+                yield chunk
+            while True:
+                try:
+                    chunk = await opened.iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except Exception as e:
+            # Обрыв после первого токена не повторяется, но учитывается breaker'ом
+            opened.backend.guard.record_failure(e)
+            raise
+        finally:
+            await self._discard(opened)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "hedge_enabled": settings.LLM_HEDGE_ENABLED,
+            "backends": {b.name: b.stats() for b in self.backends},
+        }
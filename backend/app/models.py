@@ -1,7 +1,10 @@
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Numeric, JSON
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
+from sqlalchemy.dialects.postgresql import JSONB
+from pgvector.sqlalchemy import Vector
 from app.database import Base
+from app.config import settings
 
 
 class User(Base):
@@ -82,6 +85,7 @@ class UserTask(Base):
     attempt_number = Column(Integer, default=1, nullable=False)
     question = Column(Text)  # Вопрос, сгенерированный AI
     answer = Column(Text)  # Ответ пользователя
+    evaluation = Column(Text)  # Краткая оценка ответа (для инкрементального отчёта)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True))
     
@@ -100,7 +104,7 @@ class UserProgress(Base):
     attempt_number = Column(Integer, default=1, nullable=False)
     status = Column(String, default="not_started")  # not_started, in_progress, completed
     current_task_order = Column(Integer, default=0)
-    conversation_history = Column(JSON)  # История диалога с AI
+    conversation_history = Column(JSON)  # Устарело: история перенесена в conversation_messages
     final_report = Column(Text)
     started_at = Column(DateTime(timezone=True))
     completed_at = Column(DateTime(timezone=True))
@@ -109,6 +113,22 @@ class UserProgress(Base):
     user = relationship("User", back_populates="user_progress")
     profession = relationship("Profession", back_populates="user_progress")
     tasks = relationship("UserTask", back_populates="progress", foreign_keys="UserTask.progress_id")
+    messages = relationship("ConversationMessage", back_populates="progress", order_by="ConversationMessage.seq")
+
+
+class ConversationMessage(Base):
+    """Сообщение диалога с AI в рамках попытки (append-only)"""
+    __tablename__ = "conversation_messages"
+    
+    progress_id = Column(Integer, ForeignKey("user_progress.id", ondelete="CASCADE"), primary_key=True)
+    seq = Column(Integer, primary_key=True, server_default=text("nextval('conversation_messages_seq')"))  # порядок, не номер
+    role = Column(String, nullable=False)  # system, user, assistant
+    content = Column(Text, nullable=False)
+    task_order = Column(Integer)  # Для вопросов AI: номер задания, к которому относится вопрос
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Relationships
+    progress = relationship("UserProgress", back_populates="messages")
 
 
 class Payment(Base):
@@ -121,8 +141,10 @@ class Payment(Base):
     profession_id = Column(Integer, ForeignKey("professions.id"), nullable=True)
     promocode = Column(String)
     discount_amount = Column(Numeric(10, 2), default=0)
-    status = Column(String, default="pending")  # pending, completed, failed, refunded
+    promocode_reserved = Column(Boolean, default=False)  # использование промокода засчитано (см. app/payments/promocodes.py)
+    status = Column(String, default="pending")  # pending, completed, failed, expired, refunded
     yukassa_payment_id = Column(String)
+    idempotence_key = Column(String, unique=True)  # Idempotence-Key запроса создания платежа в ЮKassa
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True))
     
@@ -131,6 +153,23 @@ class Payment(Base):
     package = relationship("Package", back_populates="payments")
 
 
+class WebhookEvent(Base):
+    """Входящее уведомление платёжной системы (inbox, см. app/payments/webhook_inbox.py)"""
+    __tablename__ = "webhook_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    event_key = Column(String, unique=True, nullable=False)  # "<event>:<object.id>" - дедупликация повторных доставок
+    event_type = Column(String, nullable=False)  # payment.succeeded, payment.canceled, ...
+    object_id = Column(String, nullable=False)  # ID платежа в ЮKassa
+    payload = Column(JSON, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, processing, done, ignored, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_error = Column(Text)
+    received_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True))
+
+
 class Package(Base):
     __tablename__ = "packages"
     
@@ -167,4 +206,28 @@ class ReportTemplate(Base):
     profession_id = Column(Integer, ForeignKey("professions.id"), nullable=False)
     template_text = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class AnswerEmbedding(Base):
+    """Семантический кеш: эмбеддинг ответа пользователя → сгенерированный следующий вопрос"""
+    __tablename__ = "answer_embeddings"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(Integer, ForeignKey("tasks.id", ondelete="CASCADE"), nullable=False, index=True)
+    question = Column(Text)
+    answer = Column(Text, nullable=False)
+    follow_up = Column(Text, nullable=False)
+    embedding = Column(Vector(settings.SEMANTIC_CACHE_EMBEDDING_DIM), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Event(Base):
+    """Событие продуктовой аналитики (пишется пачками, см. app/analytics.py)"""
+    __tablename__ = "events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), index=True)
+    event_type = Column(String, nullable=False, index=True)  # login, task_started, answer_submitted, ...
+    event_metadata = Column(JSONB)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
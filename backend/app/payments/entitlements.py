@@ -0,0 +1,69 @@
+"""
+Выдача доступа к профессиям после оплаты
+
+Доступ к профессии - строка user_progress первой попытки. Все профессии
+платежа (пакета) выдаются одним INSERT ... ON CONFLICT DO NOTHING по
+уникальному индексу idx_user_profession_attempt (user_id, profession_id,
+attempt_number), а не SELECT + INSERT на каждую профессию. Поэтому повторная
+доставка webhook'а, ручное подтверждение и webhook одновременно не создают
+дублей и не падают на нарушении уникальности.
+
+Перевод платежа в completed - условный UPDATE (только из незавершённого
+статуса), так что completed_at фиксируется один раз. Если резервация
+промокода уже была освобождена (платёж просрочен, но всё же оплачен),
+использование засчитывается снова.
+"""
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.analytics import analytics
+from app.models import Package, Payment, UserProgress
+from app.payments.promocodes import promocode_guard
+
+
+async def payment_profession_ids(db: AsyncSession, payment: Payment) -> List[int]:
+    """Профессии, доступ к которым даёт платёж (пакет или одна профессия)"""
+    if payment.package_id:
+        package = await db.get(Package, payment.package_id)
+        return list(package.profession_ids or []) if package else []
+    if payment.profession_id:
+        return [payment.profession_id]
+    return []
+
+
+async def grant_professions(db: AsyncSession, user_id: int, profession_ids: List[int]) -> int:
+    """Выдаёт доступ одним запросом; возвращает число новых записей (без commit)"""
+    # Один порядок вставки во всех транзакциях - без взаимных блокировок при конкурентных webhook'ах
+    profession_ids = sorted(set(profession_ids))
+    if not profession_ids:
+        return 0
+    result = await db.execute(
+        insert(UserProgress).values([
+            {"user_id": user_id, "profession_id": profession_id, "attempt_number": 1, "status": "not_started"}
+            for profession_id in profession_ids
+        ]).on_conflict_do_nothing(
+            index_elements=["user_id", "profession_id", "attempt_number"]
+        )
+    )
+    return result.rowcount or 0
+
+
+async def complete_payment(db: AsyncSession, payment: Payment) -> int:
+    """Отмечает платёж оплаченным и выдаёт доступ (идемпотентно, без commit)"""
+    result = await db.execute(
+        update(Payment).where(
+            Payment.id == payment.id,
+            Payment.status != "completed"
+        ).values(status="completed", completed_at=datetime.utcnow())
+    )
+    if result.rowcount:
+        analytics.emit("payment_completed", payment.user_id, payment_id=payment.id, amount=float(payment.amount),
+                       package_id=payment.package_id, profession_id=payment.profession_id,
+                       promocode=payment.promocode)
+    if payment.promocode:
+        await promocode_guard.restore(db, payment.id)
+    return await grant_professions(db, payment.user_id, await payment_profession_ids(db, payment))
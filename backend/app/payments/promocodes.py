@@ -0,0 +1,203 @@
+"""
+Счётчики использования промокодов
+
+Резервация - один условный UPDATE ... RETURNING: счётчик увеличивается только
+если промокод активен, не истёк и лимит не исчерпан. Проверка и инкремент
+атомарны, поэтому параллельные оформления не проскакивают лимит, а блокировка
+строки держится только до commit транзакции создания платежа (без SELECT и
+инкремента в Python между ними).
+
+Резервация привязана к платежу (payments.promocode_reserved) и освобождается,
+если платёж отменён в ЮKassa (webhook payment.canceled) или так и не оплачен за
+PAYMENT_PENDING_TTL_MINUTES (фоновая очистка, статус expired). Флаг меняется
+условным UPDATE, поэтому повторное освобождение ничего не делает. Если
+просроченный платёж всё же оплачен, использование возвращается в счётчик при
+выдаче доступа (restore).
+
+Отказы (нет кода, лимит исчерпан, срок истёк) кешируются в процессе на
+PROMOCODE_REJECTION_CACHE_SECONDS: во время промо-акции повторные попытки с
+исчерпанным кодом отклоняются без обращения к БД. TTL короткий, потому что
+освобождённые резервации снова делают код доступным.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Payment, Promocode
+
+logger = logging.getLogger(__name__)
+
+REJECTIONS = {
+    "not_found": (404, "Promocode not found"),
+    "exhausted": (400, "Promocode usage limit exceeded"),
+    "expired": (400, "Promocode expired"),
+}
+
+
+def _rejection(reason: str) -> HTTPException:
+    status_code, detail = REJECTIONS[reason]
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+class PromocodeGuard:
+    def __init__(self, rejection_ttl: float, max_cached: int):
+        self.rejection_ttl = rejection_ttl
+        self.max_cached = max_cached
+        # code -> (причина отказа, monotonic-время окончания)
+        self._rejected: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._counters = {
+            "reserved": 0,
+            "rejected_cached": 0,
+            "rejected_db": 0,
+            "released": 0,
+            "restored": 0,
+            "expired_payments": 0,
+        }
+
+    def _cached_rejection(self, code: str) -> Optional[str]:
+        entry = self._rejected.get(code)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._rejected[code]
+            return None
+        return entry[0]
+
+    def _remember(self, code: str, reason: str) -> None:
+        if self.rejection_ttl <= 0:
+            return
+        self._rejected[code] = (reason, time.monotonic() + self.rejection_ttl)
+        self._rejected.move_to_end(code)
+        while len(self._rejected) > self.max_cached:
+            self._rejected.popitem(last=False)
+
+    def invalidate(self, code: str) -> None:
+        """Сбрасывает закешированный отказ (новый промокод, освобождённая резервация)"""
+        self._rejected.pop(code, None)
+
+    async def reserve(self, db: AsyncSession, code: str) -> Promocode:
+        """Резервирует одно использование (без commit) или выбрасывает HTTPException"""
+        reason = self._cached_rejection(code)
+        if reason is not None:
+            self._counters["rejected_cached"] += 1
+            raise _rejection(reason)
+
+        promocode = await db.scalar(
+            update(Promocode)
+            .where(
+                Promocode.code == code,
+                Promocode.is_active == True,
+                or_(Promocode.max_uses.is_(None), Promocode.current_uses < Promocode.max_uses),
+                or_(Promocode.valid_until.is_(None), Promocode.valid_until >= func.now()),
+            )
+            .values(current_uses=Promocode.current_uses + 1)
+            .returning(Promocode)
+            .execution_options(synchronize_session=False)
+        )
+        if promocode is None:
+            reason = await self._rejection_reason(db, code)
+            self._counters["rejected_db"] += 1
+            self._remember(code, reason)
+            raise _rejection(reason)
+
+        self._counters["reserved"] += 1
+        if promocode.max_uses and promocode.current_uses >= promocode.max_uses:
+            # Последнее использование: следующие попытки отклоняются без БД
+            self._remember(code, "exhausted")
+        return promocode
+
+    @staticmethod
+    async def _rejection_reason(db: AsyncSession, code: str) -> str:
+        row = (await db.execute(select(Promocode.id, Promocode.valid_until < func.now()).where(
+            Promocode.code == code,
+            Promocode.is_active == True
+        ).limit(1))).first()
+        if row is None:
+            return "not_found"
+        return "expired" if row[1] else "exhausted"
+
+    async def release(self, db: AsyncSession, payment_ids: Iterable[int]) -> int:
+        """Освобождает резервации платежей (идемпотентно, без commit); возвращает их число"""
+        payment_ids = list(payment_ids)
+        if not payment_ids:
+            return 0
+        codes = (await db.scalars(
+            update(Payment)
+            .where(Payment.id.in_(payment_ids), Payment.promocode_reserved == True)
+            .values(promocode_reserved=False)
+            .returning(Payment.promocode)
+        )).all()
+        for code, count in sorted(Counter(codes).items()):
+            await db.execute(
+                update(Promocode)
+                .where(Promocode.code == code)
+                .values(current_uses=func.greatest(Promocode.current_uses - count, 0))
+            )
+            self.invalidate(code)
+        self._counters["released"] += len(codes)
+        return len(codes)
+
+    async def restore(self, db: AsyncSession, payment_id: int) -> None:
+        """Платёж оплачен после освобождения резервации - использование засчитывается снова (без commit)"""
+        code = await db.scalar(
+            update(Payment)
+            .where(Payment.id == payment_id, Payment.promocode.isnot(None), Payment.promocode_reserved == False)
+            .values(promocode_reserved=True)
+            .returning(Payment.promocode)
+        )
+        if code is None:
+            return
+        # Без проверки лимита: оплата уже прошла
+        await db.execute(
+            update(Promocode).where(Promocode.code == code).values(current_uses=Promocode.current_uses + 1)
+        )
+        self._counters["restored"] += 1
+
+    async def expire_stale_payments(self) -> int:
+        """Переводит неоплаченные платежи старше PAYMENT_PENDING_TTL_MINUTES в expired и освобождает промокоды"""
+        async with AsyncSessionLocal() as db:
+            payment_ids = (await db.scalars(
+                update(Payment)
+                .where(
+                    Payment.status == "pending",
+                    Payment.created_at < func.now() - timedelta(minutes=settings.PAYMENT_PENDING_TTL_MINUTES),
+                )
+                .values(status="expired")
+                .returning(Payment.id)
+            )).all()
+            await self.release(db, payment_ids)
+            await db.commit()
+        self._counters["expired_payments"] += len(payment_ids)
+        return len(payment_ids)
+
+    async def run_expiry_loop(self) -> None:
+        """Фоновая очистка просроченных платежей"""
+        interval = settings.PAYMENT_EXPIRY_INTERVAL_SECONDS
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = await self.expire_stale_payments()
+                if expired:
+                    logger.info(f"Expired {expired} unpaid payments")
+            except Exception as e:
+                logger.warning(f"Payment expiry failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {**self._counters, "cached_rejections": len(self._rejected)}
+
+
+promocode_guard = PromocodeGuard(
+    rejection_ttl=settings.PROMOCODE_REJECTION_CACHE_SECONDS,
+    max_cached=settings.PROMOCODE_REJECTION_CACHE_SIZE,
+)
@@ -0,0 +1,278 @@
+"""
+Inbox входящих webhook'ов ЮKassa
+
+Endpoint /api/payments/webhook только проверяет источник и формат, сохраняет
+уведомление в webhook_events и сразу отвечает 200 - время ответа не зависит от
+выдачи доступа и от ЮKassa API. Если сохранить не удалось, endpoint отвечает
+500 и ЮKassa доставит уведомление повторно: ничего не теряется молча.
+
+Повторная доставка того же события (event + ID платежа) не создаёт вторую
+запись (ON CONFLICT DO NOTHING по event_key).
+
+Пул воркеров забирает готовые к обработке события пачками через
+UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED), поэтому несколько
+процессов backend'а не обрабатывают одно событие одновременно. Забранное
+событие получает аренду (next_attempt_at = now + WEBHOOK_LEASE_SECONDS): если
+процесс упал посреди обработки, событие вернётся в работу после её истечения.
+Ошибка обработки - повтор с экспоненциальной задержкой, после
+WEBHOOK_MAX_ATTEMPTS попыток - статус failed; такие события можно
+переобработать через POST /api/admin/webhooks/{id}/replay.
+
+Перед выдачей доступа (payment.succeeded) или отменой платежа с освобождением
+промокода (payment.canceled) статус платежа перепроверяется запросом к ЮKassa
+(рекомендация ЮKassa для уведомлений), поэтому поддельное уведомление ничего
+не меняет.
+"""
+import asyncio
+import ipaddress
+import logging
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Set, Union
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Payment, WebhookEvent
+from app.payments.entitlements import complete_payment
+from app.payments.promocodes import promocode_guard
+from app.payments.yukassa import yukassa_client
+
+logger = logging.getLogger(__name__)
+
+# Обрабатываемые события -> статус платежа в ЮKassa, которым они подтверждаются
+HANDLED_EVENTS = {
+    "payment.succeeded": "succeeded",
+    "payment.canceled": "canceled",
+}
+
+
+def _parse_networks(value: str) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
+
+_allowed_networks = _parse_networks(settings.YUKASSA_WEBHOOK_ALLOWED_IPS)
+
+
+def source_allowed(host: Optional[str]) -> bool:
+    """IP отправителя входит в YUKASSA_WEBHOOK_ALLOWED_IPS (пустой список - без проверки)"""
+    if not _allowed_networks:
+        return True
+    try:
+        address = ipaddress.ip_address(host or "")
+    except ValueError:
+        return False
+    return any(address in network for network in _allowed_networks)
+
+
+class WebhookInbox:
+    def __init__(self, workers: int, batch_size: int, poll_interval: float, max_attempts: int):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._processing: Set[int] = set()
+        self._counters = {
+            "received": 0,
+            "duplicates": 0,
+            "processed": 0,
+            "ignored": 0,
+            "retried": 0,
+            "failed": 0,
+            "replayed": 0,
+        }
+
+    async def record(self, db: AsyncSession, event_type: str, object_id: str, payload: Dict[str, Any]) -> bool:
+        """Сохраняет уведомление (с commit); False - повторная доставка уже известного события"""
+        result = await db.execute(
+            insert(WebhookEvent).values(
+                event_key=f"{event_type}:{object_id}",
+                event_type=event_type,
+                object_id=object_id,
+                payload=payload,
+            ).on_conflict_do_nothing(index_elements=["event_key"])
+        )
+        await db.commit()
+        if not result.rowcount:
+            self._counters["duplicates"] += 1
+            return False
+        self._counters["received"] += 1
+        self.notify()
+        return True
+
+    def notify(self) -> None:
+        """Будит воркеры этого процесса, не дожидаясь WEBHOOK_POLL_INTERVAL_SECONDS"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        # Пул создаётся внутри работающего event loop (при startup)
+        if self._worker_tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._wakeup = None
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            try:
+                events = await self._claim()
+            except Exception as e:
+                logger.error(f"[WEBHOOK] Worker {index} could not claim events: {e}")
+                events = []
+
+            for event in events:
+                await self._process(event)
+
+            if len(events) < self.batch_size:
+                # Очередь пуста: ждём нового уведомления или следующего опроса (повторы, другие процессы)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim(self) -> List[Any]:
+        due = (
+            select(WebhookEvent.id)
+            .where(
+                WebhookEvent.status.in_(("pending", "processing")),
+                WebhookEvent.next_attempt_at <= func.now(),
+            )
+            .order_by(WebhookEvent.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id.in_(due))
+                .values(
+                    status="processing",
+                    attempts=WebhookEvent.attempts + 1,
+                    next_attempt_at=func.now() + timedelta(seconds=settings.WEBHOOK_LEASE_SECONDS),
+                )
+                .returning(WebhookEvent.id, WebhookEvent.event_type, WebhookEvent.object_id, WebhookEvent.attempts)
+            )).all()
+            await db.commit()
+        return sorted(rows, key=lambda row: row.id)
+
+    async def _process(self, event) -> None:
+        self._processing.add(event.id)
+        try:
+            async with AsyncSessionLocal() as db:
+                try:
+                    status = await self._handle(db, event.event_type, event.object_id)
+                except Exception as e:
+                    await db.rollback()
+                    await self._schedule_retry(db, event, e)
+                    return
+                await db.execute(
+                    update(WebhookEvent)
+                    .where(WebhookEvent.id == event.id)
+                    .values(status=status, processed_at=func.now(), last_error=None)
+                )
+                await db.commit()
+                self._counters["processed" if status == "done" else "ignored"] += 1
+        except Exception as e:
+            # Не удалось даже записать результат - событие вернётся после истечения аренды
+            logger.error(f"[WEBHOOK] Event {event.id} ({event.event_type}) left for lease expiry: {e}")
+        finally:
+            self._processing.discard(event.id)
+
+    async def _schedule_retry(self, db: AsyncSession, event, error: Exception) -> None:
+        if event.attempts >= self.max_attempts:
+            values = {"status": "failed"}
+            self._counters["failed"] += 1
+            logger.error(f"[WEBHOOK] Event {event.id} ({event.event_type} {event.object_id}) failed: {error}")
+        else:
+            delay = min(
+                settings.WEBHOOK_RETRY_BASE_DELAY_SECONDS * 2 ** (event.attempts - 1),
+                settings.WEBHOOK_RETRY_MAX_DELAY_SECONDS,
+            )
+            values = {"status": "pending", "next_attempt_at": func.now() + timedelta(seconds=delay)}
+            self._counters["retried"] += 1
+            logger.warning(
+                f"[WEBHOOK] Event {event.id} ({event.event_type}) attempt {event.attempts} failed, "
+                f"retry in {delay:.0f}s: {error}"
+            )
+        await db.execute(
+            update(WebhookEvent)
+            .where(WebhookEvent.id == event.id)
+            .values(last_error=f"{type(error).__name__}: {error}"[:2000], **values)
+        )
+        await db.commit()
+
+    async def _handle(self, db: AsyncSession, event_type: str, object_id: str) -> str:
+        """Обрабатывает событие (с commit); возвращает итоговый статус: done или ignored"""
+        expected = HANDLED_EVENTS.get(event_type)
+        if expected is None:
+            return "ignored"
+
+        payment = await db.scalar(select(Payment).where(Payment.yukassa_payment_id == object_id).limit(1))
+        if payment is None:
+            # Уведомление может опередить сохранение yukassa_payment_id в create_payment - повторим позже
+            raise LookupError(f"payment {object_id} not found")
+        if payment.status == "completed":
+            return "done"
+
+        if settings.YUKASSA_WEBHOOK_VERIFY_STATUS:
+            yukassa_status = await yukassa_client.get_payment_status(object_id)
+            if yukassa_status.get("status") != expected:
+                logger.warning(
+                    f"[WEBHOOK] {event_type} for {object_id} ignored: "
+                    f"YuKassa status is {yukassa_status.get('status')}"
+                )
+                return "ignored"
+
+        if event_type == "payment.succeeded":
+            # Повторная обработка не создаёт дублей (ON CONFLICT DO NOTHING)
+            await complete_payment(db, payment)
+        else:
+            await db.execute(
+                update(Payment)
+                .where(Payment.id == payment.id, Payment.status.in_(("pending", "expired")))
+                .values(status="failed")
+            )
+            await promocode_guard.release(db, [payment.id])
+        await db.commit()
+        return "done"
+
+    async def replay(self, db: AsyncSession, event_id: int) -> bool:
+        """Возвращает событие в очередь с обнулённым счётчиком попыток (с commit)"""
+        result = await db.execute(
+            update(WebhookEvent)
+            .where(WebhookEvent.id == event_id)
+            .values(status="pending", attempts=0, next_attempt_at=func.now(), last_error=None, processed_at=None)
+        )
+        await db.commit()
+        if not result.rowcount:
+            return False
+        self._counters["replayed"] += 1
+        self.notify()
+        return True
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "workers": len(self._worker_tasks),
+            "processing": len(self._processing),
+        }
+
+
+webhook_inbox = WebhookInbox(
+    workers=settings.WEBHOOK_WORKERS,
+    batch_size=settings.WEBHOOK_BATCH_SIZE,
+    poll_interval=settings.WEBHOOK_POLL_INTERVAL_SECONDS,
+    max_attempts=settings.WEBHOOK_MAX_ATTEMPTS,
+)
@@ -1,52 +1,166 @@
 """
 Интеграция с ЮKassa для обработки платежей
 Документация: https://yookassa.ru/developers/api
+
+Один долгоживущий httpx.AsyncClient на процесс: пул keep-alive соединений
+(HTTP/2, если установлен пакет h2), таймауты на подключение и на запрос.
+Заголовок авторизации собирается один раз.
+
+Создание платежа повторяется при сетевых ошибках, 429 и 5xx с тем же
+Idempotence-Key: ключ генерируется и сохраняется в payments.idempotence_key
+до вызова API, поэтому повтор (в том числе после рестарта) не создаёт второй
+платёж в ЮKassa.
+
+Без YUKASSA_SHOP_ID/YUKASSA_SECRET_KEY клиент работает в тестовом режиме и
+возвращает заглушки. Для тестов и локального стенда можно подменить
+YUKASSA_API_URL (локальный сервер-заглушка) или передать transport
+(например, httpx.MockTransport или respx).
 """
+import asyncio
+import base64
+import logging
+import random
+import uuid
+from typing import Any, Dict, Optional
+
 import httpx
-from typing import Optional, Dict, Any
+
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401 - нужен httpx для HTTP/2
+except ImportError:
+    h2 = None
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class YukassaError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def new_idempotence_key() -> str:
+    return uuid.uuid4().hex
+
 
 class YukassaClient:
-    def __init__(self):
-        self.shop_id = settings.YUKASSA_SHOP_ID
-        self.secret_key = settings.YUKASSA_SECRET_KEY
-        self.base_url = "https://api.yookassa.ru/v3"
-    
-    def _get_headers(self) -> Dict[str, str]:
-        """Получить заголовки для запросов"""
-        import base64
-        auth_string = f"{self.shop_id}:{self.secret_key}"
-        auth_bytes = auth_string.encode('utf-8')
-        auth_b64 = base64.b64encode(auth_bytes).decode('utf-8')
-        
-        return {
-            "Authorization": f"Basic {auth_b64}",
-            "Content-Type": "application/json",
-            "Idempotence-Key": ""  # Должен быть уникальным для каждого запроса
-        }
-    
-    def create_payment(
+    def __init__(
+        self,
+        shop_id: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.shop_id = shop_id if shop_id is not None else settings.YUKASSA_SHOP_ID
+        self.secret_key = secret_key if secret_key is not None else settings.YUKASSA_SECRET_KEY
+        self.base_url = (base_url or settings.YUKASSA_API_URL).rstrip("/")
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._auth_header = self._build_auth_header()
+        self._counters = {"requests": 0, "retries": 0, "errors": 0}
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _build_auth_header(self) -> str:
+        auth_b64 = base64.b64encode(f"{self.shop_id}:{self.secret_key}".encode("utf-8")).decode("ascii")
+        return f"Basic {auth_b64}"
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Создаём лениво, внутри работающего event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=h2 is not None and settings.YUKASSA_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=settings.YUKASSA_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.YUKASSA_MAX_CONNECTIONS,
+                    keepalive_expiry=60.0,
+                ),
+                timeout=httpx.Timeout(
+                    settings.YUKASSA_TIMEOUT_SECONDS, connect=settings.YUKASSA_CONNECT_TIMEOUT_SECONDS
+                ),
+                headers={"Authorization": self._auth_header, "Content-Type": "application/json"},
+                transport=self._transport,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        """Закрывает пул соединений (вызывается при shutdown)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        json: Optional[Dict[str, Any]] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Запрос к API с повторами; POST повторяется только с Idempotence-Key"""
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+        can_retry = method == "GET" or idempotence_key is not None
+        attempts = max(settings.YUKASSA_RETRY_ATTEMPTS, 1) if can_retry else 1
+        client = self._get_client()
+
+        for attempt in range(1, attempts + 1):
+            self._counters["requests"] += 1
+            try:
+                response = await client.request(method, path, json=json, headers=headers)
+            except httpx.TransportError as e:
+                if attempt >= attempts:
+                    self._counters["errors"] += 1
+                    raise YukassaError(f"YuKassa {method} {path} failed: {e}") from e
+                delay = None
+            else:
+                if response.status_code == 202 and can_retry and attempt < attempts:
+                    # Запрос с этим ключом ещё обрабатывается: retry_after (мс) - в теле ответа
+                    delay = (response.json().get("retry_after") or 1000) / 1000
+                elif response.status_code < 400 and response.status_code != 202:
+                    return response.json()
+                elif response.status_code not in RETRYABLE_STATUSES or attempt >= attempts:
+                    self._counters["errors"] += 1
+                    raise YukassaError(
+                        f"YuKassa {method} {path} returned {response.status_code}: {response.text[:500]}",
+                        status_code=response.status_code,
+                    )
+                else:
+                    retry_after = response.headers.get("retry-after")
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else None
+
+            if delay is None:
+                delay = random.uniform(0, settings.YUKASSA_RETRY_BASE_DELAY_MS / 1000 * 2 ** (attempt - 1))
+            self._counters["retries"] += 1
+            logger.warning("YuKassa %s %s: retry %d/%d in %.2fs", method, path, attempt, attempts - 1, delay)
+            await asyncio.sleep(delay)
+
+    async def create_payment(
         self,
         amount: float,
         description: str,
         return_url: str,
+        idempotence_key: str,
         metadata: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """
         Создать платёж в ЮKassa
-        
+
         Args:
             amount: Сумма платежа в рублях
             description: Описание платежа
             return_url: URL для возврата после оплаты
+            idempotence_key: Ключ идемпотентности, сохранённый в payments.idempotence_key
             metadata: Дополнительные данные (payment_id, user_id и т.д.)
-        
+
         Returns:
             Словарь с данными платежа, включая confirmation_url для редиректа
         """
-        import uuid
-        
         payload = {
             "amount": {
                 "value": f"{amount:.2f}",
@@ -59,61 +173,47 @@ class YukassaClient:
             "description": description,
             "capture": True,
         }
-        
+
         if metadata:
             payload["metadata"] = metadata
-        
-        headers = self._get_headers()
-        headers["Idempotence-Key"] = str(uuid.uuid4())
-        
-        # В реальном проекте здесь должен быть HTTP запрос к API ЮKassa
-        # Пока возвращаем заглушку
-        # async with httpx.AsyncClient() as client:
-        #     response = await client.post(
-        #         f"{self.base_url}/payments",
-        #         json=payload,
-        #         headers=headers,
-        #         timeout=30.0
-        #     )
-        #     response.raise_for_status()
-        #     return response.json()
-        
-        # Заглушка для разработки
-        return {
-            "id": f"test_payment_{uuid.uuid4()}",
-            "status": "pending",
-            "confirmation": {
-                "confirmation_url": f"{return_url}?payment_id=test_payment"
+
+        if not self.configured:
+            # Заглушка для разработки
+            return {
+                "id": f"test_payment_{idempotence_key}",
+                "status": "pending",
+                "confirmation": {
+                    "confirmation_url": f"{return_url}?payment_id=test_payment"
+                }
             }
-        }
-    
-    def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
+
+        return await self._request("POST", "/payments", json=payload, idempotence_key=idempotence_key)
+
+    async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
         """
         Получить статус платежа
-        
+
         Args:
             payment_id: ID платежа в ЮKassa
-        
+
         Returns:
             Словарь с данными платежа и статусом
         """
-        headers = self._get_headers()
-        
-        # В реальном проекте здесь должен быть HTTP запрос
-        # async with httpx.AsyncClient() as client:
-        #     response = await client.get(
-        #         f"{self.base_url}/payments/{payment_id}",
-        #         headers=headers,
-        #         timeout=30.0
-        #     )
-        #     response.raise_for_status()
-        #     return response.json()
-        
-        # Заглушка для разработки
+        if not self.configured:
+            # Заглушка для разработки
+            return {
+                "id": payment_id,
+                "status": "succeeded",
+                "paid": True
+            }
+
+        return await self._request("GET", f"/payments/{payment_id}")
+
+    def stats(self) -> Dict[str, object]:
         return {
-            "id": payment_id,
-            "status": "succeeded",
-            "paid": True
+            **self._counters,
+            "configured": self.configured,
+            "http2": h2 is not None and settings.YUKASSA_HTTP2,
         }
 
 
@@ -0,0 +1,149 @@
+"""
+Кеш принципалов (id, is_active, is_admin) для аутентификации без запроса к users
+
+get_current_user вызывается на каждом запросе, включая SSE-стримы и поллинг.
+Вместо SELECT по users на каждый запрос используется:
+  - локальный TTL/LRU-кеш процесса (по умолчанию);
+  - общий кеш в Redis, если задан PRINCIPAL_CACHE_REDIS_URL (для нескольких воркеров);
+  - опционально - claims прямо в JWT (JWT_PRINCIPAL_CLAIMS), тогда БД и кеш не нужны.
+
+При деактивации/смене прав пользователя вызывается invalidate(user_id): запись
+удаляется, а токены с claims, выпущенные раньше, перестают считаться доверенными.
+Время изменения хранится в Redis (если он подключён), иначе - в памяти процесса,
+и тогда после рестарта или на другом воркере оно неизвестно. Поэтому claims
+доверяются только JWT_PRINCIPAL_CLAIMS_TTL_SECONDS после выпуска токена, дальше -
+кеш/БД: устаревшие флаги живут не дольше этого окна, а не весь срок токена.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Аутентифицированный пользователь: всё, что нужно для авторизации запроса"""
+    id: int
+    is_active: bool
+    is_admin: bool
+
+
+class PrincipalCache:
+    def __init__(self, max_size: int, ttl_seconds: int, redis_url: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._local: "OrderedDict[int, tuple]" = OrderedDict()
+        # user_id -> время последнего изменения (для отзыва claims в токенах)
+        self._changed_at: Dict[int, float] = {}
+        self._redis = None
+        if redis_url:
+            try:
+                import redis.asyncio as redis_asyncio
+                self._redis = redis_asyncio.from_url(redis_url)
+            except ImportError:
+                logger.warning("PRINCIPAL_CACHE_REDIS_URL is set but redis package is not installed; using local cache")
+        self._counters = {"hits": 0, "misses": 0, "claims": 0, "claims_expired": 0, "invalidations": 0}
+
+    @staticmethod
+    def _redis_key(user_id: int) -> str:
+        return f"principal:{user_id}"
+
+    @staticmethod
+    def _changed_key(user_id: int) -> str:
+        return f"principal_changed:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[Principal]:
+        principal = None
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(self._redis_key(user_id))
+                principal = Principal(**json.loads(raw)) if raw else None
+            except Exception as e:
+                logger.warning(f"Principal cache (redis) get failed: {e}")
+        else:
+            entry = self._local.get(user_id)
+            if entry and time.monotonic() - entry[1] <= self.ttl_seconds:
+                self._local.move_to_end(user_id)
+                principal = entry[0]
+            elif entry:
+                del self._local[user_id]
+
+        self._counters["hits" if principal else "misses"] += 1
+        return principal
+
+    async def put(self, principal: Principal) -> None:
+        if self._redis is not None:
+            try:
+                await self._redis.set(
+                    self._redis_key(principal.id), json.dumps(asdict(principal)), ex=self.ttl_seconds
+                )
+            except Exception as e:
+                logger.warning(f"Principal cache (redis) set failed: {e}")
+            return
+
+        self._local[principal.id] = (principal, time.monotonic())
+        self._local.move_to_end(principal.id)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def invalidate(self, user_id: int) -> None:
+        self._counters["invalidations"] += 1
+        changed_at = time.time()
+        self._changed_at[user_id] = changed_at
+        self._local.pop(user_id, None)
+        if self._redis is not None:
+            try:
+                await self._redis.delete(self._redis_key(user_id))
+                # Общее для всех воркеров; хранить дольше срока жизни токена незачем
+                await self._redis.set(
+                    self._changed_key(user_id), changed_at, ex=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+                )
+            except Exception as e:
+                logger.warning(f"Principal cache (redis) delete failed: {e}")
+
+    async def _get_changed_at(self, user_id: int) -> Optional[float]:
+        if self._redis is not None:
+            raw = await self._redis.get(self._changed_key(user_id))
+            return float(raw) if raw else None
+        return self._changed_at.get(user_id)
+
+    async def from_claims(self, user_id: int, payload: dict) -> Optional[Principal]:
+        """Principal из claims токена, если они есть, свежие и не выпущены до изменения пользователя"""
+        if "act" not in payload or "adm" not in payload:
+            return None
+        issued_at = payload.get("iat", 0)
+        if time.time() - issued_at > settings.JWT_PRINCIPAL_CLAIMS_TTL_SECONDS:
+            self._counters["claims_expired"] += 1
+            return None
+        try:
+            changed_at = await self._get_changed_at(user_id)
+        except Exception as e:
+            # Не знаем, менялся ли пользователь, - claims не доверяем
+            logger.warning(f"Principal cache (redis) get failed: {e}")
+            return None
+        if changed_at is not None and issued_at < changed_at:
+            return None
+        self._counters["claims"] += 1
+        return Principal(id=user_id, is_active=bool(payload["act"]), is_admin=bool(payload["adm"]))
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self._counters["hits"] + self._counters["misses"]
+        return {
+            **self._counters,
+            "backend": "redis" if self._redis is not None else "local",
+            "size": len(self._local),
+            "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+principal_cache = PrincipalCache(
+    max_size=settings.PRINCIPAL_CACHE_MAX_SIZE,
+    ttl_seconds=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+    redis_url=settings.PRINCIPAL_CACHE_REDIS_URL,
+)
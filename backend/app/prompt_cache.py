@@ -0,0 +1,124 @@
+"""
+Prefix-кеширование промптов на стороне провайдера
+
+Длинный scenario.system_prompt одинаков для тысяч пользователей, и OpenAI
+автоматически кеширует общий префикс запроса (от 1024 токенов). Чтобы кеш
+срабатывал:
+  - messages собираются в стабильном порядке: неизменный материал сценария
+    (system, шаблоны, описание задания) - в начале, данные пользователя - в конце;
+  - запросы с одинаковым system prompt помечаются одним prompt_cache_key,
+    чтобы провайдер направлял их на один и тот же кеш;
+  - из usage ответа (prompt_tokens_details.cached_tokens) копится статистика по
+    ключам, а в метриках ключи сопоставляются сценариям из снимка каталога.
+
+Правка сценария меняет system prompt, а значит и ключ: старый ключ попадает в
+stale_prefixes, новый начинает "холодным". Если по ключу кеш уже срабатывал, а
+затем PROMPT_CACHE_BREAK_AFTER_MISSES запросов подряд идут без кешированных
+токенов, ключ помечается как broken (например, изменился порядок сообщений).
+"""
+import hashlib
+import time
+from typing import Any, Dict, Optional
+
+from app.config import settings
+
+# Провайдер не кеширует префиксы короче этого порога - такие запросы не считаются промахами
+MIN_CACHEABLE_PROMPT_TOKENS = 1024
+
+
+def prefix_key(system_prompt: str) -> str:
+    """Ключ кеша префикса: хеш system prompt (меняется при правке сценария)"""
+    return "sp-" + hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def request_options(system_prompt: str) -> Dict[str, Any]:
+    """Дополнительные параметры запроса для маршрутизации в кеш провайдера"""
+    if not settings.PROMPT_CACHE_KEY_ENABLED:
+        return {}
+    return {"extra_body": {"prompt_cache_key": prefix_key(system_prompt)}}
+
+
+class PromptCacheStats:
+    def __init__(self, break_after_misses: int, max_keys: int = 1000):
+        self.break_after_misses = break_after_misses
+        self.max_keys = max_keys
+        self._keys: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, system_prompt: str, usage: Optional[Any]) -> None:
+        """Учитывает usage ответа (объект openai или None, если провайдер его не вернул)"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+
+        key = prefix_key(system_prompt)
+        entry = self._keys.get(key)
+        if entry is None:
+            if len(self._keys) >= self.max_keys:
+                oldest = min(self._keys, key=lambda k: self._keys[k]["last_seen"])
+                del self._keys[oldest]
+            entry = self._keys[key] = {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "ever_hit": False,
+                "consecutive_misses": 0,
+                "last_seen": 0.0,
+            }
+
+        entry["requests"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["cached_tokens"] += cached_tokens
+        entry["last_seen"] = time.time()
+        if cached_tokens:
+            entry["ever_hit"] = True
+            entry["consecutive_misses"] = 0
+        elif prompt_tokens >= MIN_CACHEABLE_PROMPT_TOKENS:
+            entry["consecutive_misses"] += 1
+
+    def _summary(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "requests": entry["requests"],
+            "prompt_tokens": entry["prompt_tokens"],
+            "cached_tokens": entry["cached_tokens"],
+            "cached_ratio": round(entry["cached_tokens"] / entry["prompt_tokens"], 4) if entry["prompt_tokens"] else 0.0,
+            "broken": entry["ever_hit"] and entry["consecutive_misses"] >= self.break_after_misses,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        from app.catalog import catalog
+
+        snapshot = catalog.snapshot
+        scenario_keys = {}
+        if snapshot is not None:
+            scenario_keys = {prefix_key(s.system_prompt): s.id for s in snapshot.scenario_by_id.values()}
+
+        scenarios = {}
+        other = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        stale_prefixes = 0
+        for key, entry in self._keys.items():
+            scenario_id = scenario_keys.get(key)
+            if scenario_id is not None:
+                scenarios[scenario_id] = {"prefix": key, **self._summary(entry)}
+                continue
+            # Старые версии промптов сценариев и служебные промпты (сжатие истории и т.п.)
+            stale_prefixes += 1
+            for field in other:
+                other[field] += entry[field]
+
+        total_prompt = sum(e["prompt_tokens"] for e in self._keys.values())
+        total_cached = sum(e["cached_tokens"] for e in self._keys.values())
+        return {
+            "key_enabled": settings.PROMPT_CACHE_KEY_ENABLED,
+            "prompt_tokens": total_prompt,
+            "cached_tokens": total_cached,
+            "cached_ratio": round(total_cached / total_prompt, 4) if total_prompt else 0.0,
+            "broken_scenarios": sorted(sid for sid, s in scenarios.items() if s["broken"]),
+            "scenarios": scenarios,
+            "stale_prefixes": stale_prefixes,
+            "other": other,
+        }
+
+
+prompt_cache_stats = PromptCacheStats(break_after_misses=settings.PROMPT_CACHE_BREAK_AFTER_MISSES)
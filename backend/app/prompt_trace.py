@@ -0,0 +1,266 @@
+"""
+Трассировка промптов LLM (вместо полного дампа DEBUG_OPENAI_PROMPTS)
+
+DEBUG_OPENAI_PROMPTS синхронно пишет в лог каждый запрос целиком
+(json.dumps(..., indent=2) всех messages) и каждый ответ - на горячем пути это
+CPU, I/O и объём логов. Трасса пишет только выборку запросов:
+  - PROMPT_TRACE_SAMPLE_RATE - доля всех запросов;
+  - PROMPT_TRACE_USER_IDS / PROMPT_TRACE_SCENARIO_IDS - пользователи и сценарии,
+    запросы которых трассируются всегда (разбор конкретной жалобы);
+  - вместо текстов сообщений и ответа - sha256 и длина; сами тексты только
+    при PROMPT_TRACE_INCLUDE_BODIES.
+
+Запись не блокирует event loop: записи кладутся в ограниченную очередь (при
+переполнении отбрасываются и учитываются в метриках), сериализацию и запись
+делает поток QueueListener. Формат - JSONL в PROMPT_TRACE_DIR, ротация по
+размеру, ротированные файлы сжимаются gzip.
+
+Пользователь, сценарий и попытка берутся из trace_context, который выставляют
+генераторы в роутерах; фоновые задачи, созданные внутри, наследуют его.
+Восстановить промпт трассы для повторного запуска: scripts/replay_prompt_trace.py.
+"""
+import contextvars
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE_NAME = "prompt-trace.jsonl"
+
+_trace_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("prompt_trace_context", default={})
+
+
+@contextmanager
+def trace_context(**fields):
+    """Поля (user_id, scenario_id, progress_id), которые попадут в трассы запросов внутри блока"""
+    token = _trace_context.set({**_trace_context.get(), **fields})
+    try:
+        yield
+    finally:
+        try:
+            _trace_context.reset(token)
+        except ValueError:
+            # Генератор закрыт из другого контекста (например, при остановке воркеров)
+            pass
+
+
+async def traced_stream(frames: AsyncIterator[str], **fields) -> AsyncIterator[str]:
+    """Итерирует генератор кадров внутри trace_context (для фоновых задач генерации)"""
+    with trace_context(**fields):
+        async for frame in frames:
+            yield frame
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def _parse_ids(value: str) -> Set[int]:
+    return {int(item) for item in value.split(",") if item.strip()}
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не блокирует и не форматирует запись в event loop"""
+
+    def __init__(self, records: queue.Queue, on_drop):
+        super().__init__(records)
+        self._on_drop = on_drop
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сериализация - в потоке QueueListener (_JsonLineFormatter)
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._on_drop()
+
+
+class PromptTrace:
+    """Один трассируемый запрос: создаётся PromptTracer.start, завершается finish/fail"""
+
+    def __init__(self, tracer: "PromptTracer", record: Dict[str, Any]):
+        self._tracer = tracer
+        self._record = record
+        self._started = time.monotonic()
+
+    def finish(self, response_text: Optional[str], model: Optional[str] = None, usage: Optional[Any] = None) -> None:
+        record = self._record
+        if model:
+            record["model"] = model
+        record["response"] = self._tracer.describe(response_text or "")
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            record["usage"] = {
+                "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                "completion_tokens": getattr(usage, "completion_tokens", None),
+                "cached_tokens": getattr(details, "cached_tokens", None),
+            }
+        self._emit()
+
+    def fail(self, error: BaseException) -> None:
+        self._record["error"] = f"{type(error).__name__}: {error}"
+        self._emit()
+
+    def _emit(self) -> None:
+        self._record["duration_ms"] = round((time.monotonic() - self._started) * 1000)
+        self._tracer.emit(self._record)
+
+
+class PromptTracer:
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: float,
+        user_ids: Set[int],
+        scenario_ids: Set[int],
+        include_bodies: bool,
+        max_bytes: int,
+        backup_count: int,
+        queue_size: int,
+    ):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.user_ids = user_ids
+        self.scenario_ids = scenario_ids
+        self.include_bodies = include_bodies
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[QueueListener] = None
+        self._counters = {"requests": 0, "traced": 0, "forced": 0, "dropped": 0, "errors": 0}
+
+    def _ensure_started(self) -> logging.Logger:
+        # Создаём лениво: без трассируемых запросов файл и поток не нужны
+        if self._logger is None:
+            os.makedirs(self.directory, exist_ok=True)
+            file_handler = RotatingFileHandler(
+                os.path.join(self.directory, TRACE_FILE_NAME),
+                maxBytes=self.max_bytes,
+                backupCount=self.backup_count,
+                encoding="utf-8",
+            )
+            file_handler.namer = lambda name: name + ".gz"
+            file_handler.rotator = _gzip_rotator
+            file_handler.setFormatter(_JsonLineFormatter())
+            self._listener = QueueListener(self._queue, file_handler)
+            self._listener.start()
+
+            trace_logger = logging.getLogger("app.prompt_trace.records")
+            trace_logger.propagate = False
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.addHandler(_DroppingQueueHandler(self._queue, self._on_drop))
+            self._logger = trace_logger
+        return self._logger
+
+    def _on_drop(self) -> None:
+        self._counters["dropped"] += 1
+
+    def _should_trace(self, context: Dict[str, Any]) -> Optional[str]:
+        """Причина трассировки ("filter" / "sample") или None"""
+        if context.get("user_id") in self.user_ids or context.get("scenario_id") in self.scenario_ids:
+            return "filter"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def describe(self, text: str) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {"sha256": text_hash(text), "chars": len(text)}
+        if self.include_bodies:
+            entry["content"] = text
+        return entry
+
+    def start(
+        self,
+        name: str,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float],
+        max_completion_tokens: int,
+    ) -> Optional[PromptTrace]:
+        """Трасса запроса или None, если запрос не попал в выборку (тогда ничего не считается)"""
+        self._counters["requests"] += 1
+        context = _trace_context.get()
+        reason = self._should_trace(context)
+        if reason is None:
+            return None
+        self._counters["traced"] += 1
+        if reason == "filter":
+            self._counters["forced"] += 1
+        return PromptTrace(self, {
+            "ts": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+            "trace_id": uuid.uuid4().hex,
+            "name": name,
+            "reason": reason,
+            "model": settings.OPENAI_MODEL,
+            "temperature": temperature,
+            "max_completion_tokens": max_completion_tokens,
+            **context,
+            "messages": [{"role": m["role"], **self.describe(m.get("content") or "")} for m in messages],
+        })
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        if "error" in record:
+            self._counters["errors"] += 1
+        try:
+            self._ensure_started().info(record)
+        except Exception as e:
+            logger.warning(f"Prompt trace write failed: {e}")
+
+    def close(self) -> None:
+        """Дописывает очередь и останавливает поток записи (при shutdown)"""
+        if self._listener is not None:
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            self._logger = None
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "sample_rate": self.sample_rate,
+            "include_bodies": self.include_bodies,
+            "queued": self._queue.qsize(),
+            "directory": self.directory,
+        }
+
+
+prompt_tracer = PromptTracer(
+    directory=settings.PROMPT_TRACE_DIR,
+    sample_rate=settings.PROMPT_TRACE_SAMPLE_RATE,
+    user_ids=_parse_ids(settings.PROMPT_TRACE_USER_IDS),
+    scenario_ids=_parse_ids(settings.PROMPT_TRACE_SCENARIO_IDS),
+    include_bodies=settings.PROMPT_TRACE_INCLUDE_BODIES,
+    max_bytes=settings.PROMPT_TRACE_MAX_FILE_MB * 1024 * 1024,
+    backup_count=settings.PROMPT_TRACE_BACKUP_COUNT,
+    queue_size=settings.PROMPT_TRACE_QUEUE_SIZE,
+)
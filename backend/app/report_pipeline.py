@@ -0,0 +1,108 @@
+"""
+Инкрементальный финальный отчёт (map-reduce)
+
+При REPORT_MODE=incremental после каждого ответа (кроме последнего) в фоне
+считается краткая оценка ответа (map) и сохраняется в user_tasks.evaluation.
+Финальный отчёт строится по этим оценкам (reduce): промпт и время до первого
+токена почти не зависят от длины сценария. Задания, для которых оценки ещё
+нет (последнее или не успевшее оцениться), попадают в reduce целиком.
+
+При REPORT_MODE=full (по умолчанию) отчёт строится по всем вопросам и ответам,
+как раньше. Очередь оценок ограничена REPORT_EVALUATION_MAX_PENDING: сверх неё
+оценка пропускается, и задание тоже попадает в reduce целиком.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from sqlalchemy import update
+
+from app.ai_service import evaluate_task_answer_async
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import UserTask
+
+logger = logging.getLogger(__name__)
+
+
+def incremental_reports_enabled() -> bool:
+    return settings.REPORT_MODE == "incremental"
+
+
+class TaskEvaluator:
+    """Ограниченный пул фоновых задач оценки ответов"""
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._jobs: Set[asyncio.Task] = set()
+        self._counters = {"scheduled": 0, "skipped": 0, "stored": 0, "failed": 0}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Создаём лениво, внутри работающего event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    def schedule(
+        self,
+        user_task_id: int,
+        system_prompt: str,
+        report_template: str,
+        task_order: int,
+        question: str,
+        answer: str,
+    ) -> None:
+        if len(self._jobs) >= self.max_pending:
+            # Оценка необязательна: без неё задание попадёт в reduce целиком
+            self._counters["skipped"] += 1
+            return
+        self._counters["scheduled"] += 1
+        job = asyncio.create_task(
+            self._run(user_task_id, system_prompt, report_template, task_order, question, answer)
+        )
+        # Держим ссылку, чтобы задачу не собрал GC до завершения
+        self._jobs.add(job)
+        job.add_done_callback(self._jobs.discard)
+
+    async def _run(
+        self,
+        user_task_id: int,
+        system_prompt: str,
+        report_template: str,
+        task_order: int,
+        question: str,
+        answer: str,
+    ) -> None:
+        try:
+            async with self._get_semaphore():
+                evaluation = await evaluate_task_answer_async(
+                    system_prompt, report_template, task_order, question, answer
+                )
+            if not evaluation:
+                self._counters["failed"] += 1
+                return
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(UserTask).where(UserTask.id == user_task_id).values(evaluation=evaluation)
+                )
+                await db.commit()
+            self._counters["stored"] += 1
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.warning(f"Task evaluation failed for user_task {user_task_id}: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "mode": settings.REPORT_MODE,
+            "in_flight": len(self._jobs),
+            "max_pending": self.max_pending,
+        }
+
+
+evaluator = TaskEvaluator(
+    max_workers=settings.REPORT_EVALUATION_WORKERS,
+    max_pending=settings.REPORT_EVALUATION_MAX_PENDING,
+)
@@ -1,38 +1,80 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from app.database import get_db
-from app.models import User, Profession, Scenario, Task, Package, Promocode
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from app.database import get_async_db
+from app.models import User, Profession, Scenario, Task, Package, Promocode, WebhookEvent
 from app.schemas import (
     ProfessionCreate, ProfessionResponse,
     ScenarioCreate, ScenarioResponse,
     TaskCreate, TaskResponse,
     PackageCreate, PackageResponse,
-    PromocodeCreate, PromocodeResponse
+    PromocodeCreate, PromocodeResponse,
+    UserAdminUpdate, UserResponse,
+    WebhookEventResponse
 )
-from app.auth import get_current_active_user
+from app.auth import get_current_active_user, password_pool_stats, Principal
+from app.speculation import prefix_warmer
+from app.catalog import catalog
+from app.generation_jobs import generation_jobs
+from app.report_pipeline import evaluator
+from app.context_budget import history_compactor
+from app.prompt_cache import prompt_cache_stats
+from app.ai_service import model_router
+from app.prompt_trace import prompt_tracer
+from app.analytics import analytics
+from app.payments.yukassa import yukassa_client
+from app.payments.webhook_inbox import webhook_inbox
+from app.payments.promocodes import promocode_guard
+from app.llm_cache import response_cache
+from app.semantic_cache import semantic_cache
+from app.principal_cache import principal_cache
 
 router = APIRouter()
 
 
 # Проверка прав администратора
-async def get_admin_user(current_user: User = Depends(get_current_active_user)):
+async def get_admin_user(current_user: Principal = Depends(get_current_active_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
 
+# Управление пользователями
+@router.put("/users/{user_id}", response_model=UserResponse)
+async def update_user(
+    user_id: int,
+    user_data: UserAdminUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
+):
+    """Деактивировать пользователя или изменить права администратора"""
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    for key, value in user_data.dict(exclude_unset=True).items():
+        setattr(user, key, value)
+    
+    await db.commit()
+    await db.refresh(user)
+    # Закешированный principal (и claims в ранее выданных токенах) больше не действителен
+    await principal_cache.invalidate(user_id)
+    return user
+
+
 # Управление профессиями
 @router.post("/professions", response_model=ProfessionResponse)
 async def create_profession(
     profession_data: ProfessionCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
     profession = Profession(**profession_data.dict())
     db.add(profession)
-    db.commit()
-    db.refresh(profession)
+    await db.commit()
+    await db.refresh(profession)
+    await catalog.refresh()
     return profession
 
 
@@ -40,18 +82,19 @@ async def create_profession(
 async def update_profession(
     profession_id: int,
     profession_data: ProfessionCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
-    profession = db.query(Profession).filter(Profession.id == profession_id).first()
+    profession = await db.get(Profession, profession_id)
     if not profession:
         raise HTTPException(status_code=404, detail="Profession not found")
     
     for key, value in profession_data.dict().items():
         setattr(profession, key, value)
     
-    db.commit()
-    db.refresh(profession)
+    await db.commit()
+    await db.refresh(profession)
+    await catalog.refresh()
     return profession
 
 
@@ -59,13 +102,14 @@ async def update_profession(
 @router.post("/scenarios", response_model=ScenarioResponse)
 async def create_scenario(
     scenario_data: ScenarioCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
     scenario = Scenario(**scenario_data.dict())
     db.add(scenario)
-    db.commit()
-    db.refresh(scenario)
+    await db.commit()
+    await db.refresh(scenario)
+    await catalog.refresh()
     return scenario
 
 
@@ -73,32 +117,50 @@ async def create_scenario(
 async def update_scenario(
     scenario_id: int,
     scenario_data: ScenarioCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
-    scenario = db.query(Scenario).filter(Scenario.id == scenario_id).first()
+    scenario = await db.get(Scenario, scenario_id)
     if not scenario:
         raise HTTPException(status_code=404, detail="Scenario not found")
     
     for key, value in scenario_data.dict().items():
         setattr(scenario, key, value)
     
-    db.commit()
-    db.refresh(scenario)
+    await db.commit()
+    await db.refresh(scenario)
+    await catalog.refresh()
+    response_cache.invalidate_tag(f"scenario:{scenario_id}")
+    # Закешированные следующие вопросы всех заданий сценария построены по старому промпту
+    task_ids = (await db.scalars(select(Task.id).where(Task.scenario_id == scenario_id))).all()
+    await semantic_cache.invalidate_tasks(list(task_ids))
     return scenario
 
 
 # Управление заданиями
+async def _preceding_task_ids(db: AsyncSession, positions: List[tuple]) -> List[int]:
+    """Задания, стоящие перед позициями (scenario_id, order).
+
+    Семантический кеш хранит следующий вопрос под заданием, на которое ответили,
+    поэтому вопрос по заданию N лежит под заданием N-1 и при правке N тоже устаревает.
+    """
+    conditions = [and_(Task.scenario_id == scenario_id, Task.order == order - 1) for scenario_id, order in positions]
+    return list((await db.scalars(select(Task.id).where(or_(*conditions)))).all())
+
+
 @router.post("/tasks", response_model=TaskResponse)
 async def create_task(
     task_data: TaskCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
     task = Task(**task_data.dict())
     db.add(task)
-    db.commit()
-    db.refresh(task)
+    await db.commit()
+    await db.refresh(task)
+    await catalog.refresh()
+    # После предыдущего задания теперь идёт новое - старые закешированные вопросы неверны
+    await semantic_cache.invalidate_tasks(await _preceding_task_ids(db, [(task.scenario_id, task.order)]))
     return task
 
 
@@ -106,18 +168,24 @@ async def create_task(
 async def update_task(
     task_id: int,
     task_data: TaskCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
-    task = db.query(Task).filter(Task.id == task_id).first()
+    task = await db.get(Task, task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
+    # Позиция до правки: задание могли перенести в другой сценарий или на другой шаг
+    positions = [(task.scenario_id, task.order)]
     for key, value in task_data.dict().items():
         setattr(task, key, value)
     
-    db.commit()
-    db.refresh(task)
+    await db.commit()
+    await db.refresh(task)
+    await catalog.refresh()
+    response_cache.invalidate_tag(f"task:{task_id}")
+    positions.append((task.scenario_id, task.order))
+    await semantic_cache.invalidate_tasks([task_id, *await _preceding_task_ids(db, positions)])
     return task
 
 
@@ -125,41 +193,94 @@ async def update_task(
 @router.post("/packages", response_model=PackageResponse)
 async def create_package(
     package_data: PackageCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
     package = Package(**package_data.dict())
     db.add(package)
-    db.commit()
-    db.refresh(package)
+    await db.commit()
+    await db.refresh(package)
     return package
 
 
 @router.get("/packages", response_model=List[PackageResponse])
 async def get_packages(
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
-    return db.query(Package).filter(Package.is_active == True).all()
+    return (await db.scalars(select(Package).where(Package.is_active == True))).all()
 
 
 # Управление промокодами
 @router.post("/promocodes", response_model=PromocodeResponse)
 async def create_promocode(
     promocode_data: PromocodeCreate,
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
     promocode = Promocode(**promocode_data.dict())
     db.add(promocode)
-    db.commit()
-    db.refresh(promocode)
+    await db.commit()
+    await db.refresh(promocode)
+    # Код мог быть закеширован как несуществующий
+    promocode_guard.invalidate(promocode.code)
     return promocode
 
 
 @router.get("/promocodes", response_model=List[PromocodeResponse])
 async def get_promocodes(
-    db: Session = Depends(get_db),
-    admin: User = Depends(get_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
 ):
-    return db.query(Promocode).all()
+    return (await db.scalars(select(Promocode))).all()
+
+
+# Webhook'и платёжной системы
+@router.get("/webhooks", response_model=List[WebhookEventResponse])
+async def get_webhook_events(
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
+):
+    """Последние уведомления из inbox (например, status=failed)"""
+    query = select(WebhookEvent).order_by(WebhookEvent.id.desc()).limit(limit)
+    if status:
+        query = query.where(WebhookEvent.status == status)
+    return (await db.scalars(query)).all()
+
+
+@router.post("/webhooks/{event_id}/replay")
+async def replay_webhook_event(
+    event_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    admin: Principal = Depends(get_admin_user)
+):
+    """Вернуть уведомление в очередь обработки (повторная обработка идемпотентна)"""
+    if not await webhook_inbox.replay(db, event_id):
+        raise HTTPException(status_code=404, detail="Webhook event not found")
+    return {"status": "queued"}
+
+
+# Метрики
+@router.get("/metrics")
+async def get_metrics(admin: Principal = Depends(get_admin_user)):
+    """Внутренние метрики процесса (кеши, фоновые задачи)"""
+    return {
+        "catalog": catalog.stats(),
+        "generation": generation_jobs.stats(),
+        "report_evaluations": evaluator.stats(),
+        "context_budget": history_compactor.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "llm_router": model_router.stats(),
+        "prompt_trace": prompt_tracer.stats(),
+        "yukassa": yukassa_client.stats(),
+        "webhook_inbox": webhook_inbox.stats(),
+        "promocodes": promocode_guard.stats(),
+        "analytics": analytics.stats(),
+        "speculation": prefix_warmer.stats(),
+        "llm_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "principal_cache": principal_cache.stats(),
+        "password_pool": password_pool_stats(),
+    }
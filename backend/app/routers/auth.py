@@ -1,19 +1,28 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
-from app.database import get_db
+from app.database import get_async_db
 from app.models import User
 from app.schemas import UserCreate, UserLogin, Token, UserResponse
-from app.auth import verify_password, get_password_hash, create_access_token, get_current_active_user
+from app.auth import (
+    verify_password_async,
+    get_password_hash_async,
+    create_access_token,
+    principal_claims,
+    get_current_active_user,
+    Principal,
+)
 from app.config import settings
+from app.analytics import analytics
 
 router = APIRouter()
 
 
 @router.post("/register", response_model=UserResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     # Проверка существования пользователя
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
+    existing_user = await db.scalar(select(User).where(User.email == user_data.email).limit(1))
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -21,23 +30,27 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Создание нового пользователя
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     db_user = User(
         email=user_data.email,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
 
 @router.post("/login", response_model=Token)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == user_data.email).first()
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).where(User.email == user_data.email).limit(1))
     
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    password_valid, new_hash = (
+        await verify_password_async(user_data.password, user.hashed_password)
+        if user else (False, None)
+    )
+    if not password_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -53,17 +66,24 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     # Обновление времени последнего входа
     from datetime import datetime
     user.last_login = datetime.utcnow()
-    db.commit()
+    # Хеш со старой стоимостью bcrypt обновляем прозрачно для пользователя
+    if new_hash:
+        user.hashed_password = new_hash
+    await db.commit()
+    analytics.emit("login", user.id)
     
     # Создание токена
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id)}, expires_delta=access_token_expires
+        data={"sub": str(user.id), **principal_claims(user)}, expires_delta=access_token_expires
     )
     
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_active_user)):
-    return current_user
+async def get_current_user_info(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    return await db.get(User, current_user.id)
@@ -1,13 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from datetime import datetime
 import logging
-from app.database import get_db
-from app.models import User, Payment, Package, Profession, Promocode, UserProgress
+from app.database import get_async_db
+from app.models import Payment, Package, Profession, Promocode
 from app.schemas import PaymentCreate, PaymentResponse, PackageResponse
-from app.auth import get_current_active_user
-from app.payments.yukassa import yukassa_client
+from app.auth import get_current_active_user, Principal
+from app.payments.yukassa import new_idempotence_key, yukassa_client
+from app.payments.entitlements import complete_payment
+from app.payments.promocodes import promocode_guard
+from app.payments.webhook_inbox import source_allowed, webhook_inbox
 from app.config import settings
 
 logger = logging.getLogger(__name__)
@@ -26,19 +29,19 @@ def calculate_discount(price: float, promocode: Promocode) -> float:
 
 @router.get("/packages", response_model=List[PackageResponse])
 async def get_available_packages(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить список доступных пакетов"""
-    packages = db.query(Package).filter(Package.is_active == True).all()
+    packages = (await db.scalars(select(Package).where(Package.is_active == True))).all()
     return packages
 
 
 @router.post("/create", response_model=PaymentResponse)
 async def create_payment(
     payment_data: PaymentCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Создать платёж"""
     amount = 0
@@ -46,38 +49,26 @@ async def create_payment(
     
     # Вычисляем сумму и список профессий
     if payment_data.package_id:
-        package = db.query(Package).filter(Package.id == payment_data.package_id).first()
+        package = await db.get(Package, payment_data.package_id)
         if not package:
             raise HTTPException(status_code=404, detail="Package not found")
         amount = float(package.price)
         profession_ids = package.profession_ids or []
+        description = f"Пакет: {package.name}"
     elif payment_data.profession_id:
-        profession = db.query(Profession).filter(Profession.id == payment_data.profession_id).first()
+        profession = await db.get(Profession, payment_data.profession_id)
         if not profession:
             raise HTTPException(status_code=404, detail="Profession not found")
         amount = float(profession.price)
         profession_ids = [payment_data.profession_id]
+        description = f"Профессия: {profession.name}"
     else:
         raise HTTPException(status_code=400, detail="Either package_id or profession_id required")
     
-    # Проверяем промокод
+    # Резервируем использование промокода (атомарно; освобождается, если платёж не пройдёт)
     discount_amount = 0
-    promocode_obj = None
     if payment_data.promocode:
-        promocode_obj = db.query(Promocode).filter(
-            Promocode.code == payment_data.promocode,
-            Promocode.is_active == True
-        ).first()
-        
-        if not promocode_obj:
-            raise HTTPException(status_code=404, detail="Promocode not found")
-        
-        if promocode_obj.max_uses and promocode_obj.current_uses >= promocode_obj.max_uses:
-            raise HTTPException(status_code=400, detail="Promocode usage limit exceeded")
-        
-        if promocode_obj.valid_until and promocode_obj.valid_until < datetime.utcnow():
-            raise HTTPException(status_code=400, detail="Promocode expired")
-        
+        promocode_obj = await promocode_guard.reserve(db, payment_data.promocode)
         discount_amount = calculate_discount(amount, promocode_obj)
         amount -= discount_amount
     
@@ -89,204 +80,123 @@ async def create_payment(
         profession_id=payment_data.profession_id,
         promocode=payment_data.promocode,
         discount_amount=discount_amount,
-        status="pending"
+        promocode_reserved=bool(payment_data.promocode),
+        status="pending",
+        # Ключ сохраняется до вызова ЮKassa: повторы запроса не создадут второй платёж
+        idempotence_key=new_idempotence_key()
     )
     db.add(payment)
-    
-    # Обновляем счётчик использования промокода
-    if promocode_obj:
-        promocode_obj.current_uses += 1
-    
-    db.commit()
-    db.refresh(payment)
+    await db.commit()
+    await db.refresh(payment)
     
     # Создаём платёж в ЮKassa
-    description = f"Оплата профессии/пакета"
-    if payment_data.package_id:
-        package = db.query(Package).filter(Package.id == payment_data.package_id).first()
-        if package:
-            description = f"Пакет: {package.name}"
-    elif payment_data.profession_id:
-        profession = db.query(Profession).filter(Profession.id == payment_data.profession_id).first()
-        if profession:
-            description = f"Профессия: {profession.name}"
-    
     return_url = f"{settings.APP_URL}/payment/success?payment_id={payment.id}"
     
     try:
-        yukassa_payment = yukassa_client.create_payment(
+        yukassa_payment = await yukassa_client.create_payment(
             amount=float(amount),
             description=description,
             return_url=return_url,
+            idempotence_key=payment.idempotence_key,
             metadata={
                 "payment_id": payment.id,
                 "user_id": current_user.id
             }
         )
-        
-        # Сохраняем ID платежа ЮKassa
-        payment.yukassa_payment_id = yukassa_payment.get("id")
-        db.commit()
-        db.refresh(payment)
-        
-        payment_response = PaymentResponse.model_validate(payment)
-        return {
-            **payment_response.model_dump(),
-            "confirmation_url": yukassa_payment.get("confirmation", {}).get("confirmation_url")
-        }
     except Exception as e:
-        # В случае ошибки возвращаем платёж без URL (для тестирования)
+        # Платёж в ЮKassa не создан (повторы исчерпаны) - оплатить его нельзя,
+        # резервация промокода освобождается сразу, а не через PAYMENT_PENDING_TTL_MINUTES
+        logger.error(f"YuKassa payment creation failed for payment {payment.id}: {e}")
+        payment.status = "failed"
+        await promocode_guard.release(db, [payment.id])
+        await db.commit()
+        await db.refresh(payment)
         return PaymentResponse.model_validate(payment)
 
+    # Сохраняем ID платежа ЮKassa
+    payment.yukassa_payment_id = yukassa_payment.get("id")
+    await db.commit()
+    await db.refresh(payment)
+
+    payment_response = PaymentResponse.model_validate(payment)
+    return {
+        **payment_response.model_dump(),
+        "confirmation_url": yukassa_payment.get("confirmation", {}).get("confirmation_url")
+    }
+
 
 @router.post("/webhook")
-async def yukassa_webhook(request: Request, db: Session = Depends(get_db)):
+async def yukassa_webhook(request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Webhook для обработки уведомлений от ЮKassa
     Документация: https://yookassa.ru/developers/using-api/webhooks
+
+    Уведомление только сохраняется в inbox (webhook_events), обработка - в
+    фоновых воркерах (app/payments/webhook_inbox.py). Ошибка сохранения даёт
+    500, и ЮKassa доставит уведомление повторно.
     """
+    if not source_allowed(request.client.host if request.client else None):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    
     try:
         data = await request.json()
-        event_type = data.get("event")
-        payment_object = data.get("object", {})
-        
-        if event_type == "payment.succeeded":
-            yukassa_payment_id = payment_object.get("id")
-            payment = db.query(Payment).filter(
-                Payment.yukassa_payment_id == yukassa_payment_id
-            ).first()
-            
-            if payment and payment.status != "completed":
-                payment.status = "completed"
-                payment.completed_at = datetime.utcnow()
-                
-                # Предоставляем доступ к профессиям
-                profession_ids = []
-                if payment.package_id:
-                    package = db.query(Package).filter(Package.id == payment.package_id).first()
-                    if package:
-                        profession_ids = package.profession_ids or []
-                elif payment.profession_id:
-                    profession_ids = [payment.profession_id]
-                
-                # Создаём записи прогресса для каждой профессии
-                user = db.query(User).filter(User.id == payment.user_id).first()
-                if user:
-                    for profession_id in profession_ids:
-                        existing_progress = db.query(UserProgress).filter(
-                            UserProgress.user_id == user.id,
-                            UserProgress.profession_id == profession_id
-                        ).first()
-                        
-                        if not existing_progress:
-                            progress = UserProgress(
-                                user_id=user.id,
-                                profession_id=profession_id,
-                                status="not_started"
-                            )
-                            db.add(progress)
-                
-                db.commit()
-        
-        return {"status": "ok"}
-    except Exception as e:
-        # Логируем ошибку, но возвращаем 200, чтобы ЮKassa не повторял запрос
-        logger.error(f"Webhook error: {e}", exc_info=True)
-        return {"status": "error", "message": str(e)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    
+    event_type = data.get("event") if isinstance(data, dict) else None
+    payment_object = data.get("object") if isinstance(data, dict) else None
+    yukassa_payment_id = payment_object.get("id") if isinstance(payment_object, dict) else None
+    if not event_type or not yukassa_payment_id:
+        raise HTTPException(status_code=400, detail="Invalid notification")
+    
+    await webhook_inbox.record(db, event_type, str(yukassa_payment_id), data)
+    return {"status": "ok"}
 
 
 @router.post("/{payment_id}/confirm")
 async def confirm_payment(
     payment_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Подтвердить платёж вручную (для тестирования или если webhook не сработал)"""
-    payment = db.query(Payment).filter(Payment.id == payment_id).first()
+    payment = await db.get(Payment, payment_id)
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
     
     if payment.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
-    
+
+    # Отменённый, истёкший или неудавшийся платёж не подтверждается (его промокод
+    # уже освобождён), а оплаченный повторно подтверждать незачем
+    if payment.status != "pending":
+        raise HTTPException(status_code=400, detail=f"Payment is {payment.status}")
+
+    # Ручное подтверждение без ID ЮKassa - только для заглушки без ключей магазина
+    if not payment.yukassa_payment_id and yukassa_client.configured:
+        raise HTTPException(status_code=400, detail="Payment was not created in YuKassa")
+
     # Проверяем статус в ЮKassa
     if payment.yukassa_payment_id:
         try:
-            yukassa_status = yukassa_client.get_payment_status(payment.yukassa_payment_id)
-            if yukassa_status.get("status") == "succeeded":
-                payment.status = "completed"
-                payment.completed_at = datetime.utcnow()
-            else:
+            yukassa_status = await yukassa_client.get_payment_status(payment.yukassa_payment_id)
+            if yukassa_status.get("status") != "succeeded":
                 return {"status": "pending", "message": "Payment not completed yet"}
         except Exception as e:
             return {"status": "error", "message": str(e)}
-    else:
-        # Для тестирования можно подтвердить вручную
-        payment.status = "completed"
-        payment.completed_at = datetime.utcnow()
-    
-    # Предоставляем доступ к профессиям
-    profession_ids = []
-    if payment.package_id:
-        package = db.query(Package).filter(Package.id == payment.package_id).first()
-        if package:
-            profession_ids = package.profession_ids or []
-    elif payment.profession_id:
-        profession_ids = [payment.profession_id]
-    
-    # Создаём записи прогресса для каждой профессии
-    for profession_id in profession_ids:
-        existing_progress = db.query(UserProgress).filter(
-            UserProgress.user_id == current_user.id,
-            UserProgress.profession_id == profession_id
-        ).first()
-        
-        if not existing_progress:
-            progress = UserProgress(
-                user_id=current_user.id,
-                profession_id=profession_id,
-                status="not_started"
-            )
-            db.add(progress)
-    
-    db.commit()
-    
-    return {"status": "success", "message": "Payment confirmed"}
-    
-    # Предоставляем доступ к профессиям
-    profession_ids = []
-    if payment.package_id:
-        package = db.query(Package).filter(Package.id == payment.package_id).first()
-        if package:
-            profession_ids = package.profession_ids or []
-    elif payment.profession_id:
-        profession_ids = [payment.profession_id]
-    
-    # Создаём записи прогресса для каждой профессии
-    for profession_id in profession_ids:
-        existing_progress = db.query(UserProgress).filter(
-            UserProgress.user_id == current_user.id,
-            UserProgress.profession_id == profession_id
-        ).first()
-        
-        if not existing_progress:
-            progress = UserProgress(
-                user_id=current_user.id,
-                profession_id=profession_id,
-                status="not_started"
-            )
-            db.add(progress)
     
-    db.commit()
+    # Предоставляем доступ к профессиям - идемпотентно, даже если webhook пришёл во время проверки
+    await complete_payment(db, payment)
+    await db.commit()
     
     return {"status": "success", "message": "Payment confirmed"}
 
 
 @router.get("/history", response_model=List[PaymentResponse])
 async def get_payment_history(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить историю платежей пользователя"""
-    payments = db.query(Payment).filter(Payment.user_id == current_user.id).all()
+    payments = (await db.scalars(select(Payment).where(Payment.user_id == current_user.id))).all()
     return payments
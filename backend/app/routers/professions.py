@@ -1,51 +1,84 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import desc, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from datetime import datetime
-from app.database import get_db
-from app.models import User, Profession, UserProgress
+from app.database import get_async_db
+from app.models import Profession, UserProgress
 from app.schemas import ProfessionResponse, UserProgressResponse, ProgressHistoryResponse, AttemptSummary
-from app.auth import get_current_active_user
+from app.auth import get_current_active_user, Principal
+from app.catalog import catalog
 
 router = APIRouter()
 
+# Каталог общий для всех пользователей, но отдаётся только авторизованным
+CATALOG_CACHE_CONTROL = "private, no-cache"
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Совпадает ли If-None-Match клиента с текущей версией каталога"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = set()
+    for value in header.split(","):
+        value = value.strip()
+        candidates.add(value[2:] if value.startswith("W/") else value)
+    return "*" in candidates or etag in candidates
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL})
+
 
 @router.get("/", response_model=List[ProfessionResponse])
 async def get_professions(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    response: Response,
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить список всех активных профессий"""
-    professions = db.query(Profession).filter(Profession.is_active == True).all()
-    return professions
+    snapshot = await catalog.get()
+    if _etag_matches(request, snapshot.etag):
+        return _not_modified(snapshot.etag)
+    
+    response.headers["ETag"] = snapshot.etag
+    response.headers["Cache-Control"] = CATALOG_CACHE_CONTROL
+    return list(snapshot.active_professions)
 
 
 @router.get("/{profession_id}", response_model=ProfessionResponse)
 async def get_profession(
     profession_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    response: Response,
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить информацию о профессии"""
-    profession = db.query(Profession).filter(Profession.id == profession_id).first()
+    snapshot = await catalog.get()
+    profession = snapshot.profession_by_id.get(profession_id)
     if not profession:
         raise HTTPException(status_code=404, detail="Profession not found")
+    if _etag_matches(request, snapshot.etag):
+        return _not_modified(snapshot.etag)
+    
+    response.headers["ETag"] = snapshot.etag
+    response.headers["Cache-Control"] = CATALOG_CACHE_CONTROL
     return profession
 
 
 @router.get("/{profession_id}/progress", response_model=UserProgressResponse)
 async def get_profession_progress(
     profession_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить последнюю попытку прохождения профессии"""
     # Ищем последнюю попытку
-    progress = db.query(UserProgress).filter(
+    progress = await db.scalar(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
-    ).order_by(desc(UserProgress.attempt_number)).first()
+    ).order_by(desc(UserProgress.attempt_number)).limit(1))
     
     if not progress:
         # Создаём начальную попытку (attempt_number = 1)
@@ -56,8 +89,8 @@ async def get_profession_progress(
             status="not_started"
         )
         db.add(progress)
-        db.commit()
-        db.refresh(progress)
+        await db.commit()
+        await db.refresh(progress)
     
     return progress
 
@@ -65,14 +98,14 @@ async def get_profession_progress(
 @router.get("/{profession_id}/progress/history", response_model=ProgressHistoryResponse)
 async def get_progress_history(
     profession_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить историю всех попыток прохождения профессии"""
-    attempts = db.query(UserProgress).filter(
+    attempts = (await db.scalars(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
-    ).order_by(desc(UserProgress.attempt_number)).all()
+    ).order_by(desc(UserProgress.attempt_number)))).all()
     
     return ProgressHistoryResponse(
         profession_id=profession_id,
@@ -85,15 +118,15 @@ async def get_progress_history(
 async def get_specific_attempt(
     profession_id: int,
     attempt_number: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить конкретную попытку прохождения"""
-    progress = db.query(UserProgress).filter(
+    progress = await db.scalar(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id,
         UserProgress.attempt_number == attempt_number
-    ).first()
+    ).limit(1))
     
     if not progress:
         raise HTTPException(status_code=404, detail="Attempt not found")
@@ -104,20 +137,20 @@ async def get_specific_attempt(
 @router.post("/{profession_id}/progress/restart", response_model=UserProgressResponse)
 async def restart_profession(
     profession_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Начать новую попытку прохождения профессии"""
     # Проверяем существование профессии
-    profession = db.query(Profession).filter(Profession.id == profession_id).first()
+    profession = await db.get(Profession, profession_id)
     if not profession:
         raise HTTPException(status_code=404, detail="Profession not found")
     
     # Находим максимальный номер попытки
-    max_attempt = db.query(UserProgress).filter(
+    max_attempt = await db.scalar(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
-    ).order_by(desc(UserProgress.attempt_number)).first()
+    ).order_by(desc(UserProgress.attempt_number)).limit(1))
     
     next_attempt = (max_attempt.attempt_number + 1) if max_attempt else 1
     
@@ -128,11 +161,10 @@ async def restart_profession(
         attempt_number=next_attempt,
         status="in_progress",
         current_task_order=0,
-        conversation_history=[],
         started_at=datetime.utcnow()
     )
     db.add(new_progress)
-    db.commit()
-    db.refresh(new_progress)
+    await db.commit()
+    await db.refresh(new_progress)
     
     return new_progress
@@ -1,35 +1,70 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
-from sqlalchemy import desc
+from sqlalchemy import desc, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from datetime import datetime
-import json
+import asyncio
 import logging
-from app.database import get_db
-from app.models import User, Task, UserTask, UserProgress, Scenario, Profession, ReportTemplate
+from app.database import AsyncSessionLocal, get_async_db
+from app.models import UserTask, UserProgress
 from app.schemas import TaskResponse, UserTaskAnswer, UserTaskResponse
-from app.auth import get_current_active_user
-from app.ai_service import generate_task_question, generate_next_task_prompt, generate_final_report, generate_task_question_stream, generate_final_report_stream
+from app.auth import get_current_active_user, Principal
+from app.catalog import catalog
+from app.sse import sse_frame, TokenCoalescer
+from app.generation_jobs import generation_jobs
+from app.conversation import append_message, get_task_question, load_history
+from app.context_budget import history_compactor
+from app.speculation import load_next_step, prefix_warmer
+from app.semantic_cache import semantic_cache
+from app.llm_cache import replay_tokens
+from app.report_pipeline import evaluator, incremental_reports_enabled
+from app.transcript import AttemptTranscript
+from app.prompt_trace import traced_stream
+from app.telemetry import timed_stream
+from app.analytics import analytics
+from app.ai_service import (
+    QUESTION_FALLBACK_PREFIX,
+    generate_task_question_async,
+    generate_next_task_prompt,
+    generate_task_question_stream_async,
+    generate_final_report_stream_async,
+)
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+def _event_stream_response(frames) -> StreamingResponse:
+    return StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"  # Отключаем буферизацию в Nginx
+        }
+    )
+
+
+def _job_frames(job: str, produce, **trace_fields):
+    """Генератор кадров задачи генерации с телеметрией и контекстом трассировки промптов"""
+    return lambda stream_id: timed_stream(job, traced_stream(produce(stream_id), **trace_fields))
+
+
 @router.get("/profession/{profession_id}/current")
 async def get_current_task(
     profession_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить текущее задание для профессии и сгенерировать вопрос через AI (STREAMING)"""
     # Проверяем или создаем прогресс (берем последнюю попытку)
-    progress = db.query(UserProgress).filter(
+    progress = await db.scalar(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
-    ).order_by(desc(UserProgress.attempt_number)).first()
+    ).order_by(desc(UserProgress.attempt_number)).limit(1))
     
     if not progress:
         # Создаем новый прогресс
@@ -38,11 +73,12 @@ async def get_current_task(
             profession_id=profession_id,
             status="in_progress",
             current_task_order=0,
-            conversation_history=[],
             started_at=datetime.utcnow()
         )
         db.add(progress)
-        db.commit()
+        await db.commit()
+        analytics.emit("task_started", current_user.id, profession_id=profession_id, progress_id=progress.id,
+                       attempt_number=progress.attempt_number)
     else:
         # Если прогресс был создан заранее (например, после оплаты) как not_started,
         # то первый запрос за задачей является фактическим "стартом" симуляции.
@@ -50,414 +86,446 @@ async def get_current_task(
             progress.status = "in_progress"
             if not progress.started_at:
                 progress.started_at = datetime.utcnow()
-            db.commit()
+            await db.commit()
+            analytics.emit("task_started", current_user.id, profession_id=profession_id, progress_id=progress.id,
+                           attempt_number=progress.attempt_number)
     
-    # Получаем сценарий профессии
-    scenario = db.query(Scenario).filter(Scenario.profession_id == profession_id).first()
+    # Сценарий и задание берём из снимка каталога (без запросов к БД)
+    snapshot = await catalog.get()
+    scenario = snapshot.scenario_by_profession.get(profession_id)
     if not scenario:
         raise HTTPException(status_code=404, detail="Scenario not found")
     
     # Получаем задание по порядку
     next_order = progress.current_task_order + 1
-    task = db.query(Task).filter(
-        Task.scenario_id == scenario.id,
-        Task.order == next_order
-    ).first()
+    task = scenario.task_by_order(next_order)
     
     if not task:
         raise HTTPException(status_code=404, detail="No more tasks")
     
-    # Генерируем вопрос через AI (STREAMING)
-    conversation_history = progress.conversation_history or []
+    progress_id = progress.id
+    metadata = {
+        "type": "metadata",
+        "data": {
+            "id": task.id,
+            "order": task.order,
+            "task_type": task.type,
+            "time_limit_minutes": task.time_limit_minutes
+        }
+    }
     
-    async def event_generator():
-        try:
-            import asyncio
-            
-            # Проверяем, есть ли уже закешированный вопрос в истории
-            # Нужно найти вопрос, соответствующий task.order (1-indexed)
-            existing_question = None
-            if conversation_history:
-                # Собираем все assistant messages по порядку
-                assistant_messages = [
-                    msg.get("content")
-                    for msg in conversation_history
-                    if msg.get("role") == "assistant" and msg.get("content")
-                ]
-                # Для task с order=1 берем assistant_messages[0], для order=2 → [1], и т.д.
-                if len(assistant_messages) >= task.order:
-                    existing_question = assistant_messages[task.order - 1]
-            
-            if existing_question:
-                # Вопрос уже есть в кеше - отправляем сразу
-                metadata = {
-                    "type": "metadata",
-                    "data": {
-                        "id": task.id,
-                        "order": task.order,
-                        "task_type": task.type,
-                        "time_limit_minutes": task.time_limit_minutes
-                    }
+    # Проверяем, есть ли уже сохранённый вопрос для этого задания
+    existing_question = await get_task_question(db, progress_id, task.order)
+    
+    if existing_question:
+        # Вопрос уже есть в кеше - отправляем сразу
+        async def cached_question():
+            yield sse_frame(metadata)
+            done_data = {
+                "type": "done",
+                "data": {
+                    "full_text": existing_question,
+                    "task_id": task.id
                 }
-                yield f"data: {json.dumps(metadata, ensure_ascii=False)}\n\n"
+            }
+            yield sse_frame(done_data)
+            prefix_warmer.schedule(scenario.id, scenario.system_prompt)
+        
+        return _event_stream_response(cached_question())
+    
+    # Вопроса нет - генерируем через AI (STREAMING) в фоновой задаче
+    async def event_generator(stream_id: str):
+        # Собственная сессия: вопрос сохраняется, даже если клиент отключился
+        async with AsyncSessionLocal() as db:
+            try:
+                # 1. Сразу отправляем metadata (чтобы UI мог подготовиться)
+                yield sse_frame({**metadata, "data": {**metadata["data"], "stream_id": stream_id}})
+                
+                # 2. Стримим токены от OpenAI
+                conversation_history = await load_history(db, progress_id)
+                # Завершаем транзакцию: соединение не должно занимать пул на время стрима
+                await db.commit()
+                # Старые сообщения сверх бюджета токенов заменяются кратким содержанием
+                compaction = await history_compactor.fit(
+                    progress_id, scenario.system_prompt, conversation_history, task.description_template
+                )
+                coalescer = TokenCoalescer("token")
+                async for frame in coalescer.stream(generate_task_question_stream_async(
+                    system_prompt=scenario.system_prompt,
+                    task_description=task.description_template,
+                    conversation_history=compaction.history,
+                    # Первый вопрос сценария не зависит от пользователя - его можно кешировать
+                    cache_tags=(f"scenario:{scenario.id}", f"task:{task.id}")
+                )):
+                    yield frame
+                full_text = coalescer.text
+                
+                # 3. Сохраняем полный вопрос в историю
+                await append_message(db, progress_id, "assistant", full_text, task_order=task.order)
+                await db.commit()
                 
+                # 4. Отправляем завершающий сигнал
                 done_data = {
                     "type": "done",
                     "data": {
-                        "full_text": existing_question,
+                        "full_text": full_text,
                         "task_id": task.id
                     }
                 }
-                yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
-                return
-            
-            # Вопроса нет - стримим от OpenAI
-            import time
-            # 1. Сразу отправляем metadata (чтобы UI мог подготовиться)
-            metadata = {
-                "type": "metadata",
-                "data": {
-                    "id": task.id,
-                    "order": task.order,
-                    "task_type": task.type,
-                    "time_limit_minutes": task.time_limit_minutes
-                }
-            }
-            yield f"data: {json.dumps(metadata, ensure_ascii=False)}\n\n"
-            
-            # 2. Стримим токены от OpenAI
-            full_text = ""
-            for token in generate_task_question_stream(
-                system_prompt=scenario.system_prompt,
-                task_description=task.description_template,
-                conversation_history=conversation_history
-            ):
-                full_text += token
-                token_data = {
-                    "type": "token",
-                    "data": {"token": token}
-                }
-                yield f"data: {json.dumps(token_data, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(0)  # Force flush after each token
-            
-            # 3. Сохраняем полный вопрос в историю
-            conversation_history.append({
-                "role": "assistant",
-                "content": full_text
-            })
-            progress.conversation_history = conversation_history
-            # Явно помечаем JSON поле как измененное для SQLAlchemy
-            flag_modified(progress, 'conversation_history')
-            db.commit()
-            
-            # 4. Отправляем завершающий сигнал
-            done_data = {
-                "type": "done",
-                "data": {
-                    "full_text": full_text,
-                    "task_id": task.id
+                yield sse_frame(done_data)
+                
+                # 5. Пока пользователь отвечает, прогреваем prefix-кеш провайдера
+                prefix_warmer.schedule(scenario.id, scenario.system_prompt)
+                
+            except Exception as e:
+                logger.error(f"[STREAMING] Error in stream: {e}", exc_info=True)
+                error_data = {
+                    "type": "error",
+                    "data": {"message": str(e)}
                 }
-            }
-            yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
-            
-            
-        except Exception as e:
-            logger.error(f"[STREAMING] Error in stream: {e}", exc_info=True)
-            error_data = {
-                "type": "error",
-                "data": {"message": str(e)}
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                yield sse_frame(error_data)
     
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"  # Отключаем буферизацию в Nginx
-        }
+    # Повторный запрос за тем же вопросом подключается к уже идущей генерации
+    job = generation_jobs.submit(
+        (progress_id, task.order),
+        current_user.id,
+        _job_frames(
+            "get_current_task", event_generator,
+            user_id=current_user.id, scenario_id=scenario.id, progress_id=progress_id
+        )
     )
+    return _event_stream_response(generation_jobs.subscribe(job))
+
+
+@router.get("/streams/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    """Продолжить прерванный стрим: отдаёт кадры после Last-Event-ID (заголовок или параметр)"""
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header) if last_event_id_header else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    
+    frames = await generation_jobs.resume(stream_id, current_user.id, last_event_id)
+    if frames is None:
+        raise HTTPException(status_code=404, detail="Stream not found")
+    return _event_stream_response(frames)
 
 
 @router.post("/{task_id}/submit")
 async def submit_task_answer(
     task_id: int,
     answer_data: UserTaskAnswer,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Отправить ответ на задание и получить следующий вопрос или завершить (STREAMING)"""
-    task = db.query(Task).filter(Task.id == task_id).first()
+    snapshot = await catalog.get()
+    task = snapshot.task_by_id.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    scenario = db.query(Scenario).filter(Scenario.id == task.scenario_id).first()
+    scenario = snapshot.scenario_by_id.get(task.scenario_id)
     if not scenario:
         raise HTTPException(status_code=404, detail="Scenario not found")
     
     # Получаем прогресс (берем последнюю попытку) - СНАЧАЛА!
     profession_id = scenario.profession_id
-    progress = db.query(UserProgress).filter(
+    progress = await db.scalar(select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
-    ).order_by(desc(UserProgress.attempt_number)).first()
+    ).order_by(desc(UserProgress.attempt_number)).limit(1))
     
     if not progress:
         raise HTTPException(status_code=404, detail="Progress not found")
-    
+
+    # Повтор того же запроса (двойной клик, переподключение сразу после конца стрима):
+    # генерация уже записала ответ, поэтому подключаемся к ней до проверки ниже
+    job = generation_jobs.find((progress.id, task.order + 1), current_user.id)
+    if job is not None:
+        return _event_stream_response(generation_jobs.subscribe(job))
+
     # Проверяем, не отвечал ли уже пользователь в ТЕКУЩЕЙ попытке
-    existing_user_task = db.query(UserTask).filter(
+    existing_user_task = await db.scalar(select(UserTask).where(
         UserTask.progress_id == progress.id,
         UserTask.task_id == task_id
-    ).first()
+    ).limit(1))
     
     if existing_user_task:
         raise HTTPException(status_code=400, detail="Task already completed in this attempt")
     
-    async def process_and_stream():
-        try:
+    progress_id = progress.id
+    
+    async def process_and_stream(stream_id: str):
+        # Собственная сессия: генерация доводится до конца и сохраняется,
+        # даже если клиент отключился и сессия запроса уже закрыта
+        async with AsyncSessionLocal() as db:
+            progress = await db.get(UserProgress, progress_id)
+            try:
             
-            # Получаем вопрос, который был задан (из последнего элемента conversation_history)
-            conversation_history = progress.conversation_history or []
-            last_ai_message = ""
-            if conversation_history:
-                # Ищем последнее сообщение от assistant
-                for msg in reversed(conversation_history):
-                    if msg.get("role") == "assistant":
-                        last_ai_message = msg.get("content", "")
-                        break
+                # Получаем вопрос, который был задан по этому заданию
+                last_ai_message = await get_task_question(db, progress.id, task.order) or ""
             
-            # Если не нашли в истории, генерируем заново (fallback)
-            if not last_ai_message:
-                last_ai_message = generate_task_question(
-                    system_prompt=scenario.system_prompt,
-                    task_description=task.description_template,
-                    conversation_history=[]
+                # Если не нашли в истории, генерируем заново (fallback)
+                if not last_ai_message:
+                    last_ai_message = await generate_task_question_async(
+                        system_prompt=scenario.system_prompt,
+                        task_description=task.description_template,
+                        conversation_history=[]
+                    )
+            
+                # ВАЖНО: Сначала делаем ВСЕ DB операции!
+                # Сохраняем ответ пользователя
+                user_task = UserTask(
+                    user_id=current_user.id,
+                    task_id=task_id,
+                    progress_id=progress.id,
+                    attempt_number=progress.attempt_number,
+                    question=last_ai_message,
+                    answer=answer_data.answer,
+                    completed_at=datetime.utcnow()
                 )
+                db.add(user_task)
             
-            # ВАЖНО: Сначала делаем ВСЕ DB операции!
-            # Сохраняем ответ пользователя
-            user_task = UserTask(
-                user_id=current_user.id,
-                task_id=task_id,
-                progress_id=progress.id,
-                attempt_number=progress.attempt_number,
-                question=last_ai_message,
-                answer=answer_data.answer,
-                completed_at=datetime.utcnow()
-            )
-            db.add(user_task)
+                # Добавляем ответ пользователя в историю диалога
+                await append_message(
+                    db, progress.id, "user",
+                    f"Пользователь ответил на задание №{task.order}: {answer_data.answer}"
+                )
             
-            # Добавляем ответ пользователя в историю диалога
-            conversation_history.append({
-                "role": "user",
-                "content": f"Пользователь ответил на задание №{task.order}: {answer_data.answer}"
-            })
+                # Обновляем прогресс
+                progress.current_task_order = task.order
             
-            # Обновляем прогресс
-            progress.current_task_order = task.order
-            progress.conversation_history = conversation_history
+                # ВАЖНО: Коммитим СРАЗУ, чтобы сохранить UserTask и ответ пользователя
+                # Даже если генерация следующего вопроса прервется, данные будут в БД
+                await db.commit()
+                analytics.emit("answer_submitted", current_user.id, progress_id=progress.id, task_id=task_id,
+                               task_order=task.order, answer_length=len(answer_data.answer))
             
-            # ВАЖНО: Коммитим СРАЗУ, чтобы сохранить UserTask и ответ пользователя
-            # Даже если генерация следующего вопроса прервется, данные будут в БД
-            # Явно помечаем JSON поле как измененное для SQLAlchemy
-            flag_modified(progress, 'conversation_history')
-            db.commit()
+                # Следующее задание и шаблон отчёта - из снимка каталога (см. app/speculation.py)
+                next_step = await load_next_step(scenario.id, task.order)
             
-            # Проверяем, есть ли еще задания
-            total_tasks = db.query(Task).filter(Task.scenario_id == scenario.id).count()
+                # Краткая оценка ответа для инкрементального отчёта (map-шаг, в фоне).
+                # Ответ на последнее задание попадает в отчёт целиком - ждать его оценку незачем
+                report_template_text = next_step.report_template_text
+                if (
+                    incremental_reports_enabled()
+                    and report_template_text
+                    and not next_step.is_last
+                ):
+                    evaluator.schedule(
+                        user_task.id, scenario.system_prompt, report_template_text,
+                        task.order, last_ai_message, answer_data.answer
+                    )
             
-            if task.order >= total_tasks:
-                # Это было последнее задание - генерируем финальный отчёт
+                # Проверяем, есть ли еще задания
+                if next_step.is_last:
+                    # Это было последнее задание - генерируем финальный отчёт
                 
-                # ВАЖНО: Сразу отправляем metadata, чтобы скрыть прогресс-бар!
+                    # ВАЖНО: Сразу отправляем metadata, чтобы скрыть прогресс-бар!
                 
-                report_metadata = {
-                    "type": "metadata",
-                    "data": {
-                        "completed": True,
-                        "generating_report": True
+                    report_metadata = {
+                        "type": "metadata",
+                        "data": {
+                            "completed": True,
+                            "generating_report": True,
+                            "stream_id": stream_id
+                        }
                     }
-                }
-                yield f"data: {json.dumps(report_metadata, ensure_ascii=False)}\n\n"
-                import asyncio
-                await asyncio.sleep(0)  # Force flush to network
-                
-                # Получаем шаблон отчета
-                report_template_obj = db.query(ReportTemplate).filter(
-                    ReportTemplate.profession_id == profession_id
-                ).first()
-                
-                if not report_template_obj:
-                    raise HTTPException(status_code=404, detail="Report template not found")
+                    yield sse_frame(report_metadata)
+                    await asyncio.sleep(0)  # Force flush to network
                 
-                # Собираем все задания и ответы
-                all_user_tasks = db.query(UserTask).join(Task).filter(
-                    UserTask.user_id == current_user.id,
-                    Task.scenario_id == scenario.id
-                ).order_by(Task.order).all()
+                    # Шаблон отчета
+                    if not report_template_text:
+                        raise HTTPException(status_code=404, detail="Report template not found")
                 
-                all_tasks = [
-                    {"question": ut.question, "answer": ut.answer}
-                    for ut in all_user_tasks if ut.question and ut.answer
-                ]
+                    # Собираем задания и ответы ТЕКУЩЕЙ попытки
+                    transcript = await AttemptTranscript.load(db, progress.id)
+                    all_tasks = transcript.as_report_tasks()
+                    # Завершаем транзакцию: соединение не должно занимать пул на время стрима
+                    await db.commit()
                 
-                # Генерируем финальный отчёт (STREAMING!)
-                full_report = ""
-                token_count = 0
-                for token in generate_final_report_stream(
-                    system_prompt=scenario.system_prompt,
-                    report_template=report_template_obj.template_text,
-                    all_tasks=all_tasks
-                ):
-                    token_count += 1
-                    full_report += token
-                    token_data = {
-                        "type": "report_token",
-                        "data": {"token": token}
-                    }
-                    yield f"data: {json.dumps(token_data, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)  # Force flush after each token
+                    # Генерируем финальный отчёт (STREAMING!)
+                    coalescer = TokenCoalescer("report_token")
+                    async for frame in coalescer.stream(generate_final_report_stream_async(
+                        system_prompt=scenario.system_prompt,
+                        report_template=report_template_text,
+                        all_tasks=all_tasks,
+                        # reduce-шаг по кратким оценкам (см. app/report_pipeline.py)
+                        use_evaluations=incremental_reports_enabled()
+                    )):
+                        yield frame
+                    full_report = coalescer.text
                 
-                progress.status = "completed"
-                progress.completed_at = datetime.utcnow()
-                progress.final_report = full_report
-                progress.conversation_history = []  # Очищаем историю после завершения
-                # Явно помечаем JSON поле как измененное для SQLAlchemy
-                flag_modified(progress, 'conversation_history')
+                    progress.status = "completed"
+                    progress.completed_at = datetime.utcnow()
+                    progress.final_report = full_report
                 
-                db.commit()
+                    await db.commit()
+                    analytics.emit("report_generated", current_user.id, profession_id=profession_id,
+                                   progress_id=progress.id, report_length=len(full_report))
                 
-                done_data = {
-                    "type": "completed",
-                    "data": {"final_report": full_report}
-                }
-                yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
-            else:
-                # Есть еще задания - генерируем следующий вопрос (STREAMING!)
-                next_task = db.query(Task).filter(
-                    Task.scenario_id == scenario.id,
-                    Task.order == task.order + 1
-                ).first()
+                    done_data = {
+                        "type": "completed",
+                        "data": {"final_report": full_report}
+                    }
+                    yield sse_frame(done_data)
+                else:
+                    # Есть еще задания - генерируем следующий вопрос (STREAMING!)
+                    next_task = next_step.next_task
                 
-                if next_task:
-                    # Формируем промпт для следующего задания
-                    next_prompt = generate_next_task_prompt(
-                        current_task_order=task.order,
-                        user_answer=answer_data.answer,
-                        next_task_description=next_task.description_template
-                    )
+                    if next_task:
+                        # Формируем промпт для следующего задания
+                        next_prompt = generate_next_task_prompt(
+                            current_task_order=task.order,
+                            user_answer=answer_data.answer,
+                            next_task_description=next_task.description_template
+                        )
                     
-                    # Добавляем промпт в историю как user message
-                    conversation_history.append({
-                        "role": "user",
-                        "content": next_prompt
-                    })
+                        # ВАЖНО: СРАЗУ отправляем metadata (до OpenAI streaming!)
+                        # Это позволит UI скрыть прогресс-бар немедленно!
                     
-                    # ВАЖНО: СРАЗУ отправляем metadata (до OpenAI streaming!)
-                    # Это позволит UI скрыть прогресс-бар немедленно!
-                    
-                    metadata = {
-                        "type": "metadata",
-                        "data": {
-                            "id": next_task.id,
-                            "order": next_task.order,
-                            "task_type": next_task.type,
-                            "time_limit_minutes": next_task.time_limit_minutes,
-                            "completed": False
+                        metadata = {
+                            "type": "metadata",
+                            "data": {
+                                "id": next_task.id,
+                                "order": next_task.order,
+                                "task_type": next_task.type,
+                                "time_limit_minutes": next_task.time_limit_minutes,
+                                "completed": False,
+                                "stream_id": stream_id
+                            }
                         }
-                    }
-                    yield f"data: {json.dumps(metadata, ensure_ascii=False)}\n\n"
-                    import asyncio
-                    await asyncio.sleep(0)  # Force flush to network
+                        yield sse_frame(metadata)
+                        await asyncio.sleep(0)  # Force flush to network
                     
-                    # Теперь стримим следующий вопрос от OpenAI
-                    full_text = ""
-                    for token in generate_task_question_stream(
-                        system_prompt=scenario.system_prompt,
-                        task_description=next_prompt,
-                        conversation_history=[]  # Не передаем историю, т.к. она уже в промпте
-                    ):
-                        full_text += token
-                        token_data = {
-                            "type": "token",
-                            "data": {"token": token}
-                        }
-                        yield f"data: {json.dumps(token_data, ensure_ascii=False)}\n\n"
-                        await asyncio.sleep(0)  # Force flush after each token
+                        # Семантический кеш: встречался ли уже похожий ответ на это задание
+                        answer_vector = None
+                        match = None
+                        if semantic_cache.enabled:
+                            try:
+                                answer_vector = await semantic_cache.embed(answer_data.answer)
+                                match = await semantic_cache.lookup(task.id, answer_vector)
+                            except Exception as e:
+                                logger.warning(f"Semantic cache unavailable: {e}")
                     
-                    # Сохраняем вопрос AI в истории
-                    conversation_history.append({
-                        "role": "assistant",
-                        "content": full_text
-                    })
+                        served_from_cache = bool(match and semantic_cache.is_servable(match))
+                        if served_from_cache:
+                            token_source = replay_tokens(match.follow_up)
+                        else:
+                            # Похожая пара (ответ → вопрос) передаётся как few-shot пример
+                            hint_history = []
+                            if match:
+                                hint_history = [
+                                    {
+                                        "role": "user",
+                                        "content": generate_next_task_prompt(
+                                            current_task_order=task.order,
+                                            user_answer=match.answer,
+                                            next_task_description=next_task.description_template
+                                        )
+                                    },
+                                    {"role": "assistant", "content": match.follow_up},
+                                ]
+                            # Историю диалога не передаем, т.к. она уже в промпте
+                            token_source = generate_task_question_stream_async(
+                                system_prompt=scenario.system_prompt,
+                                task_description=next_prompt,
+                                conversation_history=hint_history
+                            )
                     
-                    progress.conversation_history = conversation_history
-                    # Явно помечаем JSON поле как измененное для SQLAlchemy
-                    flag_modified(progress, 'conversation_history')
-                    db.commit()
+                        # Теперь стримим следующий вопрос
+                        coalescer = TokenCoalescer("token")
+                        async for frame in coalescer.stream(token_source):
+                            yield frame
+                        full_text = coalescer.text
                     
-                    done_data = {
-                        "type": "done",
-                        "data": {
-                            "full_text": full_text,
-                            "task_id": next_task.id,
-                            "completed": False
+                        # Сохраняем промпт (user message) и вопрос AI в истории - после стрима,
+                        # чтобы транзакция не держала соединение на время генерации
+                        await append_message(db, progress.id, "user", next_prompt)
+                        await append_message(db, progress.id, "assistant", full_text, task_order=next_task.order)
+                        await db.commit()
+                    
+                        if (
+                            answer_vector is not None
+                            and not served_from_cache
+                            and full_text
+                            and not full_text.startswith(QUESTION_FALLBACK_PREFIX)
+                        ):
+                            await semantic_cache.store(
+                                task.id, answer_vector,
+                                question=last_ai_message,
+                                answer=answer_data.answer,
+                                follow_up=full_text
+                            )
+                    
+                        done_data = {
+                            "type": "done",
+                            "data": {
+                                "full_text": full_text,
+                                "task_id": next_task.id,
+                                "completed": False
+                            }
                         }
-                    }
-                    yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
+                        yield sse_frame(done_data)
                     
-                else:
-                    # Нет следующего задания (не должно происходить)
-                    db.commit()
-                    done_data = {
-                        "type": "done",
-                        "data": {
-                            "message": "Task submitted successfully",
-                            "completed": False
+                    else:
+                        # Нет следующего задания (не должно происходить)
+                        await db.commit()
+                        done_data = {
+                            "type": "done",
+                            "data": {
+                                "message": "Task submitted successfully",
+                                "completed": False
+                            }
                         }
-                    }
-                    yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
+                        yield sse_frame(done_data)
         
-        except Exception as e:
-            logger.error(f"[STREAMING] Error in submit stream: {e}", exc_info=True)
-            error_data = {
-                "type": "error",
-                "data": {"message": str(e)}
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+            except Exception as e:
+                logger.error(f"[STREAMING] Error in submit stream: {e}", exc_info=True)
+                error_data = {
+                    "type": "error",
+                    "data": {"message": str(e)}
+                }
+                yield sse_frame(error_data)
     
-    return StreamingResponse(
-        process_and_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"  # Отключаем буферизацию в Nginx
-        }
+    # Ключ - генерируемый шаг (следующий вопрос или отчёт): повторная отправка того же
+    # ответа и get_current_task за этим вопросом подключаются к той же генерации
+    job = generation_jobs.submit(
+        (progress_id, task.order + 1),
+        current_user.id,
+        _job_frames(
+            "submit_task_answer", process_and_stream,
+            user_id=current_user.id, scenario_id=scenario.id, progress_id=progress_id
+        )
     )
+    return _event_stream_response(generation_jobs.subscribe(job))
 
 
 @router.get("/profession/{profession_id}/report")
 async def get_final_report(
     profession_id: int,
     attempt_number: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить финальный отчёт по профессии (по умолчанию - последняя попытка)"""
-    query = db.query(UserProgress).filter(
+    query = select(UserProgress).where(
         UserProgress.user_id == current_user.id,
         UserProgress.profession_id == profession_id
     )
     
     if attempt_number:
         # Конкретная попытка
-        progress = query.filter(UserProgress.attempt_number == attempt_number).first()
+        progress = await db.scalar(query.where(UserProgress.attempt_number == attempt_number).limit(1))
     else:
         # Последняя попытка
-        progress = query.order_by(desc(UserProgress.attempt_number)).first()
+        progress = await db.scalar(query.order_by(desc(UserProgress.attempt_number)).limit(1))
     
     if not progress or progress.status != "completed":
         raise HTTPException(status_code=404, detail="Report not available")
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
 from app.models import User, UserProgress, Profession
 from app.schemas import UserResponse, UserProgressResponse
-from app.auth import get_current_active_user
+from app.auth import get_current_active_user, Principal
 from typing import List
 
 router = APIRouter()
@@ -11,18 +12,19 @@ router = APIRouter()
 
 @router.get("/me", response_model=UserResponse)
 async def get_current_user(
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    return current_user
+    return await db.get(User, current_user.id)
 
 
 @router.get("/progress", response_model=List[UserProgressResponse])
 async def get_user_progress(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Получить весь прогресс пользователя"""
-    progress_list = db.query(UserProgress).filter(
+    progress_list = (await db.scalars(select(UserProgress).where(
         UserProgress.user_id == current_user.id
-    ).all()
+    ))).all()
     return progress_list
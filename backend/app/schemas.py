@@ -31,6 +31,11 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 
+class UserAdminUpdate(BaseModel):
+    is_active: Optional[bool] = None
+    is_admin: Optional[bool] = None
+
+
 # Profession schemas
 class ProfessionBase(BaseModel):
     name: str
@@ -122,7 +127,6 @@ class UserProgressResponse(BaseModel):
     attempt_number: int
     status: str
     current_task_order: int
-    conversation_history: Optional[List[Dict[str, str]]]
     final_report: Optional[str]
     started_at: Optional[datetime]
     completed_at: Optional[datetime]
@@ -187,6 +191,20 @@ class PaymentResponse(BaseModel):
         from_attributes = True
 
 
+class WebhookEventResponse(BaseModel):
+    id: int
+    event_type: str
+    object_id: str
+    status: str
+    attempts: int
+    last_error: Optional[str]
+    received_at: datetime
+    processed_at: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
+
+
 # Package schemas
 class PackageBase(BaseModel):
     name: str
@@ -0,0 +1,223 @@
+"""
+Семантический кеш следующего вопроса по ответу пользователя
+
+Для каждого задания хранится эмбеддинг ответа и сгенерированный после него
+следующий вопрос. Если новый ответ на то же задание достаточно близок
+(косинусное сходство):
+  - >= SEMANTIC_CACHE_SERVE_THRESHOLD - следующий вопрос отдаётся из кеша;
+  - >= SEMANTIC_CACHE_HINT_THRESHOLD  - найденная пара передаётся модели как few-shot пример.
+
+Хранилище - таблица answer_embeddings (pgvector, ANN-индекс hnsw/ivfflat,
+см. database/migration_answer_embeddings.sql). Если в Postgres нет расширения
+vector, используется in-process индекс на NumPy - только для подсказок: он свой
+у каждого процесса и не очищается при правке в другом воркере, поэтому
+вопросы из него не отдаются.
+
+Следующий вопрос хранится под заданием, на которое ответили, но построен по
+следующему заданию - при правке задания сбрасываются и записи предыдущего
+(см. routers/admin.py).
+
+Кеш работает в собственных сессиях (AsyncSessionLocal), а не в сессии запроса:
+ошибка pgvector откатывает только запрос к кешу, а не незакоммиченные строки
+вызывающего кода (например, сообщение истории диалога).
+
+При правке задания или сценария в админке записи кеша этих заданий удаляются
+(invalidate_tasks) - как и response_cache.invalidate_tag.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import AnswerEmbedding
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SemanticMatch:
+    similarity: float
+    answer: str
+    follow_up: str
+
+
+def _normalize(vector) -> np.ndarray:
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    return arr / norm if norm else arr
+
+
+class NumpyCosineIndex:
+    """Простой индекс в памяти процесса: матрица нормированных векторов на задание"""
+
+    def __init__(self, max_items_per_task: int):
+        self.max_items_per_task = max_items_per_task
+        self._vectors: Dict[int, np.ndarray] = {}
+        self._payloads: Dict[int, List[Tuple[str, str]]] = {}
+
+    def add(self, task_id: int, vector, answer: str, follow_up: str) -> None:
+        row = _normalize(vector)[np.newaxis, :]
+        matrix = self._vectors.get(task_id)
+        payloads = self._payloads.setdefault(task_id, [])
+        matrix = row if matrix is None else np.vstack([matrix, row])
+        payloads.append((answer, follow_up))
+        # Держим только последние max_items_per_task записей
+        if len(payloads) > self.max_items_per_task:
+            matrix = matrix[-self.max_items_per_task:]
+            del payloads[:-self.max_items_per_task]
+        self._vectors[task_id] = matrix
+
+    def search(self, task_id: int, vector) -> Optional[SemanticMatch]:
+        matrix = self._vectors.get(task_id)
+        if matrix is None or not len(matrix):
+            return None
+        scores = matrix @ _normalize(vector)
+        best = int(np.argmax(scores))
+        answer, follow_up = self._payloads[task_id][best]
+        return SemanticMatch(similarity=float(scores[best]), answer=answer, follow_up=follow_up)
+
+    def remove(self, task_id: int) -> None:
+        self._vectors.pop(task_id, None)
+        self._payloads.pop(task_id, None)
+
+    def size(self) -> int:
+        return sum(len(p) for p in self._payloads.values())
+
+
+class PgVectorIndex:
+    """ANN-поиск по таблице answer_embeddings через оператор косинусного расстояния <=>"""
+
+    async def add(self, db: AsyncSession, task_id: int, vector, question: str, answer: str, follow_up: str) -> None:
+        db.add(AnswerEmbedding(
+            task_id=task_id,
+            question=question,
+            answer=answer,
+            follow_up=follow_up,
+            embedding=list(vector),
+        ))
+        await db.commit()
+
+    async def search(self, db: AsyncSession, task_id: int, vector) -> Optional[SemanticMatch]:
+        probes = int(settings.SEMANTIC_CACHE_INDEX_PROBES)
+        if settings.SEMANTIC_CACHE_INDEX == "ivfflat":
+            await db.execute(text(f"SET LOCAL ivfflat.probes = {probes}"))
+        else:
+            await db.execute(text(f"SET LOCAL hnsw.ef_search = {max(probes * 4, 40)}"))
+
+        distance = AnswerEmbedding.embedding.cosine_distance(list(vector))
+        row = (await db.execute(
+            select(AnswerEmbedding.answer, AnswerEmbedding.follow_up, distance.label("distance")).where(
+                AnswerEmbedding.task_id == task_id
+            ).order_by(distance).limit(1)
+        )).first()
+        if not row:
+            return None
+        return SemanticMatch(similarity=1.0 - float(row.distance), answer=row.answer, follow_up=row.follow_up)
+
+    async def remove(self, db: AsyncSession, task_ids: List[int]) -> None:
+        await db.execute(delete(AnswerEmbedding).where(AnswerEmbedding.task_id.in_(task_ids)))
+        await db.commit()
+
+
+class SemanticAnswerCache:
+    def __init__(self):
+        self._backend: Optional[str] = None
+        self._pg_index = PgVectorIndex()
+        self._np_index = NumpyCosineIndex(settings.SEMANTIC_CACHE_MAX_ITEMS_PER_TASK)
+        self._counters = {
+            "lookups": 0, "served": 0, "hinted": 0, "misses": 0, "stores": 0, "errors": 0, "invalidations": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return settings.SEMANTIC_CACHE_ENABLED
+
+    async def _resolve_backend(self, db: AsyncSession) -> str:
+        if self._backend is None:
+            try:
+                has_vector = (await db.execute(
+                    text("SELECT 1 FROM pg_extension WHERE extname = 'vector'")
+                )).first() is not None
+            except Exception:
+                has_vector = False
+            self._backend = "pgvector" if has_vector else "numpy"
+            logger.info("Semantic answer cache backend: %s", self._backend)
+        return self._backend
+
+    async def embed(self, text_value: str) -> List[float]:
+        from app.ai_service import async_client
+
+        response = await async_client.embeddings.create(
+            model=settings.SEMANTIC_CACHE_EMBEDDING_MODEL,
+            input=text_value,
+        )
+        return response.data[0].embedding
+
+    async def lookup(self, task_id: int, vector) -> Optional[SemanticMatch]:
+        """Ближайший ранее виденный ответ на задание, если он выше порога подсказки"""
+        self._counters["lookups"] += 1
+        try:
+            async with AsyncSessionLocal() as db:
+                if await self._resolve_backend(db) == "pgvector":
+                    match = await self._pg_index.search(db, task_id, vector)
+                else:
+                    match = self._np_index.search(task_id, vector)
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+
+        if match and self.is_servable(match):
+            self._counters["served"] += 1
+            return match
+        if match and match.similarity >= settings.SEMANTIC_CACHE_HINT_THRESHOLD:
+            self._counters["hinted"] += 1
+            return match
+        self._counters["misses"] += 1
+        return None
+
+    async def store(self, task_id: int, vector, question: str, answer: str, follow_up: str) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                if await self._resolve_backend(db) == "pgvector":
+                    await self._pg_index.add(db, task_id, vector, question, answer, follow_up)
+                else:
+                    self._np_index.add(task_id, vector, answer, follow_up)
+            self._counters["stores"] += 1
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning(f"Semantic cache store failed: {e}")
+
+    async def invalidate_tasks(self, task_ids: List[int]) -> None:
+        """Удаляет закешированные вопросы заданий (после правки задания или сценария)"""
+        if not task_ids:
+            return
+        self._counters["invalidations"] += 1
+        for task_id in task_ids:
+            self._np_index.remove(task_id)
+        try:
+            async with AsyncSessionLocal() as db:
+                if await self._resolve_backend(db) == "pgvector":
+                    await self._pg_index.remove(db, task_ids)
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning(f"Semantic cache invalidation failed: {e}")
+
+    def is_servable(self, match: SemanticMatch) -> bool:
+        # Индекс NumPy не согласован между процессами - из него только подсказки
+        return self._backend == "pgvector" and match.similarity >= settings.SEMANTIC_CACHE_SERVE_THRESHOLD
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "backend": self._backend,
+            "in_process_items": self._np_index.size(),
+        }
+
+
+semantic_cache = SemanticAnswerCache()
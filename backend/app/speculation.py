@@ -0,0 +1,153 @@
+"""
+Спекулятивный прогрев prefix-кеша провайдера и данные следующего шага
+
+Пока пользователь отвечает на задание N, вопрос N+1 заранее сгенерировать
+нельзя - он зависит от ответа, как и промпт следующего задания. Всё, что не
+зависит от ответа (следующее задание, шаблон отчёта), берётся из снимка
+каталога в памяти (load_next_step) - готовить и хранить это заранее незачем.
+
+Заранее имеет смысл только "прогреть" prefix-кеш провайдера запросом с тем же
+системным промптом, чтобы настоящий запрос после ответа получил кешированный
+префикс. Прогрев идёт в фоне, не чаще раза в SPECULATIVE_PREFETCH_INTERVAL_SECONDS
+на сценарий, и ничего не возвращает в обработчик запроса.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+
+from app.catalog import TaskEntry, catalog
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class NextStepContext:
+    """Контекст шага, следующего за заданием current_order"""
+    current_order: int
+    total_tasks: int
+    next_task: Optional[TaskEntry] = None
+    report_template_text: Optional[str] = None
+
+    @property
+    def is_last(self) -> bool:
+        return self.current_order >= self.total_tasks
+
+
+async def load_next_step(scenario_id: int, current_order: int) -> NextStepContext:
+    """Собирает из снимка каталога всё, что нужно submit_task_answer для шага после current_order"""
+    snapshot = await catalog.get()
+    scenario = snapshot.scenario_by_id.get(scenario_id)
+    ctx = NextStepContext(
+        current_order=current_order,
+        total_tasks=scenario.total_tasks if scenario else 0,
+    )
+    if scenario is None:
+        return ctx
+    # Шаблон нужен и на промежуточных шагах - для краткой оценки ответа (app/report_pipeline.py)
+    ctx.report_template_text = snapshot.report_template_by_profession.get(scenario.profession_id)
+    if not ctx.is_last:
+        ctx.next_task = scenario.task_by_order(current_order + 1)
+    return ctx
+
+
+class PrefixWarmer:
+    """Ограниченный пул фоновых запросов прогрева, не чаще interval_seconds на сценарий"""
+
+    def __init__(self, max_workers: int, max_pending: int, interval_seconds: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.interval_seconds = interval_seconds
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._jobs: Set[asyncio.Task] = set()
+        self._in_flight: Set[int] = set()
+        self._warmed_at: Dict[int, float] = {}
+        self._counters = {
+            "scheduled": 0,
+            "skipped_recent": 0,
+            "rejected": 0,
+            "failed": 0,
+            "warmup_tokens": 0,
+        }
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Создаём лениво, внутри работающего event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    def schedule(self, scenario_id: int, system_prompt: str) -> bool:
+        """Запланировать прогрев системного промпта сценария. Возвращает False, если прогрев не запущен"""
+        if not settings.SPECULATIVE_PREFETCH_ENABLED:
+            return False
+        if scenario_id in self._in_flight:
+            return False
+        warmed_at = self._warmed_at.get(scenario_id)
+        if warmed_at is not None and time.monotonic() - warmed_at < self.interval_seconds:
+            self._counters["skipped_recent"] += 1
+            return False
+        if len(self._jobs) >= self.max_pending:
+            self._counters["rejected"] += 1
+            return False
+
+        self._counters["scheduled"] += 1
+        self._in_flight.add(scenario_id)
+        job = asyncio.create_task(self._run(scenario_id, system_prompt))
+        self._jobs.add(job)
+        job.add_done_callback(self._jobs.discard)
+        return True
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self._counters,
+            "in_flight": len(self._jobs),
+            "scenarios_warmed": len(self._warmed_at),
+        }
+
+    def _evict_stale(self, now: float) -> None:
+        for scenario_id, warmed_at in list(self._warmed_at.items()):
+            if now - warmed_at >= self.interval_seconds:
+                del self._warmed_at[scenario_id]
+
+    async def _run(self, scenario_id: int, system_prompt: str) -> None:
+        try:
+            async with self._get_semaphore():
+                tokens = await _warm_provider_prefix(system_prompt)
+                self._counters["warmup_tokens"] += tokens
+                now = time.monotonic()
+                self._evict_stale(now)
+                self._warmed_at[scenario_id] = now
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.warning(f"Provider prefix warm-up failed for scenario {scenario_id}: {e}")
+        finally:
+            self._in_flight.discard(scenario_id)
+
+
+async def _warm_provider_prefix(system_prompt: str) -> int:
+    """Минимальный запрос с тем же префиксом, чтобы провайдер закешировал системный промпт"""
+    from app.ai_service import complete_async
+
+    # Тот же бэкенд и prompt_cache_key, что и у настоящих запросов сценария
+    response = await complete_async(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "."},
+        ],
+        temperature=None,
+        max_completion_tokens=1,
+        name="warm_provider_prefix",
+    )
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
+
+
+prefix_warmer = PrefixWarmer(
+    max_workers=settings.SPECULATIVE_PREFETCH_WORKERS,
+    max_pending=settings.SPECULATIVE_PREFETCH_MAX_PENDING,
+    interval_seconds=settings.SPECULATIVE_PREFETCH_INTERVAL_SECONDS,
+)
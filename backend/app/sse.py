@@ -0,0 +1,149 @@
+"""
+Формирование SSE-кадров для стриминговых эндпоинтов
+
+Токены LLM объединяются в кадры по временному окну (SSE_COALESCE_WINDOW_MS)
+или по объёму в байтах UTF-8 (SSE_COALESCE_MAX_BYTES): вместо кадра, json.dumps
+и переключения event loop на каждый токен - один кадр на группу токенов. Обёртка
+кадра закодирована заранее, сериализуется только текст. Полный текст копится в
+списке.
+
+Первый токен стрима отправляется сразу (время до первого токена не растёт).
+Окно отсчитывается таймером: если следующий токен не пришёл до конца окна
+(провайдер задумался), накопленное отправляется, не дожидаясь его.
+
+Бенчмарк: scripts/benchmark_sse_coalescing.py.
+
+Формат кадра не меняется: {"type": "token", "data": {"token": "..."}} - клиент
+просто получает более длинные "токены". При SSE_COALESCE_ENABLED=false
+поведение прежнее: один кадр на токен.
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from app.config import settings
+
+
+def sse_frame(payload: Dict[str, Any]) -> str:
+    """Сериализует служебное событие (metadata, done, error...) в SSE-кадр"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class TokenCoalescer:
+    """Склеивает токены в кадры и накапливает полный текст ответа"""
+
+    def __init__(
+        self,
+        event_type: str = "token",
+        enabled: Optional[bool] = None,
+        window_ms: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.enabled = settings.SSE_COALESCE_ENABLED if enabled is None else enabled
+        self.window = (settings.SSE_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self.max_bytes = settings.SSE_COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+        # Заранее закодированная обёртка кадра
+        self._prefix = 'data: {"type": %s, "data": {"token": ' % json.dumps(event_type)
+        self._suffix = "}}\n\n"
+        self._parts: List[str] = []
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._window_started = 0.0
+        self.frames = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def _encode(self, text: str) -> str:
+        self.frames += 1
+        return self._prefix + json.dumps(text, ensure_ascii=False) + self._suffix
+
+    def feed(self, token: str) -> Optional[str]:
+        """Добавляет токен; возвращает готовый кадр, если окно или лимит объёма исчерпаны"""
+        self._parts.append(token)
+        if not self.enabled:
+            return self._encode(token)
+
+        if not self._pending:
+            self._window_started = time.monotonic()
+        self._pending.append(token)
+        self._pending_bytes += len(token.encode("utf-8"))
+
+        if (
+            self._pending_bytes >= self.max_bytes
+            or time.monotonic() - self._window_started >= self.window
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Кадр из накопленных токенов (или None, если буфер пуст)"""
+        if not self._pending:
+            return None
+        frame = self._encode("".join(self._pending))
+        self._pending = []
+        self._pending_bytes = 0
+        return frame
+
+    def _remaining_window(self) -> float:
+        return max(self.window - (time.monotonic() - self._window_started), 0.0)
+
+    async def stream(self, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Превращает поток токенов в поток SSE-кадров"""
+        if not self.enabled:
+            async for token in tokens:
+                yield self.feed(token)
+                await asyncio.sleep(0)  # Force flush after each token
+            return
+
+        # Токены читает отдельная задача: ожидание очереди можно прервать по таймеру
+        # (wait_for), не отменяя чтение стрима LLM
+        queue: asyncio.Queue = asyncio.Queue()
+        pump = asyncio.ensure_future(_pump(tokens, queue))
+        first = True
+        try:
+            while True:
+                if not queue.empty():
+                    item = queue.get_nowait()
+                elif self._pending:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout=self._remaining_window())
+                    except asyncio.TimeoutError:
+                        # Провайдер задумался - отправляем накопленное, не дожидаясь токена
+                        yield self.flush()
+                        continue
+                else:
+                    item = await queue.get()
+
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                frame = self.feed(item)
+                if first:
+                    # Первый токен - сразу, чтобы не увеличивать время до первого токена
+                    first = False
+                    frame = frame or self.flush()
+                if frame is not None:
+                    yield frame
+        finally:
+            pump.cancel()
+        frame = self.flush()
+        if frame is not None:
+            yield frame
+
+
+_END = object()
+
+
+async def _pump(tokens: AsyncIterator[str], queue: asyncio.Queue) -> None:
+    try:
+        async for token in tokens:
+            queue.put_nowait(token)
+    except Exception as e:
+        queue.put_nowait(e)
+    else:
+        queue.put_nowait(_END)
@@ -0,0 +1,221 @@
+"""
+Возобновляемые SSE-стримы: брокер кадров между генерацией и подписчиками
+
+Генерация вопроса или отчёта выполняется фоновым воркером (см.
+app/generation_jobs.py) и публикует кадры в брокер. HTTP-ответы лишь
+подписываются на стрим: подписчиков может быть несколько (двойной клик,
+вторая вкладка), и отключение любого из них не прерывает генерацию.
+Каждый кадр получает "id: N", поэтому переподключившийся клиент передаёт
+Last-Event-ID и получает только недостающие кадры
+(GET /api/tasks/streams/{stream_id}) - без повторной платной генерации.
+
+Брокеры:
+  - LocalBroker - кольцевые буферы в памяти процесса (по умолчанию и для тестов);
+  - RedisBroker - дополнительно пишет кадры в Redis Streams (XADD/XREAD),
+    чтобы подписаться на стрим можно было через любой воркер
+    (включается SSE_RESUME_REDIS_URL).
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from app.config import settings
+from app.sse import sse_frame
+
+logger = logging.getLogger(__name__)
+
+# Кадр, который получает клиент, если нужные ему события уже вытеснены из буфера.
+# Клиент сбрасывает частичный текст и загружает шаг заново (см. STREAMING_IMPLEMENTATION.md)
+RESUME_GAP_FRAME = sse_frame({
+    "type": "error",
+    "data": {"message": "Stream history is no longer available", "code": "resume_gap"},
+})
+
+
+class ResumableStream:
+    """Кольцевой буфер кадров одного стрима с ожиданием новых событий"""
+
+    def __init__(self, stream_id: str, owner_id: int, max_events: int):
+        self.stream_id = stream_id
+        self.owner_id = owner_id
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._events: Deque[Tuple[int, str]] = deque(maxlen=max_events)
+        self._last_id = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def last_event_id(self) -> int:
+        return self._last_id
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, frame: str) -> Tuple[int, str]:
+        self._last_id += 1
+        event = (self._last_id, f"id: {self._last_id}\n{frame}")
+        self._events.append(event)
+        self._wake()
+        return event
+
+    def finish(self) -> None:
+        self.finished = True
+        self.finished_at = time.monotonic()
+        self._wake()
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[str]:
+        """Кадры с id > last_event_id; ждёт новые, пока стрим не завершится"""
+        self.subscribers += 1
+        try:
+            async for frame in self._follow(last_event_id):
+                yield frame
+        finally:
+            self.subscribers -= 1
+
+    async def _follow(self, cursor: int) -> AsyncIterator[str]:
+        while True:
+            # Событие берём до чтения буфера, чтобы не пропустить публикацию между ними
+            changed = self._changed
+            if self._events and cursor < self._events[0][0] - 1:
+                yield RESUME_GAP_FRAME
+                return
+            for event_id, frame in list(self._events):
+                if event_id > cursor:
+                    cursor = event_id
+                    yield frame
+            if self.finished and cursor >= self._last_id:
+                return
+            await changed.wait()
+
+
+class LocalBroker:
+    """Pub/sub в памяти процесса"""
+
+    name = "local"
+
+    def __init__(self, max_events: int, ttl_seconds: int):
+        self.max_events = max_events
+        self.ttl_seconds = ttl_seconds
+        self._streams: Dict[str, ResumableStream] = {}
+
+    def _evict_finished(self) -> None:
+        now = time.monotonic()
+        for stream_id, stream in list(self._streams.items()):
+            if stream.finished and now - stream.finished_at > self.ttl_seconds:
+                del self._streams[stream_id]
+
+    def open(self, stream_id: str, owner_id: int) -> ResumableStream:
+        self._evict_finished()
+        stream = ResumableStream(stream_id, owner_id, self.max_events)
+        self._streams[stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> Optional[ResumableStream]:
+        return self._streams.get(stream_id)
+
+    async def publish(self, stream_id: str, frame: str) -> None:
+        self._streams[stream_id].publish(frame)
+
+    async def finish(self, stream_id: str) -> None:
+        self._streams[stream_id].finish()
+
+    async def subscribe(self, stream_id: str, owner_id: int, last_event_id: int = 0) -> Optional[AsyncIterator[str]]:
+        """Итератор кадров после last_event_id или None, если стрим неизвестен или чужой"""
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.owner_id != owner_id:
+            return None
+        return stream.subscribe(last_event_id)
+
+    def stats(self) -> Dict[str, object]:
+        return {"backend": self.name, "buffered": len(self._streams)}
+
+
+class RedisBroker(LocalBroker):
+    """Локальные буферы + копия в Redis Streams для подписчиков из других воркеров"""
+
+    name = "redis"
+
+    def __init__(self, max_events: int, ttl_seconds: int, redis):
+        super().__init__(max_events, ttl_seconds)
+        self._redis = redis
+
+    @staticmethod
+    def _key(stream_id: str) -> str:
+        return f"sse:{stream_id}"
+
+    async def _xadd(self, stream_id: str, fields: Dict[str, object], owner_id: int) -> None:
+        key = self._key(stream_id)
+        try:
+            pipe = self._redis.pipeline()
+            pipe.xadd(key, fields, maxlen=self.max_events, approximate=True)
+            pipe.hset(f"{key}:meta", "owner_id", owner_id)
+            pipe.expire(key, self.ttl_seconds)
+            pipe.expire(f"{key}:meta", self.ttl_seconds)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"SSE broker (redis) publish failed: {e}")
+
+    async def publish(self, stream_id: str, frame: str) -> None:
+        stream = self._streams[stream_id]
+        event_id, stamped = stream.publish(frame)
+        await self._xadd(stream_id, {"id": event_id, "frame": stamped}, stream.owner_id)
+
+    async def finish(self, stream_id: str) -> None:
+        stream = self._streams[stream_id]
+        stream.finish()
+        await self._xadd(stream_id, {"id": stream.last_event_id, "end": 1}, stream.owner_id)
+
+    async def subscribe(self, stream_id: str, owner_id: int, last_event_id: int = 0) -> Optional[AsyncIterator[str]]:
+        if stream_id in self._streams:
+            return await super().subscribe(stream_id, owner_id, last_event_id)
+        try:
+            owner = await self._redis.hget(f"{self._key(stream_id)}:meta", "owner_id")
+        except Exception as e:
+            logger.warning(f"SSE broker (redis) lookup failed: {e}")
+            return None
+        if owner is None or int(owner) != owner_id:
+            return None
+        return self._follow_remote(stream_id, last_event_id)
+
+    async def _follow_remote(self, stream_id: str, cursor: int) -> AsyncIterator[str]:
+        """Чтение стрима, который генерируется в другом воркере"""
+        key = self._key(stream_id)
+        entries = await self._redis.xrange(key)
+        first = next((int(fields["id"]) for _, fields in entries if "frame" in fields), None)
+        if first is not None and cursor < first - 1:
+            yield RESUME_GAP_FRAME
+            return
+
+        last_redis_id = "0-0"
+        while True:
+            for redis_id, fields in entries:
+                last_redis_id = redis_id
+                if "end" in fields:
+                    return
+                event_id = int(fields["id"])
+                if event_id > cursor:
+                    cursor = event_id
+                    yield fields["frame"]
+            response = await self._redis.xread(
+                {key: last_redis_id}, block=settings.SSE_RESUME_BLOCK_MS, count=100
+            )
+            entries = response[0][1] if response else []
+            if not entries and not await self._redis.exists(key):
+                return
+
+
+def create_broker() -> LocalBroker:
+    max_events = settings.SSE_RESUME_BUFFER_EVENTS
+    ttl_seconds = settings.SSE_RESUME_TTL_SECONDS
+    if settings.SSE_RESUME_REDIS_URL:
+        try:
+            import redis.asyncio as redis_asyncio
+            redis = redis_asyncio.from_url(settings.SSE_RESUME_REDIS_URL, decode_responses=True)
+            return RedisBroker(max_events, ttl_seconds, redis)
+        except ImportError:
+            logger.warning("SSE_RESUME_REDIS_URL is set but redis package is not installed; using local broker")
+    return LocalBroker(max_events, ttl_seconds)
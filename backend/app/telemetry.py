@@ -0,0 +1,301 @@
+"""
+Телеметрия запросов: разбивка задержки по этапам и гистограммы Prometheus
+
+Каждый HTTP-запрос (TelemetryMiddleware) и каждая фоновая генерация
+(timed_stream) получают RequestTrace в contextvar. В него складываются:
+  - span("auth"), span("llm_completion"), время до первого токена LLM и т.п. -
+    этапы запроса, размеченные в коде;
+  - все SQL-запросы движков (события SQLAlchemy before/after_cursor_execute):
+    число, суммарное время и самый медленный;
+  - время коммита сессий (before/after_commit) - этап db_commit.
+Длительности одновременно попадают в гистограммы, которые отдаются в
+текстовом формате Prometheus на GET /metrics. Доступ к /metrics - по токену
+METRICS_BEARER_TOKEN и/или с адресов METRICS_ALLOWED_IPS (metrics_access_allowed);
+без них - только с loopback.
+
+Запрос или генерация дольше TELEMETRY_SLOW_REQUEST_SECONDS пишет в лог одну
+строку [TIMING] с разбивкой по этапам - по ней видно, где застрял 30-секундный
+запрос (БД, первый токен LLM, коммит), без передеплоя и включения отладки.
+
+Накладные расходы: несколько perf_counter и операций со словарём на этап и на
+SQL-запрос, без аллокаций на наблюдение в гистограмме.
+"""
+import contextvars
+import hmac
+import ipaddress
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str], buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # значения меток -> [счётчики корзин (не кумулятивные) + +Inf, сумма, количество]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for label_values, series in sorted(items):
+            base = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values))
+            prefix = base + "," if base else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{base}}}" if base else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-2]}")
+            lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+http_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request duration (for SSE - the whole stream)",
+    ("method", "route", "status"),
+)
+http_first_byte = Histogram(
+    "http_time_to_first_byte_seconds", "Time until the first response body byte", ("method", "route"),
+)
+span_duration = Histogram("span_duration_seconds", "Duration of marked request stages", ("span",))
+db_query_duration = Histogram("db_query_duration_seconds", "SQL statement duration", ("operation",))
+llm_first_token = Histogram("llm_time_to_first_token_seconds", "Time to the first LLM token", ("call",))
+llm_tokens_per_second = Histogram(
+    "llm_tokens_per_second", "LLM streaming rate after the first token", ("call",), buckets=RATE_BUCKETS,
+)
+job_duration = Histogram("generation_job_duration_seconds", "Background generation duration", ("job",))
+
+REGISTRY = (http_duration, http_first_byte, span_duration, db_query_duration, llm_first_token,
+            llm_tokens_per_second, job_duration)
+
+
+def render_prometheus() -> str:
+    lines: List[str] = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+_metrics_networks = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in settings.METRICS_ALLOWED_IPS.split(",") if item.strip()
+]
+
+
+def metrics_access_allowed(host: Optional[str], authorization: Optional[str]) -> bool:
+    """Проверка доступа к /metrics: заданные токен и список адресов должны совпасть оба.
+
+    Без METRICS_BEARER_TOKEN и METRICS_ALLOWED_IPS доступ только с loopback - за
+    reverse proxy на том же хосте /metrics нужно закрыть в самом прокси.
+    """
+    try:
+        address = ipaddress.ip_address(host or "")
+    except ValueError:
+        address = None
+    token = settings.METRICS_BEARER_TOKEN
+    if not token and not _metrics_networks:
+        return address is not None and address.is_loopback
+    if token and not hmac.compare_digest((authorization or "").encode(), f"Bearer {token}".encode()):
+        return False
+    if _metrics_networks and not (address is not None and any(address in network for network in _metrics_networks)):
+        return False
+    return True
+
+
+class RequestTrace:
+    __slots__ = ("name", "started", "spans", "db_queries", "db_seconds", "db_slowest")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.db_slowest = 0.0
+
+    def add_span(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_query(self, seconds: float) -> None:
+        self.db_queries += 1
+        self.db_seconds += seconds
+        self.db_slowest = max(self.db_slowest, seconds)
+
+    def summary(self, total: float) -> str:
+        parts = [f"{name}={seconds:.3f}s" for name, seconds in self.spans.items()]
+        parts.append(f"db={self.db_seconds:.3f}s ({self.db_queries} queries, slowest {self.db_slowest:.3f}s)")
+        return f"{self.name} {total:.3f}s: " + " ".join(parts)
+
+    def finish(self) -> float:
+        total = time.perf_counter() - self.started
+        if total >= settings.TELEMETRY_SLOW_REQUEST_SECONDS:
+            logger.warning("[TIMING] slow %s", self.summary(total))
+        return total
+
+
+_current: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str):
+    """Этап запроса: длительность идёт в текущий RequestTrace и в span_duration_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def record_span(name: str, seconds: float) -> None:
+    if not settings.TELEMETRY_ENABLED:
+        return
+    span_duration.observe(seconds, name)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, seconds)
+
+
+def record_llm_stream(call: str, first_token: Optional[float], tokens: int, total: float) -> None:
+    """Время до первого токена и скорость генерации стрима LLM"""
+    if not settings.TELEMETRY_ENABLED or first_token is None:
+        return
+    llm_first_token.observe(first_token, call)
+    record_span("llm_first_token", first_token)
+    generating = total - first_token
+    if tokens > 1 and generating > 0:
+        llm_tokens_per_second.observe(tokens / generating, call)
+
+
+async def timed_stream(job: str, frames: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Итерирует генератор кадров фоновой генерации под собственным RequestTrace"""
+    if not settings.TELEMETRY_ENABLED:
+        async for frame in frames:
+            yield frame
+        return
+    trace = RequestTrace(f"job {job}")
+    token = _current.set(trace)
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        job_duration.observe(trace.finish(), job)
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Генератор закрыт из другого контекста (например, при остановке воркеров)
+            pass
+
+
+def instrument_engine(engine) -> None:
+    """Время каждого SQL-запроса движка (sync Engine или AsyncEngine.sync_engine)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("telemetry_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["telemetry_started"].pop()
+        _record_query(statement, time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("telemetry_started"):
+            started = conn.info["telemetry_started"].pop()
+            _record_query(exception_context.statement or "", time.perf_counter() - started)
+
+
+def instrument_sessions() -> None:
+    """Время коммита (flush + COMMIT) каждой сессии - этап db_commit"""
+
+    @event.listens_for(Session, "before_commit")
+    def _before_commit(session):
+        session.info["telemetry_commit_started"] = time.perf_counter()
+
+    @event.listens_for(Session, "after_commit")
+    def _after_commit(session):
+        started = session.info.pop("telemetry_commit_started", None)
+        if started is not None:
+            record_span("db_commit", time.perf_counter() - started)
+
+
+def _record_query(statement: str, seconds: float) -> None:
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    if operation not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        operation = "OTHER"
+    db_query_duration.observe(seconds, operation)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_query(seconds)
+
+
+class TelemetryMiddleware:
+    """ASGI-middleware: RequestTrace на запрос, длительность и время до первого байта"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.TELEMETRY_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(f"{scope['method']} {scope['path']}")
+        token = _current.set(trace)
+        status = {"code": 500, "first_byte": None}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body" and status["first_byte"] is None:
+                status["first_byte"] = time.perf_counter() - trace.started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            total = trace.finish()
+            # Шаблон пути (scope["route"] выставляет FastAPI) - без id в метках
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_duration.observe(total, scope["method"], route, str(status["code"]))
+            if status["first_byte"] is not None:
+                http_first_byte.observe(status["first_byte"], scope["method"], route)
+            _current.reset(token)
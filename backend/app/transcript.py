@@ -0,0 +1,61 @@
+"""
+Вопросы и ответы одной попытки прохождения (для финального отчёта)
+
+Выборка ограничена progress_id - ответы прошлых попыток в отчёт не попадают -
+и выполняется одним запросом по индексу idx_user_tasks_progress
+(progress_id, task_id) с упорядочиванием по номеру задания.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Task, UserTask
+
+
+@dataclass(frozen=True)
+class TranscriptEntry:
+    task_order: int
+    question: str
+    answer: str
+    evaluation: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class AttemptTranscript:
+    progress_id: int
+    entries: Tuple[TranscriptEntry, ...]
+
+    @classmethod
+    async def load(cls, db: AsyncSession, progress_id: int) -> "AttemptTranscript":
+        """Упорядоченные по заданиям вопросы и ответы попытки (один запрос)"""
+        rows = (await db.execute(
+            select(UserTask.question, UserTask.answer, UserTask.evaluation, Task.order).join(
+                Task, Task.id == UserTask.task_id
+            ).where(
+                UserTask.progress_id == progress_id
+            ).order_by(Task.order)
+        )).all()
+        return cls(
+            progress_id=progress_id,
+            entries=tuple(
+                TranscriptEntry(
+                    task_order=row.order,
+                    question=row.question,
+                    answer=row.answer,
+                    evaluation=row.evaluation,
+                )
+                for row in rows if row.question and row.answer
+            ),
+        )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def as_report_tasks(self) -> List[Dict[str, Optional[str]]]:
+        """Формат all_tasks для generate_final_report_*"""
+        return [
+            {"question": e.question, "answer": e.answer, "evaluation": e.evaluation}
+            for e in self.entries
+        ]
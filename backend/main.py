@@ -1,7 +1,9 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 # Настройка логирования (должна быть как можно раньше, до импортов app.*)
@@ -11,9 +13,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-from app.database import engine, Base
+from app.database import async_engine, engine, Base
 from app.routers import auth, professions, tasks, admin, payments, users
 from app.config import settings
+from app.ai_service import close_async_client
+from app.payments.yukassa import yukassa_client
+from app.payments.webhook_inbox import webhook_inbox
+from app.payments.promocodes import promocode_guard
+from app.catalog import catalog
+from app.generation_jobs import generation_jobs
+from app.prompt_trace import prompt_tracer
+from app.analytics import analytics
+from app.telemetry import (
+    TelemetryMiddleware, instrument_engine, instrument_sessions, metrics_access_allowed, render_prometheus
+)
 
 security = HTTPBearer()
 
@@ -23,6 +36,7 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting application...")
     logger.info("DEBUG_OPENAI_PROMPTS=%s", settings.DEBUG_OPENAI_PROMPTS)
+    logger.info("PROMPT_TRACE_SAMPLE_RATE=%s", settings.PROMPT_TRACE_SAMPLE_RATE)
     
     # Валидация критических переменных окружения
     if not settings.OPENAI_API_KEY or settings.OPENAI_API_KEY == "":
@@ -37,18 +51,36 @@ async def lifespan(app: FastAPI):
     try:
         # Проверяем подключение к БД
         from sqlalchemy import text
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-            conn.commit()
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
         logger.info("✓ Database connection successful")
     except Exception as e:
         logger.error(f"⚠ Warning: Could not connect to database: {e}")
         logger.error("  Make sure PostgreSQL is running and DATABASE_URL is correct")
         logger.error("  The server will start, but database operations will fail")
     
+    try:
+        await catalog.refresh()
+        logger.info("✓ Catalog snapshot loaded")
+    except Exception as e:
+        logger.error(f"⚠ Warning: Could not load catalog snapshot: {e}")
+    catalog_refresher = asyncio.create_task(catalog.run_refresh_loop())
+    webhook_inbox.start()
+    analytics.start()
+    payment_expirer = asyncio.create_task(promocode_guard.run_expiry_loop())
+    
     yield
     # Shutdown
     logger.info("Shutting down application...")
+    catalog_refresher.cancel()
+    payment_expirer.cancel()
+    await generation_jobs.stop()
+    await webhook_inbox.stop()
+    await analytics.stop()
+    await close_async_client()
+    await yukassa_client.close()
+    prompt_tracer.close()
+    await async_engine.dispose()
 
 
 app = FastAPI(
@@ -72,6 +104,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Телеметрия: разбивка задержки запросов и SQL-запросов, гистограммы на /metrics
+if settings.TELEMETRY_ENABLED:
+    instrument_engine(async_engine.sync_engine)
+    instrument_engine(engine)
+    instrument_sessions()
+    app.add_middleware(TelemetryMiddleware)
+
 # Routers
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
@@ -89,3 +128,12 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "ok"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Гистограммы задержек в текстовом формате Prometheus"""
+    if not metrics_access_allowed(request.client.host if request.client else None,
+                                  request.headers.get("Authorization")):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
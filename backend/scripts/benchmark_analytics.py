@@ -0,0 +1,78 @@
+"""
+Бенчмарк конвейера аналитики (app/analytics.py), событий в секунду
+
+1. emit: скорость постановки событий в кольцевой буфер - то, что платит
+   обработчик запроса (без БД).
+2. flush: скорость записи в таблицу events пачками по --flush-size через COPY
+   и через многострочный INSERT. Нужна БД; с --no-db этап пропускается.
+   Записанные события (event_type=benchmark) после замера удаляются.
+
+Запуск (из каталога backend):
+    python -m scripts.benchmark_analytics --events 200000 --flush-size 500
+    python -m scripts.benchmark_analytics --events 200000 --no-db
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import delete
+
+from app.analytics import EventPipeline
+from app.database import async_engine
+from app.models import Event
+
+EVENT_TYPE = "benchmark"
+
+
+def fill(pipeline: EventPipeline, events: int) -> float:
+    started = time.perf_counter()
+    for i in range(events):
+        pipeline.emit(EVENT_TYPE, None, progress_id=i, task_id=i % 10, task_order=i % 10, answer_length=420)
+    return time.perf_counter() - started
+
+
+async def benchmark_flush(events: int, flush_size: int, use_copy: bool) -> None:
+    pipeline = EventPipeline(capacity=events, flush_size=flush_size, flush_interval=1.0, use_copy=use_copy)
+    fill(pipeline, events)
+    started = time.perf_counter()
+    written = await pipeline.flush()
+    elapsed = time.perf_counter() - started
+    method = "COPY" if use_copy else "INSERT"
+    print(f"flush {method:<6}: {written} events in {elapsed:.2f}s = {written / elapsed:,.0f} events/s "
+          f"({pipeline.stats()['batches']} batches, failed {pipeline.stats()['failed']})")
+
+
+async def run(args) -> None:
+    pipeline = EventPipeline(capacity=args.events, flush_size=args.flush_size, flush_interval=1.0, use_copy=True)
+    elapsed = fill(pipeline, args.events)
+    print(f"emit        : {args.events} events in {elapsed:.3f}s = {args.events / elapsed:,.0f} events/s "
+          f"({elapsed / args.events * 1e6:.2f} us/event)")
+
+    # Переполнение: буфер на 10% событий - emit не блокируется, старые вытесняются
+    small = EventPipeline(capacity=max(args.events // 10, 1), flush_size=args.flush_size, flush_interval=1.0,
+                          use_copy=True)
+    elapsed = fill(small, args.events)
+    print(f"emit (full) : {args.events / elapsed:,.0f} events/s, dropped {small.stats()['dropped']}")
+
+    if args.no_db:
+        return
+    try:
+        await benchmark_flush(args.events, args.flush_size, use_copy=True)
+        await benchmark_flush(args.events, args.flush_size, use_copy=False)
+    finally:
+        async with async_engine.begin() as conn:
+            await conn.execute(delete(Event).where(Event.event_type == EVENT_TYPE))
+        await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--no-db", action="store_true", help="Только emit, без записи в БД")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Бенчмарк бюджета токенов истории на синтетических сценариях
+
+Моделирует попытку из N заданий: на каждом шаге история растёт на вопрос AI,
+ответ пользователя и промпт следующего задания. Для каждого шага считаются
+токены промпта без сжатия и с HistoryCompactor. Вместо LLM используется
+офлайн-резюме (первые символы сжимаемых сообщений), поэтому скрипт не
+обращается ни к OpenAI, ни к БД.
+
+Запуск (из каталога backend):
+    python -m scripts.benchmark_context_budget --tasks 20 --scenarios 50 --budget 6000 --keep-last 6
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import List, Optional
+
+from app.context_budget import HistoryCompactor, Message, count_message_tokens
+
+WORDS = (
+    "проект команда сроки риск бюджет заказчик приоритет задача релиз качество "
+    "коммуникация конфликт руководитель план ресурсы метрика решение процесс"
+).split()
+
+
+def synthetic_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+async def offline_summary(previous: Optional[str], messages: List[Message]) -> str:
+    parts = [previous] if previous else []
+    parts.extend(m["content"][:80] for m in messages)
+    return " | ".join(parts)[-1200:]
+
+
+async def run_scenario(rng: random.Random, tasks: int, compactor: HistoryCompactor, key: int):
+    system_prompt = synthetic_text(rng, 400)
+    history: List[Message] = []
+    rows = []
+    for order in range(1, tasks + 1):
+        task_description = synthetic_text(rng, 120)
+        started = time.perf_counter()
+        result = await compactor.fit(key, system_prompt, history, task_description)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        full = count_message_tokens(
+            [{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": task_description}]
+        )
+        rows.append((order, full, result.tokens_after, elapsed_ms))
+
+        history.append({"role": "assistant", "content": synthetic_text(rng, 150)})
+        history.append({"role": "user", "content": f"Пользователь ответил на задание №{order}: {synthetic_text(rng, 200)}"})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--scenarios", type=int, default=50)
+    parser.add_argument("--budget", type=int, default=6000)
+    parser.add_argument("--keep-last", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    compactor = HistoryCompactor(args.budget, args.keep_last, offline_summary)
+
+    per_order = {}
+    for key in range(args.scenarios):
+        for order, full, compacted, elapsed_ms in asyncio.run(run_scenario(rng, args.tasks, compactor, key)):
+            per_order.setdefault(order, []).append((full, compacted, elapsed_ms))
+
+    print(f"{'task':>4} {'full':>8} {'compact':>8} {'saved':>6} {'fit ms':>7}")
+    for order, samples in sorted(per_order.items()):
+        full = sum(s[0] for s in samples) / len(samples)
+        compacted = sum(s[1] for s in samples) / len(samples)
+        elapsed = sum(s[2] for s in samples) / len(samples)
+        saved = 1 - compacted / full if full else 0.0
+        print(f"{order:>4} {full:>8.0f} {compacted:>8.0f} {saved:>6.1%} {elapsed:>7.2f}")
+
+    stats = compactor.stats()
+    print()
+    print(
+        f"tokenizer={stats['tokenizer']} requests={stats['requests']} compacted={stats['compacted']} "
+        f"saved_tokens={stats['saved_tokens']} "
+        f"({stats['saved_tokens'] / stats['tokens_before']:.1%} of prompt tokens)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Пропускная способность слоя БД: синхронная Session против AsyncSession (asyncpg)
+
+Имитирует обработчик запроса (async def), который делает --queries запросов к
+БД: выборку пользователя, заданий сценария и `SELECT pg_sleep(--query-ms)` -
+задержку сети/планировщика. --concurrency таких обработчиков запускаются
+одновременно в одном event loop, всего --requests запросов:
+
+- sync:  блокирующий SessionLocal внутри async def - как роутеры работали
+         раньше; пока идёт запрос к БД, loop стоит и остальные ждут;
+- async: AsyncSessionLocal (get_async_db) - запросы разных обработчиков идут
+         параллельно в пределах пула (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+
+Для каждого режима выводятся запросов в секунду, p50/p99 времени обработчика
+и наибольшая задержка event loop. Нужна БД; данные не изменяются.
+
+Запуск (из каталога backend):
+    python -m scripts.benchmark_db_sessions --requests 2000 --concurrency 100 --query-ms 2
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+from sqlalchemy import select, text
+
+from app.config import settings
+from app.database import AsyncSessionLocal, SessionLocal, async_engine, engine
+from app.models import Task, User
+
+LOOP_TICK = 0.01
+
+
+def statements(query_ms: float, queries: int):
+    sleep = text("SELECT pg_sleep(:seconds)").bindparams(seconds=query_ms / 1000)
+    base = [select(User).order_by(User.id).limit(1), select(Task).order_by(Task.id).limit(10), sleep]
+    return [base[i % len(base)] for i in range(queries)]
+
+
+async def sync_handler(query_ms: float, queries: int) -> None:
+    db = SessionLocal()
+    try:
+        for statement in statements(query_ms, queries):
+            db.execute(statement).all()
+    finally:
+        db.close()
+
+
+async def async_handler(query_ms: float, queries: int) -> None:
+    async with AsyncSessionLocal() as db:
+        for statement in statements(query_ms, queries):
+            (await db.execute(statement)).all()
+
+
+async def loop_lag_monitor(stop: asyncio.Event, lags: List[float]) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_TICK)
+        lags.append(time.perf_counter() - started - LOOP_TICK)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+async def run_mode(mode: str, args) -> None:
+    handler = sync_handler if mode == "sync" else async_handler
+    # Прогрев пула, чтобы не мерить установку соединений
+    await asyncio.gather(*(handler(0, 1) for _ in range(min(args.concurrency, 10))))
+
+    latencies: List[float] = []
+    lags: List[float] = []
+    remaining = args.requests
+
+    async def client() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await handler(args.query_ms, args.queries)
+            latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(loop_lag_monitor(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    print(f"{mode:<6} {len(latencies) / elapsed:>10.0f} {percentile(latencies, 0.5) * 1000:>9.1f}ms "
+          f"{percentile(latencies, 0.99) * 1000:>9.1f}ms {max(lags, default=0) * 1000:>11.0f}ms")
+
+
+async def run(args) -> None:
+    print(f"{args.requests} handlers x {args.queries} queries, concurrency {args.concurrency}, "
+          f"pg_sleep {args.query_ms} ms, pool {settings.DB_POOL_SIZE}+{settings.DB_MAX_OVERFLOW}")
+    print(f"{'mode':<6} {'req/s':>10} {'p50':>11} {'p99':>11} {'max loop lag':>13}")
+    try:
+        for mode in args.modes:
+            await run_mode(mode, args)
+    finally:
+        await async_engine.dispose()
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=3, help="Запросов к БД на один обработчик")
+    parser.add_argument("--query-ms", type=float, default=2.0, help="pg_sleep на каждый третий запрос")
+    parser.add_argument("--modes", nargs="+", choices=["sync", "async"], default=["sync", "async"])
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
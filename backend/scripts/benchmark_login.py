@@ -0,0 +1,135 @@
+"""
+Бенчмарк входа под нагрузкой: bcrypt в event loop против пула потоков (app/auth.py)
+
+--concurrency одновременных входов (по умолчанию 200), у каждого - проверка
+пароля с текущим BCRYPT_ROUNDS:
+
+- inline: verify_password прямо в async def - как login работал раньше,
+          каждый вход останавливает event loop на время bcrypt;
+- pool:   verify_password_async - пул PASSWORD_HASH_WORKERS потоков с
+          очередью PASSWORD_HASH_MAX_QUEUE (сверх неё - 503).
+
+Выводятся входов в секунду, p50/p99/max времени входа, число 503 и наибольшая
+задержка event loop - столько ждали бы все остальные запросы воркера.
+
+С --api-url вместо этого те же --concurrency запросов POST /api/auth/login
+отправляются на запущенный backend (нужен существующий пользователь).
+
+Запуск (из каталога backend):
+    python -m scripts.benchmark_login --concurrency 200
+    python -m scripts.benchmark_login --concurrency 200 --api-url http://localhost:8000 \\
+        --email user@example.com --password secret
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from typing import List
+
+from fastapi import HTTPException
+
+from app.auth import get_password_hash, password_pool_stats, verify_password, verify_password_async
+from app.config import settings
+
+LOOP_TICK = 0.01
+PASSWORD = "benchmark-password"
+
+
+async def loop_lag_monitor(stop: asyncio.Event, lags: List[float]) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_TICK)
+        lags.append(time.perf_counter() - started - LOOP_TICK)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+def report(mode: str, latencies: List[float], elapsed: float, outcomes: Counter, lags: List[float]) -> None:
+    print(f"{mode:<7} {len(latencies) / elapsed:>9.1f} {percentile(latencies, 0.5) * 1000:>8.0f}ms "
+          f"{percentile(latencies, 0.99) * 1000:>8.0f}ms {max(latencies, default=0) * 1000:>8.0f}ms "
+          f"{outcomes['503']:>5} {max(lags, default=0) * 1000:>11.0f}ms")
+
+
+async def measure(mode: str, concurrency: int, login) -> None:
+    latencies: List[float] = []
+    lags: List[float] = []
+    outcomes: Counter = Counter()
+
+    async def one() -> None:
+        started = time.perf_counter()
+        outcomes[await login()] += 1
+        latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(loop_lag_monitor(stop, lags))
+    # Даём монитору сделать первый тик до начала нагрузки
+    await asyncio.sleep(LOOP_TICK)
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    report(mode, latencies, elapsed, outcomes, lags)
+    unexpected = {k: v for k, v in outcomes.items() if k not in ("ok", "503")}
+    if unexpected:
+        print(f"        unexpected outcomes: {dict(unexpected)}")
+
+
+async def run_local(args) -> None:
+    hashed = get_password_hash(PASSWORD)
+
+    async def inline_login() -> str:
+        return "ok" if verify_password(PASSWORD, hashed) else "invalid"
+
+    async def pool_login() -> str:
+        try:
+            valid, _ = await verify_password_async(PASSWORD, hashed)
+        except HTTPException as e:
+            return str(e.status_code)
+        return "ok" if valid else "invalid"
+
+    print(f"{args.concurrency} concurrent logins, bcrypt rounds {settings.BCRYPT_ROUNDS}, "
+          f"pool {settings.PASSWORD_HASH_WORKERS} workers + queue {settings.PASSWORD_HASH_MAX_QUEUE}")
+    print(f"{'mode':<7} {'logins/s':>9} {'p50':>10} {'p99':>10} {'max':>10} {'503':>5} {'max loop lag':>13}")
+    for mode in args.modes:
+        await measure(mode, args.concurrency, inline_login if mode == "inline" else pool_login)
+    print(f"pool after run: {password_pool_stats()}")
+
+
+async def run_http(args) -> None:
+    import httpx
+
+    body = {"email": args.email, "password": args.password}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.api_url, timeout=120.0, limits=limits) as client:
+
+        async def http_login() -> str:
+            try:
+                response = await client.post("/api/auth/login", json=body)
+            except httpx.HTTPError as e:
+                return type(e).__name__
+            return "ok" if response.status_code == 200 else str(response.status_code)
+
+        print(f"{args.concurrency} concurrent POST {args.api_url}/api/auth/login")
+        print(f"{'mode':<7} {'logins/s':>9} {'p50':>10} {'p99':>10} {'max':>10} {'503':>5} {'client lag':>13}")
+        await measure("http", args.concurrency, http_login)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--modes", nargs="+", choices=["inline", "pool"], default=["inline", "pool"])
+    parser.add_argument("--api-url", help="Нагружать запущенный backend вместо локального замера")
+    parser.add_argument("--email")
+    parser.add_argument("--password")
+    args = parser.parse_args()
+    if args.api_url and not (args.email and args.password):
+        parser.error("--api-url requires --email and --password")
+    asyncio.run(run_http(args) if args.api_url else run_local(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Микро-бенчмарк склейки токенов в SSE-кадры (TokenCoalescer, app/sse.py)
+
+Синтетический поток русских токенов (2-6 символов) с заданным интервалом и
+одной паузой провайдера посреди ответа. Для режима "кадр на токен" и для
+склейки выводятся: число кадров и байт, время до первого кадра, наибольшая
+задержка отправки токена (от его получения до кадра) - она ограничена окном
+и не зависит от паузы, - и процессорное время на 1000 токенов при нулевом
+интервале. Ни LLM, ни БД не нужны.
+
+Запуск (из каталога backend):
+    python -m scripts.benchmark_sse_coalescing --tokens 2000 --interval-ms 5 --stall-ms 500
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import List
+
+from app.sse import TokenCoalescer
+
+SYLLABLES = "про ект ком анда сро ки рис к бюд жет за каз чик при ори тет ре лиз ка чес тво".split()
+
+
+def synthetic_tokens(count: int, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    return [rng.choice(SYLLABLES) + (" " if rng.random() < 0.3 else "") for _ in range(count)]
+
+
+async def token_source(tokens: List[str], interval: float, stall: float, arrivals: List[float]):
+    for i, token in enumerate(tokens):
+        if i == len(tokens) // 2 and stall:
+            await asyncio.sleep(stall)
+        elif interval:
+            await asyncio.sleep(interval)
+        arrivals.append(time.perf_counter())
+        yield token
+
+
+async def run_timed(tokens: List[str], enabled: bool, args) -> dict:
+    coalescer = TokenCoalescer("token", enabled=enabled, window_ms=args.window_ms, max_bytes=args.max_bytes)
+    arrivals: List[float] = []
+    started = time.perf_counter()
+    first_frame = None
+    frames = 0
+    sent_bytes = 0
+    worst_delay = 0.0
+    delivered = 0
+    async for frame in coalescer.stream(token_source(tokens, args.interval_ms / 1000, args.stall_ms / 1000, arrivals)):
+        now = time.perf_counter()
+        first_frame = first_frame if first_frame is not None else now - started
+        frames += 1
+        sent_bytes += len(frame.encode("utf-8"))
+        # Все полученные к этому моменту токены ушли в этом кадре
+        for arrived in arrivals[delivered:]:
+            worst_delay = max(worst_delay, now - arrived)
+        delivered = len(arrivals)
+    assert coalescer.text == "".join(tokens)
+    return {
+        "frames": frames,
+        "bytes": sent_bytes,
+        "first_frame_ms": (first_frame or 0) * 1000,
+        "worst_delay_ms": worst_delay * 1000,
+    }
+
+
+async def run_cpu(tokens: List[str], enabled: bool, args) -> float:
+    async def instant():
+        for token in tokens:
+            yield token
+
+    coalescer = TokenCoalescer("token", enabled=enabled, window_ms=args.window_ms, max_bytes=args.max_bytes)
+    started = time.process_time()
+    async for _ in coalescer.stream(instant()):
+        pass
+    return (time.process_time() - started) / len(tokens) * 1000 * 1000
+
+
+async def run(args) -> None:
+    tokens = synthetic_tokens(args.tokens)
+    print(f"{args.tokens} tokens, interval {args.interval_ms} ms, stall {args.stall_ms} ms, "
+          f"window {args.window_ms} ms, max {args.max_bytes} bytes")
+    print(f"{'mode':<10} {'frames':>7} {'bytes':>9} {'first frame':>12} {'worst delay':>12} {'cpu/1000 tok':>13}")
+    for enabled in (False, True):
+        timed = await run_timed(tokens, enabled, args)
+        cpu = await run_cpu(tokens, enabled, args)
+        print(f"{'coalesce' if enabled else 'per-token':<10} {timed['frames']:>7} {timed['bytes']:>9} "
+              f"{timed['first_frame_ms']:>10.1f}ms {timed['worst_delay_ms']:>10.1f}ms {cpu:>11.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--interval-ms", type=float, default=5.0)
+    parser.add_argument("--stall-ms", type=float, default=500.0)
+    parser.add_argument("--window-ms", type=int, default=30)
+    parser.add_argument("--max-bytes", type=int, default=512)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Проверка повторов клиента ЮKassa (app/payments/yukassa.py) без сети
+
+YukassaClient получает httpx.MockTransport, который отвечает по сценарию, и
+записывает каждый запрос. Проверяется:
+
+- 503, 500, затем 200 - платёж создан с третьей попытки;
+- 202 с retry_after в теле - следующая попытка не раньше указанного времени;
+- сетевая ошибка, затем 200;
+- 400 - без повторов, YukassaError со status_code;
+- 503 на всех попытках - ровно YUKASSA_RETRY_ATTEMPTS запросов, затем YukassaError;
+- GET статуса повторяется и без Idempotence-Key.
+
+Во всех сценариях каждая попытка создания платежа несёт один и тот же
+Idempotence-Key. Ни ключи ЮKassa, ни БД не нужны; при ошибке - код выхода 1.
+
+Запуск (из каталога backend):
+    python -m scripts.check_yukassa_retries
+"""
+import asyncio
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+import httpx
+
+from app.config import settings
+from app.payments.yukassa import YukassaClient, YukassaError, new_idempotence_key
+
+ATTEMPTS = 3
+RETRY_AFTER_MS = 250
+# Допуск на планирование event loop сверх retry_after
+TIMING_SLACK = 0.2
+
+PAYMENT = {"id": "2c5d3f1e-000f-5000-8000-1a2b3c4d5e6f", "status": "pending",
+           "confirmation": {"type": "redirect", "confirmation_url": "https://yoomoney.ru/checkout"}}
+
+Step = Callable[[httpx.Request], httpx.Response]
+
+
+def reply(status_code: int, body: Optional[dict] = None) -> Step:
+    return lambda request: httpx.Response(status_code, json=body if body is not None else {"type": "error"})
+
+
+def disconnect(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection reset", request=request)
+
+
+class ScriptedTransport(httpx.MockTransport):
+    """Отвечает шагами сценария по очереди (последний повторяется) и пишет журнал запросов"""
+
+    def __init__(self, steps: List[Step]):
+        self.steps = steps
+        self.log: List[Tuple[float, httpx.Request]] = []
+        super().__init__(self._handle)
+
+    def _handle(self, request: httpx.Request) -> httpx.Response:
+        self.log.append((time.perf_counter(), request))
+        return self.steps[min(len(self.log), len(self.steps)) - 1](request)
+
+    @property
+    def keys(self) -> List[Optional[str]]:
+        return [request.headers.get("Idempotence-Key") for _, request in self.log]
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+async def create(steps: List[Step]) -> Tuple[ScriptedTransport, str, object]:
+    transport = ScriptedTransport(steps)
+    client = YukassaClient(shop_id="123456", secret_key="test_secret", transport=transport)
+    key = new_idempotence_key()
+    try:
+        result = await client.create_payment(100.0, "Пакет", "https://example.com/return", key, {"payment_id": 1})
+    except YukassaError as e:
+        result = e
+    finally:
+        await client.close()
+    return transport, key, result
+
+
+def check_same_key(transport: ScriptedTransport, key: str) -> None:
+    check(all(sent == key for sent in transport.keys), f"Idempotence-Key differs between attempts: {transport.keys}")
+
+
+async def retry_until_success() -> str:
+    transport, key, result = await create([reply(503), reply(500), reply(200, PAYMENT)])
+    check(result == PAYMENT, f"expected payment, got {result!r}")
+    check(len(transport.log) == 3, f"expected 3 requests, got {len(transport.log)}")
+    check_same_key(transport, key)
+    request = transport.log[0][1]
+    check(request.method == "POST" and request.url.path.endswith("/payments"), f"unexpected request {request.url}")
+    check(request.headers["Authorization"].startswith("Basic "), "Authorization header missing")
+    return "3 attempts, same Idempotence-Key"
+
+
+async def respects_retry_after() -> str:
+    transport, key, result = await create([reply(202, {"retry_after": RETRY_AFTER_MS}), reply(200, PAYMENT)])
+    check(result == PAYMENT, f"expected payment, got {result!r}")
+    check(len(transport.log) == 2, f"expected 2 requests, got {len(transport.log)}")
+    check_same_key(transport, key)
+    gap = transport.log[1][0] - transport.log[0][0]
+    check(RETRY_AFTER_MS / 1000 <= gap < RETRY_AFTER_MS / 1000 + TIMING_SLACK,
+          f"retry after {gap * 1000:.0f} ms, expected ~{RETRY_AFTER_MS} ms")
+    return f"retried after {gap * 1000:.0f} ms (retry_after={RETRY_AFTER_MS})"
+
+
+async def retry_on_transport_error() -> str:
+    transport, key, result = await create([disconnect, reply(200, PAYMENT)])
+    check(result == PAYMENT, f"expected payment, got {result!r}")
+    check(len(transport.log) == 2, f"expected 2 requests, got {len(transport.log)}")
+    check_same_key(transport, key)
+    return "2 attempts, same Idempotence-Key"
+
+
+async def no_retry_on_client_error() -> str:
+    transport, _, result = await create([reply(400), reply(200, PAYMENT)])
+    check(isinstance(result, YukassaError) and result.status_code == 400, f"expected YukassaError(400), got {result!r}")
+    check(len(transport.log) == 1, f"expected 1 request, got {len(transport.log)}")
+    return "1 attempt, YukassaError(400)"
+
+
+async def gives_up_after_attempts() -> str:
+    transport, key, result = await create([reply(503)])
+    check(isinstance(result, YukassaError) and result.status_code == 503, f"expected YukassaError(503), got {result!r}")
+    check(len(transport.log) == ATTEMPTS, f"expected {ATTEMPTS} requests, got {len(transport.log)}")
+    check_same_key(transport, key)
+    return f"{ATTEMPTS} attempts, YukassaError(503)"
+
+
+async def status_retried_without_key() -> str:
+    transport = ScriptedTransport([reply(502), reply(200, {**PAYMENT, "status": "succeeded"})])
+    client = YukassaClient(shop_id="123456", secret_key="test_secret", transport=transport)
+    try:
+        result = await client.get_payment_status(PAYMENT["id"])
+    finally:
+        await client.close()
+    check(result["status"] == "succeeded", f"unexpected status {result!r}")
+    check(transport.keys == [None, None], f"GET must not send Idempotence-Key: {transport.keys}")
+    return "2 attempts, no Idempotence-Key"
+
+
+async def run() -> int:
+    failed = 0
+    for scenario in (retry_until_success, respects_retry_after, retry_on_transport_error,
+                     no_retry_on_client_error, gives_up_after_attempts, status_retried_without_key):
+        try:
+            outcome = await scenario()
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {scenario.__name__}: {e}")
+        else:
+            print(f"ok   {scenario.__name__}: {outcome}")
+    return failed
+
+
+def main():
+    # Сценарии рассчитаны на 3 попытки; короткие паузы, чтобы проверка шла быстро
+    settings.YUKASSA_RETRY_ATTEMPTS = ATTEMPTS
+    settings.YUKASSA_RETRY_BASE_DELAY_MS = 10
+    if asyncio.run(run()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
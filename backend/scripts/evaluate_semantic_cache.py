@@ -0,0 +1,109 @@
+"""
+Офлайн-оценка семантического кеша на исторических ответах
+
+Для каждой попытки берутся пары (ответ на задание N → вопрос N+1) из user_tasks.
+Ранние пары каждого задания индексируются, поздние используются как запросы.
+Для набора порогов считается доля попаданий и качество подмены: косинусное
+сходство между вопросом из кеша и реально сгенерированным вопросом.
+
+Запуск (из каталога backend):
+    python -m scripts.evaluate_semantic_cache --train-ratio 0.7 --thresholds 0.8,0.85,0.9,0.95,0.97
+"""
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from app.ai_service import client
+from app.config import settings
+from app.database import SessionLocal
+from app.models import Task, UserTask
+from app.semantic_cache import NumpyCosineIndex, _normalize
+
+
+def load_pairs(limit: int) -> List[Tuple[int, str, str]]:
+    """(task_id, answer, follow_up) по всем завершённым шагам попыток"""
+    db = SessionLocal()
+    try:
+        rows = db.query(UserTask.progress_id, Task.id, Task.order, UserTask.question, UserTask.answer).join(
+            Task, Task.id == UserTask.task_id
+        ).filter(
+            UserTask.progress_id.isnot(None)
+        ).order_by(UserTask.progress_id, Task.order).limit(limit).all()
+    finally:
+        db.close()
+
+    by_progress: Dict[int, list] = defaultdict(list)
+    for row in rows:
+        by_progress[row.progress_id].append(row)
+
+    pairs = []
+    for steps in by_progress.values():
+        for current, following in zip(steps, steps[1:]):
+            if following.order == current.order + 1 and current.answer and following.question:
+                pairs.append((current.id, current.answer, following.question))
+    return pairs
+
+
+def embed_all(texts: List[str], batch_size: int = 100) -> np.ndarray:
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        response = client.embeddings.create(
+            model=settings.SEMANTIC_CACHE_EMBEDDING_MODEL,
+            input=texts[start:start + batch_size],
+        )
+        vectors.extend(item.embedding for item in response.data)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=20000, help="Максимум строк user_tasks")
+    parser.add_argument("--train-ratio", type=float, default=0.7)
+    parser.add_argument("--thresholds", default="0.8,0.85,0.9,0.95,0.97")
+    args = parser.parse_args()
+
+    pairs = load_pairs(args.limit)
+    if not pairs:
+        print("Нет данных для оценки")
+        return
+
+    answer_vectors = embed_all([answer for _, answer, _ in pairs])
+    follow_up_vectors = embed_all([follow_up for _, _, follow_up in pairs])
+
+    by_task: Dict[int, List[int]] = defaultdict(list)
+    for i, (task_id, _, _) in enumerate(pairs):
+        by_task[task_id].append(i)
+
+    index = NumpyCosineIndex(max_items_per_task=len(pairs))
+    queries: List[int] = []
+    follow_up_index: Dict[str, int] = {}
+    for task_id, indices in by_task.items():
+        split = max(1, int(len(indices) * args.train_ratio))
+        for i in indices[:split]:
+            _, answer, follow_up = pairs[i]
+            index.add(task_id, answer_vectors[i], answer, follow_up)
+            follow_up_index[follow_up] = i
+        queries.extend(indices[split:])
+
+    if not queries:
+        print("Недостаточно данных: все пары ушли в индекс")
+        return
+
+    matches = [(i, index.search(pairs[i][0], answer_vectors[i])) for i in queries]
+
+    print(f"Пар: {len(pairs)}, запросов: {len(queries)}, заданий: {len(by_task)}")
+    print(f"{'threshold':>10} {'hit_rate':>10} {'quality':>10}")
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        hits = [(i, m) for i, m in matches if m and m.similarity >= threshold]
+        quality = [
+            float(_normalize(follow_up_vectors[follow_up_index[m.follow_up]]) @ _normalize(follow_up_vectors[i]))
+            for i, m in hits
+        ]
+        mean_quality = sum(quality) / len(quality) if quality else 0.0
+        print(f"{threshold:>10.2f} {len(hits) / len(queries):>10.3f} {mean_quality:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
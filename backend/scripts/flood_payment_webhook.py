@@ -0,0 +1,126 @@
+"""
+Проверка идемпотентности выдачи доступа при повторной доставке webhook'а ЮKassa
+
+Создаёт в БД тестовый платёж за пакет (или берёт --payment-id), сбрасывает его
+в pending, параллельно отправляет --copies одинаковых уведомлений
+payment.succeeded на запущенный backend, ждёт обработки inbox'а (до --wait
+секунд) и проверяет результат: платёж completed, у пользователя ровно по одной записи user_progress первой попытки
+на каждую профессию пакета, ни один запрос не вернул ошибку.
+
+Запуск (из каталога backend, backend запущен на --api-url):
+    python -m scripts.flood_payment_webhook --user-id 1 --package-id 1 --copies 200
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from collections import Counter
+
+import httpx
+from sqlalchemy import func
+
+from app.database import SessionLocal
+from app.models import Package, Payment, UserProgress
+
+
+def prepare_payment(args) -> Payment:
+    db = SessionLocal()
+    try:
+        if args.payment_id:
+            payment = db.get(Payment, args.payment_id)
+            if payment is None:
+                sys.exit(f"Payment {args.payment_id} not found")
+        else:
+            package = db.get(Package, args.package_id)
+            if package is None:
+                sys.exit(f"Package {args.package_id} not found")
+            payment = Payment(user_id=args.user_id, amount=package.price, package_id=package.id)
+            db.add(payment)
+        payment.status = "pending"
+        payment.completed_at = None
+        payment.yukassa_payment_id = payment.yukassa_payment_id or f"flood_{uuid.uuid4().hex}"
+        db.commit()
+        db.refresh(payment)
+        return payment
+    finally:
+        db.close()
+
+
+async def flood(api_url: str, yukassa_payment_id: str, copies: int) -> Counter:
+    body = {"type": "notification", "event": "payment.succeeded", "object": {"id": yukassa_payment_id, "status": "succeeded"}}
+    async with httpx.AsyncClient(base_url=api_url, timeout=30.0) as client:
+        responses = await asyncio.gather(
+            *(client.post("/api/payments/webhook", json=body) for _ in range(copies)),
+            return_exceptions=True,
+        )
+    outcomes = Counter()
+    for response in responses:
+        if isinstance(response, Exception):
+            outcomes[type(response).__name__] += 1
+        else:
+            outcomes[f"{response.status_code} {response.json().get('status')}"] += 1
+    return outcomes
+
+
+def wait_completed(payment_id: int, timeout: float) -> None:
+    """Уведомления обрабатываются воркерами inbox'а асинхронно - ждём завершения"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db = SessionLocal()
+        try:
+            if db.get(Payment, payment_id).status == "completed":
+                return
+        finally:
+            db.close()
+        time.sleep(0.5)
+
+
+def check(payment_id: int) -> bool:
+    db = SessionLocal()
+    try:
+        payment = db.get(Payment, payment_id)
+        profession_ids = [payment.profession_id] if payment.profession_id else []
+        if payment.package_id:
+            profession_ids = db.get(Package, payment.package_id).profession_ids or []
+        rows = dict(db.query(UserProgress.profession_id, func.count()).filter(
+            UserProgress.user_id == payment.user_id,
+            UserProgress.profession_id.in_(profession_ids),
+            UserProgress.attempt_number == 1,
+        ).group_by(UserProgress.profession_id).all())
+    finally:
+        db.close()
+
+    ok = payment.status == "completed"
+    print(f"payment {payment_id}: status={payment.status}")
+    for profession_id in profession_ids:
+        count = rows.get(profession_id, 0)
+        ok = ok and count == 1
+        print(f"  profession {profession_id}: {count} progress row(s)")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--package-id", type=int)
+    parser.add_argument("--payment-id", type=int, help="Использовать существующий платёж")
+    parser.add_argument("--copies", type=int, default=200)
+    parser.add_argument("--wait", type=float, default=30.0, help="Сколько ждать обработки, секунд")
+    args = parser.parse_args()
+    if not args.payment_id and not (args.user_id and args.package_id):
+        parser.error("--payment-id or --user-id with --package-id required")
+
+    payment = prepare_payment(args)
+    outcomes = asyncio.run(flood(args.api_url, payment.yukassa_payment_id, args.copies))
+    print("responses:", dict(outcomes))
+    wait_completed(payment.id, args.wait)
+
+    ok = check(payment.id) and set(outcomes) == {"200 ok"}
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Нагрузочный тест стриминга вопросов: синхронный клиент OpenAI против AsyncOpenAI
+
+Поднимает в отдельном потоке локальный фейковый OpenAI-совместимый сервер
+(POST /v1/chat/completions, stream=true: --tokens кадров SSE с интервалом
+--interval-ms) и направляет на него оба клиента app/ai_service.py через
+OPENAI_BASE_URL. Затем в одном event loop одновременно запускает --concurrency
+"пользователей", каждый читает стрим вопроса:
+
+- sync:  `for token in generate_task_question_stream(...)` внутри async def -
+         так стримы читались в роутерах раньше, loop заблокирован на весь стрим;
+- async: `async for token in generate_task_question_stream_async(...)`.
+
+Для каждого режима выводятся общее время, стримов в секунду, p50/p99 времени
+до первого токена и наибольшая задержка event loop (тикер каждые 10 мс).
+Ни ключ OpenAI, ни БД не нужны.
+
+Запуск (из каталога backend):
+    python -m scripts.loadtest_llm_streams --concurrency 200 --tokens 50 --interval-ms 20
+    python -m scripts.loadtest_llm_streams --concurrency 20 --modes async
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from typing import List
+
+LOOP_TICK = 0.01
+
+
+# --- Фейковый OpenAI ---------------------------------------------------------
+
+def _chunk(index: int, content: str = None, finish_reason: str = None) -> bytes:
+    delta = {"content": content} if content is not None else {}
+    payload = {
+        "id": f"chatcmpl-fake-{index}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "fake-model",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    data = f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+class FakeOpenAIServer:
+    """HTTP/1.1 с keep-alive и chunked-ответом; работает в своём потоке и своём loop"""
+
+    def __init__(self, tokens: int, interval: float):
+        self.tokens = tokens
+        self.interval = interval
+        self.requests = 0
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+
+    def start(self) -> str:
+        threading.Thread(target=self._run, daemon=True).start()
+        self._started.wait()
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, sock=sock, backlog=4096))
+        self._started.set()
+        self._loop.run_forever()
+        server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.decode("latin-1").split("\r\n")[1:]:
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                await reader.readexactly(length)
+                self.requests += 1
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                    b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+                )
+                for i in range(self.tokens):
+                    await asyncio.sleep(self.interval)
+                    writer.write(_chunk(i, f"слово{i} "))
+                    await writer.drain()
+                writer.write(_chunk(self.tokens, finish_reason="stop"))
+                data = b"data: [DONE]\n\n"
+                writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(data), data))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# --- Нагрузка ----------------------------------------------------------------
+
+async def loop_lag_monitor(stop: asyncio.Event, lags: List[float]) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_TICK)
+        lags.append(time.perf_counter() - started - LOOP_TICK)
+
+
+async def one_user(mode: str, ttft: List[float], failures: List[int]) -> None:
+    from app.ai_service import (
+        QUESTION_FALLBACK_PREFIX,
+        generate_task_question_stream,
+        generate_task_question_stream_async,
+    )
+
+    args = ("Ты - руководитель проекта.", "Оцените риски релиза.", [])
+    started = time.perf_counter()
+    first = None
+    text = []
+    if mode == "sync":
+        for token in generate_task_question_stream(*args):
+            first = first or time.perf_counter() - started
+            text.append(token)
+    else:
+        async for token in generate_task_question_stream_async(*args):
+            first = first or time.perf_counter() - started
+            text.append(token)
+    if first is not None:
+        ttft.append(first)
+    if not text or "".join(text).startswith(QUESTION_FALLBACK_PREFIX):
+        failures.append(1)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run_mode(mode: str, concurrency: int) -> None:
+    ttft: List[float] = []
+    failures: List[int] = []
+    lags: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(loop_lag_monitor(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(one_user(mode, ttft, failures) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    print(f"{mode:<6} {elapsed:>8.2f}s {concurrency / elapsed:>10.1f} "
+          f"{percentile(ttft, 0.5) * 1000:>9.0f}ms {percentile(ttft, 0.99) * 1000:>9.0f}ms "
+          f"{max(lags, default=0) * 1000:>11.0f}ms {len(failures):>7}")
+
+
+async def run(args) -> None:
+    from app.ai_service import close_async_client
+
+    print(f"{args.concurrency} concurrent streams x {args.tokens} tokens, interval {args.interval_ms} ms "
+          f"(one stream alone ~{args.tokens * args.interval_ms / 1000:.2f}s)")
+    print(f"{'mode':<6} {'total':>9} {'streams/s':>10} {'ttft p50':>11} {'ttft p99':>11} {'max loop lag':>13} {'errors':>7}")
+    try:
+        for mode in args.modes:
+            await run_mode(mode, args.concurrency)
+    finally:
+        await close_async_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--interval-ms", type=float, default=20.0)
+    parser.add_argument("--modes", nargs="+", choices=["sync", "async"], default=["sync", "async"])
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.tokens, args.interval_ms / 1000)
+    # Клиенты app.ai_service создаются при импорте - адрес нужно задать до него
+    os.environ["OPENAI_BASE_URL"] = server.start()
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["LLM_BACKENDS"] = ""
+    os.environ["LLM_LIMIT_INITIAL"] = str(max(args.concurrency, 1))
+    os.environ["LLM_LIMIT_MAX"] = str(max(args.concurrency, 1))
+    os.environ["OPENAI_MAX_CONNECTIONS"] = str(max(args.concurrency, 1))
+    os.environ["PROMPT_TRACE_SAMPLE_RATE"] = "0"
+    asyncio.run(run(args))
+    print(f"fake server handled {server.requests} requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Восстановление промпта из трассы (app/prompt_trace.py) для повторного запуска
+
+Без --trace-id выводит список трасс из файлов (текущий .jsonl и ротированные
+.jsonl.gz). С --trace-id печатает JSON с параметрами и messages запроса.
+
+Если трасса записана без текстов (PROMPT_TRACE_INCLUDE_BODIES=false), тексты
+сообщений ищутся в БД по sha256 среди данных попытки: system prompt сценария,
+описания заданий, история conversation_messages, вопросы/ответы/оценки
+user_tasks и шаблон отчёта профессии. Сообщения, собранные из нескольких
+источников (промпт финального отчёта, краткое содержание истории), так не
+восстанавливаются - они перечисляются в "missing".
+
+Запуск (из каталога backend):
+    python -m scripts.replay_prompt_trace logs/prompt_traces
+    python -m scripts.replay_prompt_trace logs/prompt_traces --trace-id 3f2a... --send
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Optional
+
+from app.prompt_trace import TRACE_FILE_NAME, text_hash
+
+
+def trace_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            # Хронологически: старшие ротированные файлы (.N.gz) первыми, текущий - последним
+            current = os.path.join(path, TRACE_FILE_NAME)
+            rotated = glob.glob(current + ".*.gz")
+            files.extend(sorted(rotated, key=lambda name: int(name.rsplit(".", 2)[-2]), reverse=True))
+            if os.path.exists(current):
+                files.append(current)
+        else:
+            files.append(path)
+    return files
+
+
+def read_traces(paths: List[str]) -> Iterator[Dict]:
+    for path in trace_files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_candidates(trace: Dict) -> Dict[str, str]:
+    """sha256 -> текст для данных сценария и попытки из трассы"""
+    from app.database import SessionLocal
+    from app.models import ConversationMessage, ReportTemplate, Scenario, Task, UserTask
+
+    texts: List[Optional[str]] = []
+    db = SessionLocal()
+    try:
+        scenario = db.get(Scenario, trace["scenario_id"]) if trace.get("scenario_id") else None
+        if scenario is not None:
+            texts.append(scenario.system_prompt)
+            texts.extend(row.description_template for row in db.query(Task.description_template).filter(
+                Task.scenario_id == scenario.id
+            ))
+            texts.extend(row.template_text for row in db.query(ReportTemplate.template_text).filter(
+                ReportTemplate.profession_id == scenario.profession_id
+            ))
+        if trace.get("progress_id"):
+            texts.extend(row.content for row in db.query(ConversationMessage.content).filter(
+                ConversationMessage.progress_id == trace["progress_id"]
+            ))
+            for row in db.query(UserTask.question, UserTask.answer, UserTask.evaluation).filter(
+                UserTask.progress_id == trace["progress_id"]
+            ):
+                texts.extend([row.question, row.answer, row.evaluation])
+    finally:
+        db.close()
+    return {text_hash(text): text for text in texts if text}
+
+
+def rehydrate(trace: Dict) -> Dict:
+    messages = trace["messages"]
+    candidates = {}
+    if any("content" not in m for m in messages):
+        candidates = load_candidates(trace)
+
+    restored, missing = [], []
+    for index, message in enumerate(messages):
+        content = message.get("content")
+        if content is None:
+            content = candidates.get(message["sha256"])
+        if content is None:
+            missing.append(index)
+        restored.append({"role": message["role"], "content": content})
+
+    return {
+        "trace_id": trace["trace_id"],
+        "name": trace["name"],
+        "model": trace.get("model"),
+        "temperature": trace.get("temperature"),
+        "max_completion_tokens": trace.get("max_completion_tokens"),
+        "messages": restored,
+        "missing": missing,
+        "response_sha256": (trace.get("response") or {}).get("sha256"),
+    }
+
+
+def send(replay: Dict) -> None:
+    from app.ai_service import client
+
+    params = {"max_completion_tokens": replay["max_completion_tokens"]}
+    if replay["temperature"] is not None:
+        params["temperature"] = replay["temperature"]
+    response = client.chat.completions.create(model=replay["model"], messages=replay["messages"], **params)
+    text = response.choices[0].message.content or ""
+    print(text)
+    same = text_hash(text) == replay["response_sha256"]
+    print(f"\n--- response {'identical to' if same else 'differs from'} the traced one", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Каталог PROMPT_TRACE_DIR или файлы трасс")
+    parser.add_argument("--trace-id", help="Трасса для восстановления")
+    parser.add_argument("--send", action="store_true", help="Повторить запрос к OpenAI и вывести ответ")
+    args = parser.parse_args()
+
+    if not args.trace_id:
+        print(f"{'ts':<24} {'trace_id':<32} {'name':<36} {'user':>6} {'scen':>5} {'msgs':>4} {'ms':>7} error")
+        for trace in read_traces(args.paths):
+            print(
+                f"{trace['ts']:<24} {trace['trace_id']:<32} {trace['name']:<36} "
+                f"{str(trace.get('user_id') or '-'):>6} {str(trace.get('scenario_id') or '-'):>5} "
+                f"{len(trace['messages']):>4} {trace.get('duration_ms', 0):>7} {trace.get('error') or ''}"
+            )
+        return
+
+    trace = next((t for t in read_traces(args.paths) if t["trace_id"] == args.trace_id), None)
+    if trace is None:
+        sys.exit(f"Trace {args.trace_id} not found")
+
+    replay = rehydrate(trace)
+    print(json.dumps(replay, ensure_ascii=False, indent=2))
+    if args.send:
+        if replay["missing"]:
+            sys.exit(f"Cannot replay: messages {replay['missing']} were not restored")
+        send(replay)
+
+
+if __name__ == "__main__":
+    main()
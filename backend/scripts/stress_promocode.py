@@ -0,0 +1,97 @@
+"""
+Нагрузочная проверка резервации промокодов (app/payments/promocodes.py)
+
+Создаёт временный промокод с лимитом --max-uses и параллельно выполняет
+--checkouts резерваций, каждую в своей транзакции вместе с платежом - как
+create_payment. Проверяет, что успешных резерваций ровно max_uses и
+current_uses совпадает с ними, затем освобождает половину резерваций (дважды -
+повтор не должен ничего менять) и сверяет счётчик ещё раз. Временные платежи и
+промокод удаляются.
+
+Запуск (из каталога backend, нужна БД с применёнными миграциями):
+    python -m scripts.stress_promocode --user-id 1 --max-uses 50 --checkouts 500
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from collections import Counter
+
+from fastapi import HTTPException
+from sqlalchemy import delete
+
+from app.database import AsyncSessionLocal, async_engine
+from app.models import Payment, Promocode
+from app.payments.promocodes import promocode_guard
+
+
+async def checkout(code: str, user_id: int, outcomes: Counter, payment_ids: list) -> None:
+    async with AsyncSessionLocal() as db:
+        try:
+            await promocode_guard.reserve(db, code)
+        except HTTPException as e:
+            outcomes[e.detail] += 1
+            return
+        payment = Payment(user_id=user_id, amount=0, promocode=code, promocode_reserved=True, status="pending")
+        db.add(payment)
+        await db.commit()
+        outcomes["reserved"] += 1
+        payment_ids.append(payment.id)
+
+
+async def current_uses(promocode_id: int) -> int:
+    async with AsyncSessionLocal() as db:
+        return (await db.get(Promocode, promocode_id)).current_uses
+
+
+async def run(args) -> bool:
+    code = f"STRESS_{uuid.uuid4().hex[:8].upper()}"
+    async with AsyncSessionLocal() as db:
+        promocode = Promocode(code=code, discount_percent=10, max_uses=args.max_uses, current_uses=0)
+        db.add(promocode)
+        await db.commit()
+        promocode_id = promocode.id
+
+    outcomes: Counter = Counter()
+    payment_ids: list = []
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(checkout(code, args.user_id, outcomes, payment_ids) for _ in range(args.checkouts)))
+        elapsed = time.perf_counter() - started
+        uses = await current_uses(promocode_id)
+        print(f"{args.checkouts} checkouts in {elapsed:.2f}s: {dict(outcomes)}")
+        print(f"current_uses={uses}, guard={promocode_guard.stats()}")
+        ok = outcomes["reserved"] == args.max_uses == uses
+
+        to_release = payment_ids[: len(payment_ids) // 2]
+        for _ in range(2):
+            async with AsyncSessionLocal() as db:
+                await promocode_guard.release(db, to_release)
+                await db.commit()
+        uses = await current_uses(promocode_id)
+        print(f"released {len(to_release)} twice: current_uses={uses}")
+        ok = ok and uses == args.max_uses - len(to_release)
+    finally:
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(Payment).where(Payment.promocode == code))
+            await db.execute(delete(Promocode).where(Promocode.id == promocode_id))
+            await db.commit()
+        await async_engine.dispose()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, required=True, help="Владелец временных платежей")
+    parser.add_argument("--max-uses", type=int, default=50)
+    parser.add_argument("--checkouts", type=int, default=500)
+    args = parser.parse_args()
+
+    ok = asyncio.run(run(args))
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+-- Миграция: Семантический кеш следующего вопроса (pgvector)
+-- Дата: 2026-10-17
+-- Требует расширение vector (https://github.com/pgvector/pgvector).
+-- Если расширение недоступно, backend использует in-process индекс на NumPy.
+
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS answer_embeddings (
+    id SERIAL PRIMARY KEY,
+    task_id INTEGER NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    question TEXT,
+    answer TEXT NOT NULL,
+    follow_up TEXT NOT NULL,
+    embedding vector(1536) NOT NULL,  -- = SEMANTIC_CACHE_EMBEDDING_DIM
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_answer_embeddings_task ON answer_embeddings(task_id);
+
+-- ANN-индекс по косинусному расстоянию. Выберите ОДИН вариант и укажите его
+-- в SEMANTIC_CACHE_INDEX (hnsw | ivfflat).
+
+-- HNSW (pgvector >= 0.5.0): лучше recall, не требует данных для построения
+CREATE INDEX IF NOT EXISTS idx_answer_embeddings_hnsw
+ON answer_embeddings USING hnsw (embedding vector_cosine_ops);
+
+-- IVFFlat: строить после накопления данных (lists ≈ rows / 1000)
+-- CREATE INDEX IF NOT EXISTS idx_answer_embeddings_ivfflat
+-- ON answer_embeddings USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+
+COMMIT;
@@ -0,0 +1,54 @@
+-- Миграция: История диалога из JSON-колонки user_progress.conversation_history
+-- в append-only таблицу conversation_messages
+-- Дата: 2026-10-17
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    progress_id INTEGER NOT NULL REFERENCES user_progress(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role VARCHAR NOT NULL,
+    content TEXT NOT NULL,
+    task_order INTEGER,  -- для вопросов AI: номер задания
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (progress_id, seq)
+);
+
+-- Точечный поиск уже сгенерированного вопроса для задания
+CREATE INDEX IF NOT EXISTS idx_conversation_messages_question
+ON conversation_messages(progress_id, task_order)
+WHERE role = 'assistant';
+
+-- Перенос данных: N-й вопрос AI в истории относится к заданию N
+INSERT INTO conversation_messages (progress_id, seq, role, content, task_order)
+SELECT
+    up.id,
+    m.ord::INTEGER,
+    m.msg->>'role',
+    COALESCE(m.msg->>'content', ''),
+    CASE WHEN m.msg->>'role' = 'assistant' THEN
+        (ROW_NUMBER() OVER (
+            PARTITION BY up.id, (m.msg->>'role' = 'assistant')
+            ORDER BY m.ord
+        ))::INTEGER
+    END
+FROM user_progress up
+CROSS JOIN LATERAL jsonb_array_elements(up.conversation_history::jsonb) WITH ORDINALITY AS m(msg, ord)
+WHERE up.conversation_history IS NOT NULL
+  AND jsonb_typeof(up.conversation_history::jsonb) = 'array'
+ON CONFLICT DO NOTHING;
+
+COMMIT;
+
+-- ============================================================
+-- Проверка миграции
+-- ============================================================
+
+SELECT
+    (SELECT COUNT(*) FROM conversation_messages) AS migrated_messages,
+    (SELECT COALESCE(SUM(jsonb_array_length(conversation_history::jsonb)), 0)
+     FROM user_progress
+     WHERE jsonb_typeof(conversation_history::jsonb) = 'array') AS source_messages;
+
+-- После проверки JSON-колонку можно очистить:
+-- UPDATE user_progress SET conversation_history = NULL;
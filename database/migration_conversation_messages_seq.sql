@@ -0,0 +1,18 @@
+-- Миграция: Порядок сообщений истории диалога из последовательности БД
+-- Дата: 2026-10-17
+-- seq вычислялся как max(seq) + 1 по попытке: две параллельные вставки
+-- (ответ и возобновлённый стрим, две вкладки) получали одинаковый seq и
+-- нарушали первичный ключ. Теперь seq берётся из общей последовательности:
+-- значения уникальны и возрастают, но внутри попытки идут не подряд -
+-- они используются только для упорядочивания.
+
+BEGIN;
+
+CREATE SEQUENCE IF NOT EXISTS conversation_messages_seq AS INTEGER;
+
+SELECT setval('conversation_messages_seq', GREATEST((SELECT COALESCE(MAX(seq), 0) FROM conversation_messages), 1));
+
+ALTER TABLE conversation_messages ALTER COLUMN seq SET DEFAULT nextval('conversation_messages_seq');
+ALTER SEQUENCE conversation_messages_seq OWNED BY conversation_messages.seq;
+
+COMMIT;
@@ -0,0 +1,12 @@
+-- Миграция: Ключ идемпотентности создания платежа в ЮKassa (Idempotence-Key)
+-- Дата: 2026-10-17
+
+BEGIN;
+
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS idempotence_key VARCHAR;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotence_key ON payments(idempotence_key);
+
+COMMENT ON COLUMN payments.idempotence_key IS 'Idempotence-Key запроса создания платежа; повторы с этим ключом не создают второй платёж';
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- Миграция: Резервация использований промокодов за платежами
+-- Дата: 2026-10-17
+-- Использование засчитывается при создании платежа и освобождается, если
+-- платёж отменён или не оплачен (см. app/payments/promocodes.py).
+
+BEGIN;
+
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS promocode_reserved BOOLEAN DEFAULT FALSE;
+
+-- Существующие платежи с промокодом уже учтены в promocodes.current_uses
+UPDATE payments
+SET promocode_reserved = TRUE
+WHERE promocode IS NOT NULL AND status IN ('pending', 'completed');
+
+-- Фоновая очистка неоплаченных платежей
+CREATE INDEX IF NOT EXISTS idx_payments_pending_created
+ON payments(created_at)
+WHERE status = 'pending';
+
+COMMENT ON COLUMN payments.promocode_reserved IS 'Использование промокода засчитано в promocodes.current_uses';
+
+COMMIT;
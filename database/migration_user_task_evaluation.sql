@@ -0,0 +1,11 @@
+-- Миграция: Краткая оценка ответа на задание для инкрементального отчёта (REPORT_MODE=incremental)
+-- Обязательна при любом REPORT_MODE: колонка отображена в модели UserTask
+-- Дата: 2026-10-17
+
+BEGIN;
+
+ALTER TABLE user_tasks ADD COLUMN IF NOT EXISTS evaluation TEXT;
+
+COMMENT ON COLUMN user_tasks.evaluation IS 'Краткая оценка ответа; финальный отчёт строится по этим оценкам';
+
+COMMIT;
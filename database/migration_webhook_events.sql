@@ -0,0 +1,33 @@
+-- Миграция: Inbox входящих webhook'ов ЮKassa
+-- Дата: 2026-10-17
+-- Endpoint только сохраняет уведомление, обработку выполняют воркеры
+-- (app/payments/webhook_inbox.py) с повторами.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id SERIAL PRIMARY KEY,
+    event_key VARCHAR NOT NULL,
+    event_type VARCHAR NOT NULL,
+    object_id VARCHAR NOT NULL,
+    payload JSON NOT NULL,
+    status VARCHAR NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Повторная доставка того же события не создаёт вторую запись
+CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_events_event_key ON webhook_events(event_key);
+
+-- Выборка воркерами: только незавершённые события
+CREATE INDEX IF NOT EXISTS idx_webhook_events_due
+ON webhook_events(next_attempt_at)
+WHERE status IN ('pending', 'processing');
+
+COMMENT ON TABLE webhook_events IS 'Входящие уведомления ЮKassa: сохраняются endpoint''ом, обрабатываются воркерами с повторами';
+COMMENT ON COLUMN webhook_events.event_key IS 'event:object.id - ключ дедупликации повторных доставок';
+
+COMMIT;